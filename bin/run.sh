@@ -1,3 +1,5 @@
 #!/usr/bin/env bash
 
-uwsgi --http 0.0.0.0:8080 --wsgi-file run.py --callable app --enable-threads --uid aurora
+# Every worker loads the app, and the workers elect the one running the jobs
+uwsgi --http 0.0.0.0:8080 --wsgi-file run.py --callable app --enable-threads --uid aurora \
+    --lazy-apps --env COORDINATION_DIR=/tmp/freg-quality-metrics
@@ -3,7 +3,16 @@ from . import config
 
 config.configure_logging()
 
-from flask import Flask
 
-from . import bigquery
-from .app import create_app
+def __getattr__(name):
+    # The app and the modules behind it (Flask, pandas, google-cloud-bigquery)
+    # are imported on first use, so that importing the package stays cheap.
+    if name == "create_app":
+        from .app import create_app
+
+        return create_app
+    if name in ("app", "bigquery", "metrics", "scheduler"):
+        import importlib
+
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
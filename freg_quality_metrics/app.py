@@ -1,12 +1,13 @@
 import datetime
 import logging
+import threading
 
 # Flask (webapp library) and flask-related dispatcher
 from flask import Flask, Response
 from flask_wtf.csrf import CSRFProtect
 
-from . import metrics, scheduler
-from .config import INTERVAL_MINUTES
+from . import coordination, exposition, metrics, ondemand, scheduler
+from .config import COORDINATION_DIR, INTERVAL_MINUTES, MAX_STALENESS_SECONDS
 
 
 logger = logging.getLogger(__name__)
@@ -28,13 +29,38 @@ def create_app():
     csrf = CSRFProtect()
     csrf.init_app(app)
 
-    metrics.configure_prometheus(app, **kwargs)
-    scheduler.configure_scheduler(**kwargs)
+    # With MAX_STALENESS_SECONDS, scrapes refresh the jobs gone stale first
+    before_scrape = None
+    if MAX_STALENESS_SECONDS is not None:
+        before_scrape = ondemand.before_scrape
+    metrics.configure_prometheus(app, before_scrape=before_scrape, **kwargs)
+
+    def start_jobs():
+        metrics.load_saved_results()
+        scheduler.configure_scheduler(**kwargs)
+        # Dry runs wait for BigQuery, so they are kept out of startup
+        threading.Thread(
+            target=metrics.estimate_costs, name="estimate-costs", daemon=True
+        ).start()
+
+    if COORDINATION_DIR is None:
+        start_jobs()
+    else:
+        # Only the elected process runs the jobs, see coordination.py
+        coordination.elect(COORDINATION_DIR, start_jobs)
 
     @app.route("/health/ready")
     def ready():
-        """Tells whether or not the app is ready to receive requests"""
-        return Response(status=200)
+        """
+        Tells whether or not the app is ready to receive requests, i.e. has
+        metrics loaded from saved results or from a refresh, or follows a
+        leader that is ready
+        """
+        following = exposition.COLLECTOR.following
+        ready = metrics.READY.is_set() or (
+            following and exposition.COLLECTOR.snapshot.ready
+        )
+        return Response(status=200 if ready else 503)
 
     @app.route("/health/alive")
     def alive():
@@ -1,38 +1,531 @@
+from __future__ import annotations
+
+import collections
+import functools
 import logging
+import math
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, NamedTuple
+
+from . import idents, results
+
 
-import pandas
-from google.cloud import bigquery
+if TYPE_CHECKING:
+    import pandas
 
 
 logger = logging.getLogger(__name__)
 logger.debug("Logging is configured.")
 
+# Pre-aggregated sources read by the scheduled jobs. Each entry holds the
+# columns the query returns and the query itself, with {project} as a
+# placeholder for the GCP project.
+PRE_AGGREGATED = {
+    "total_and_distinct": (
+        ("datasett", "tabell", "variabel", "totalt", "distinkte"),
+        """
+            SELECT datasett, tabell, variabel, totalt, distinkte
+            FROM `{project}.kvalitet.metrics_count_total_and_distinct`
+        """,
+    ),
+    "number_of_citizenships": (
+        ("datasett", "gruppe", "antall"),
+        """
+            SELECT datasett, gruppe, antall
+            FROM `{project}.kvalitet.metrics_antall_statsborgerskap`
+        """,
+    ),
+    "valid_fnr": (
+        (
+            "datasett",
+            "tabell",
+            "variabel",
+            "fnr_total_count",
+            "fnr_invalid_format",
+            "fnr_invalid_first_digit",
+            "fnr_invalid_date",
+            "fnr_invalid_control",
+            "dnr_total_count",
+            "dnr_invalid_format",
+            "dnr_invalid_first_digit",
+            "dnr_invalid_date",
+            "dnr_invalid_control",
+        ),
+        """
+            SELECT datasett, tabell, variabel,
+                fnr_total_count, fnr_invalid_format, fnr_invalid_first_digit, fnr_invalid_date, fnr_invalid_control,
+                dnr_total_count, dnr_invalid_format, dnr_invalid_first_digit, dnr_invalid_date, dnr_invalid_control
+            FROM `{project}.kvalitet.metrics_count_valid_fnr_dnr`
+        """,
+    ),
+    "count_group_by": (
+        ("datasett", "tabell", "variabel", "gruppe", "antall"),
+        """
+        SELECT datasett, tabell, variabel, gruppe, antall
+        FROM `{project}.kvalitet.metrics_count_group_by`
+        """,
+    ),
+    "latest_timestamp": (
+        ("datasett", "tabell", "variabel", "latest_timestamp"),
+        """
+            SELECT datasett, tabell, variabel, latest_timestamp
+            FROM `{project}.kvalitet.metrics_latest_timestamp`
+        """,
+    ),
+    "metrics_timestamp": (
+        ("latest_timestamp",),
+        """
+            SELECT
+                FORMAT_DATETIME("%Y-%m-%d %H:%M:%S", MAX(tidspunkt)) as latest_timestamp,
+            FROM `{project}.kvalitet.metrics_count_total_and_distinct`
+        """,
+    ),
+    "dsfsit_latest_timestamp": (
+        ("latest_timestamp",),
+        """
+            select FORMAT_TIMESTAMP("%d-%m-%Y %H:%M:%S", max(tidspunkt)) as latest_timestamp
+                from `{project}.kvalitet.qa_nullvalue_columns`
+                where datasett='klargjort' and tabell='dsf_situasjonsuttak'
+        """,
+    ),
+    "dsfsit_qa_nullvals_latest": (
+        ("kolonne", "ant_nullvals", "pct_nullvals"),
+        """
+            with ranked_values as
+            (
+              select tidspunkt, kolonne, ant_nullvals, pct_nullvals,
+              ROW_NUMBER() OVER (PARTITION BY datasett, tabell, kolonne order by tidspunkt desc) as rank
+              from `kvalitet.qa_nullvalue_columns`
+              where datasett='klargjort' and tabell='dsf_situasjonsuttak'
+            ),
+            max_dato as
+            (
+              select cast(max(tidspunkt) AS DATE) as dato
+              from ranked_values
+            )
+            select kolonne, ant_nullvals, pct_nullvals
+            from ranked_values a, max_dato d
+            where a.rank=1
+            and tidspunkt > d.dato  -- This makes sure we only get variables from the latest run
+        """,
+    ),
+    "dsfsit_qa_nullvals_diff": (
+        ("kolonne", "ant_nullvals", "pct_nullvals", "pct_diff_last"),
+        """
+            with differanser as
+            (
+              select tidspunkt, kolonne, ant_nullvals, pct_nullvals,
+              IFNULL((pct_nullvals - LAG(pct_nullvals) OVER (PARTITION BY kolonne ORDER BY tidspunkt)), pct_nullvals) as pct_diff
+              from `kvalitet.qa_nullvalue_columns`
+              where datasett='klargjort' and tabell='dsf_situasjonsuttak'
+            ), ranked_nyeste as
+            (
+              SELECT *, ROW_NUMBER() OVER (PARTITION BY kolonne ORDER BY tidspunkt desc) as ranked
+              from differanser
+            ),
+            max_dato as
+            (
+              select cast(max(tidspunkt) AS DATE) as dato
+              from differanser
+            )
+            select d.dato, kolonne, ant_nullvals, pct_nullvals, round(pct_diff,2) as pct_diff_last
+            from ranked_nyeste, max_dato d where ranked=1 and tidspunkt > d.dato
+            and (pct_diff >= 0.1 or pct_diff <= -0.1)
+        """,
+    ),
+}
+
+# BigQuery types of the columns in the combined result of a batched refresh.
+# Numbers are read as FLOAT64 since they all end up in Prometheus gauges.
+BATCH_COLUMNS = {
+    "datasett": "STRING",
+    "tabell": "STRING",
+    "variabel": "STRING",
+    "gruppe": "STRING",
+    "kolonne": "STRING",
+    "latest_timestamp": "STRING",
+    "totalt": "FLOAT64",
+    "distinkte": "FLOAT64",
+    "antall": "FLOAT64",
+    "fnr_total_count": "FLOAT64",
+    "fnr_invalid_format": "FLOAT64",
+    "fnr_invalid_first_digit": "FLOAT64",
+    "fnr_invalid_date": "FLOAT64",
+    "fnr_invalid_control": "FLOAT64",
+    "dnr_total_count": "FLOAT64",
+    "dnr_invalid_format": "FLOAT64",
+    "dnr_invalid_first_digit": "FLOAT64",
+    "dnr_invalid_date": "FLOAT64",
+    "dnr_invalid_control": "FLOAT64",
+    "ant_nullvals": "FLOAT64",
+    "pct_nullvals": "FLOAT64",
+    "pct_diff_last": "FLOAT64",
+}
+
+# Precision of the HyperLogLog++ sketches of approximate distinct counts, and
+# the relative standard error of the counts estimated from them
+HLL_PRECISION = 15
+HLL_RELATIVE_ERROR = 1.04 / math.sqrt(2**HLL_PRECISION)
+
+
+class QueryStats(NamedTuple):
+    """Time spent in each phase of a query job, and the statistics of the job."""
+
+    queue_seconds: float
+    execution_seconds: float
+    download_seconds: float
+    bytes_processed: int
+    bytes_billed: int
+    slot_millis: int
+    rows: int
+    cache_hit: bool
+    # Bytes of the largest page of a result read page by page, 0 otherwise
+    peak_page_bytes: int = 0
+
+
+# Number of query texts BigQuery.estimate_bytes() keeps the estimate of
+ESTIMATES_KEPT = 256
+
+# The client shared by the BigQuery instances of all projects, so that their
+# requests reuse one pool of connections, see BigQuery.client
+_client = None
+_client_lock = threading.Lock()
+
+
+def shared_client(project):
+    """
+    The BigQuery client of this process, created on first use with project
+    as its default project.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from google.cloud import bigquery
+
+                _client = bigquery.Client(project=project)
+    return _client
+
+
+def _seconds(start, end) -> float:
+    """Seconds from start to end, 0 when either is unknown."""
+    import datetime
+
+    if isinstance(start, datetime.datetime) and isinstance(end, datetime.datetime):
+        return max((end - start).total_seconds(), 0.0)
+    return 0.0
+
 
 class BigQuery:
-    def __init__(self, gcp_project="dev-freg-3896"):
-        self.client = bigquery.Client(project=gcp_project)
+    # Queries run as jobs, which can be started with submit_pre_aggregated()
+    # and polled, see engine.py
+    query_jobs = True
+
+    def __init__(
+        self,
+        gcp_project="dev-freg-3896",
+        result_format="pandas",
+        storage_api_min_rows=None,
+        on_query: Callable = None,
+        on_estimate: Callable = None,
+        budget=None,
+    ):
         self.gcp_project = gcp_project
+        self.result_format = result_format
+        self.storage_api_min_rows = storage_api_min_rows
+        # Called with the QueryStats of every query job that completes
+        self.on_query = on_query
+        # Called with the estimated bytes of every query before it is run
+        self.on_estimate = on_estimate
+        # budget.ByteBudget charged the estimated bytes of every query
+        self.budget = budget
+        # Estimated bytes of the latest queries, see estimate_bytes()
+        self._estimates = collections.OrderedDict()
+        self._client = None
+
+    @property
+    def client(self):
+        """
+        The BigQuery client, created on first use and then shared by all
+        threads and projects, see shared_client(). Creating it looks up
+        credentials, which is slow, so it is kept out of application startup.
+        """
+        if self._client is None:
+            self._client = shared_client(self.gcp_project)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    def _query(self, query: str, job_config=None):
+        """
+        Description: Internal method for this class. Starts a query job in
+            self.gcp_project, whatever the default project of the client.
+            With a budget, the estimated bytes of the query are charged to
+            it first, raising budget.BudgetExceeded when over budget.
+            Without, a query is only estimated the first time its text is
+            run, for self.on_estimate.
+        Parameters: query string, and optionally a QueryJobConfig.
+        Returns: QueryJob.
+        """
+        if self.budget is not None:
+            self.budget.charge(self.estimate_bytes(query, job_config))
+        elif self.on_estimate is not None:
+            self.estimate_bytes(query, job_config, by_parameters=False)
+        return self.client.query(query, job_config=job_config, project=self.gcp_project)
+
+    def estimate_bytes(self, query: str, job_config=None, by_parameters=True) -> int:
+        """
+        Description
+        -----------
+        Estimate the bytes the query would process, with a dry run. The
+        estimate is kept per query text and, with by_parameters, values of
+        the query parameters in job_config, so a query is only dry run again
+        when either changes. Passed to self.on_estimate.
 
-    def _query_job_dataframe(self, query: str) -> pandas.DataFrame:
+        Return
+        ------
+        int: bytes processed, as if the query could not be read from cache.
+        """
+        key = (query, None)
+        if by_parameters and job_config is not None:
+            parameters = job_config.query_parameters
+            key = (query, repr([parameter.to_api_repr() for parameter in parameters]))
+        estimate = self._estimates.get(key)
+        if estimate is None:
+            from google.cloud import bigquery
+
+            dry_run = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+            if job_config is not None:
+                dry_run.query_parameters = job_config.query_parameters
+            job = self.client.query(query, job_config=dry_run, project=self.gcp_project)
+            estimate = int(job.total_bytes_processed or 0)
+            self._estimates[key] = estimate
+            # Queries with a watermark in them change on every run
+            while len(self._estimates) > ESTIMATES_KEPT:
+                self._estimates.popitem(last=False)
+        else:
+            self._estimates.move_to_end(key)
+
+        if self.on_estimate is not None:
+            self.on_estimate(estimate)
+        return estimate
+
+    def estimate_pre_aggregated(self, source: str) -> int:
+        """Estimate the bytes of the query for one of the sources in PRE_AGGREGATED."""
+        _, query = PRE_AGGREGATED[source]
+        return self.estimate_bytes(query.format(project=self.gcp_project))
+
+    def _query_job_dataframe(self, query: str, parameters=None) -> pandas.DataFrame:
         """
         Description: Internal method for this class.
-        Parameters: query string.
+        Parameters: query string, and optionally a list of query parameters.
         Returns: pandas dataframe.
         """
         logger.debug("Retrieving query and converting to dataframe.")
-        return (
-            self.client.query(query)
-            .result()
-            .to_dataframe(create_bqstorage_client=False)
+        job = self._query(query, _job_config(parameters))
+        rows = job.result()
+        start = time.perf_counter()
+        df = rows.to_dataframe(create_bqstorage_client=False)
+        self._query_done(job, rows, time.perf_counter() - start)
+        return df
+
+    def _query_job_result(self, query: str, parameters=None):
+        """
+        Description: Internal method for this class. Runs the query and
+            downloads the result, see download().
+        Parameters: query string, and optionally a list of query parameters.
+        Returns: pandas dataframe or pyarrow table.
+        """
+        return self.download(self._query(query, _job_config(parameters)))
+
+    def download(self, job):
+        """
+        Description
+        -----------
+        Wait for a query job to finish and download its result in
+        self.result_format. Results of at least self.storage_api_min_rows
+        rows are streamed with the BigQuery Storage Read API.
+
+        Return
+        ------
+        dataframe or pyarrow table.
+        """
+        logger.debug(f"Retrieving query as {self.result_format}.")
+        rows = job.result()
+        storage_api = (
+            self.storage_api_min_rows is not None
+            and (rows.total_rows or 0) >= self.storage_api_min_rows
+            and _storage_api_installed()
         )
+        start = time.perf_counter()
+        if self.result_format == "arrow":
+            result = rows.to_arrow(create_bqstorage_client=storage_api)
+        else:
+            result = rows.to_dataframe(create_bqstorage_client=storage_api)
+        self._query_done(job, rows, time.perf_counter() - start)
+        return result
 
-    def pre_aggregate_total_and_uniques(self) -> pandas.DataFrame:
-        query = f"""
-            SELECT datasett, tabell, variabel, totalt, distinkte
-            FROM `{self.gcp_project}.kvalitet.metrics_count_total_and_distinct`
+    def _query_column_chunks(self, query: str, chunk_size: int):
         """
-        df = self._query_job_dataframe(query)
-        return df
+        Description: Internal method for this class. Runs a query returning
+            a single column and yields its values one page at a time.
+        Parameters: query string, and the number of rows per page.
+        Returns: iterator of lists.
+        """
+        logger.debug(f"Retrieving query in pages of {chunk_size} rows.")
+        job = self._query(query)
+        rows = job.result(page_size=chunk_size)
+        download_seconds = 0.0
+        pages = iter(rows.pages)
+        while True:
+            # Only the time waiting for the next page counts as download
+            start = time.perf_counter()
+            page = next(pages, None)
+            download_seconds += time.perf_counter() - start
+            if page is None:
+                break
+            yield [row[0] for row in page]
+        self._query_done(job, rows, download_seconds)
+
+    def _query_pages(self, query: str, parameters=None, page_size=None):
+        """
+        Description: Internal method for this class. Runs a query and yields
+            its result one page at a time, so that only one page is held in
+            memory, and the bytes of the largest page go in its QueryStats.
+        Parameters: query string, optionally a list of query parameters, and
+            the number of rows per page (the default of the API if None).
+        Returns: iterator of pandas dataframes.
+        """
+        logger.debug(f"Retrieving query in pages of {page_size} rows.")
+        job = self._query(query, _job_config(parameters))
+        rows = job.result(page_size=page_size)
+        download_seconds = 0.0
+        peak_page_bytes = 0
+        pages = iter(rows.to_dataframe_iterable())
+        while True:
+            # Only the time waiting for the next page counts as download
+            start = time.perf_counter()
+            page = next(pages, None)
+            download_seconds += time.perf_counter() - start
+            if page is None:
+                break
+            page_bytes = int(page.memory_usage(deep=True).sum())
+            peak_page_bytes = max(peak_page_bytes, page_bytes)
+            yield page
+        self._query_done(job, rows, download_seconds, peak_page_bytes)
+
+    def _query_done(
+        self, job, rows, download_seconds: float, peak_page_bytes=0
+    ) -> None:
+        """
+        Description: Internal method for this class. Pass the QueryStats of
+            a completed query job to self.on_query.
+        Parameters: the QueryJob, its RowIterator, the seconds spent
+            downloading the result and the bytes of its largest page, if
+            read page by page.
+        """
+        if self.on_query is None:
+            return None
+        stats = QueryStats(
+            queue_seconds=_seconds(job.created, job.started),
+            execution_seconds=_seconds(job.started, job.ended),
+            download_seconds=download_seconds,
+            bytes_processed=int(job.total_bytes_processed or 0),
+            bytes_billed=int(job.total_bytes_billed or 0),
+            slot_millis=int(job.slot_millis or 0),
+            rows=int(rows.total_rows or 0),
+            cache_hit=bool(job.cache_hit),
+            peak_page_bytes=peak_page_bytes,
+        )
+        try:
+            self.on_query(stats)
+        except Exception:
+            # Statistics are never worth failing a refresh for
+            logger.exception("Could not record the statistics of a query job.")
+        return None
+
+    def table_fingerprint(self, database, table) -> tuple:
+        """
+        Description
+        -----------
+        Read the metadata of a table, without running a query. The result
+        changes whenever the table is written to.
+
+        Return
+        ------
+        tuple: (last modified time, number of rows)
+        """
+        metadata = self.client.get_table(f"{self.gcp_project}.{database}.{table}")
+        return (metadata.modified, metadata.num_rows)
+
+    def pre_aggregated(self, source: str) -> pandas.DataFrame:
+        """
+        Description
+        -----------
+        Run the query for one of the sources in PRE_AGGREGATED.
+
+        Return
+        ------
+        dataframe or pyarrow table (see result_format): the columns listed
+        for the source.
+        """
+        _, query = PRE_AGGREGATED[source]
+        return self._query_job_result(query.format(project=self.gcp_project))
+
+    def submit_pre_aggregated(self, source: str):
+        """
+        Description
+        -----------
+        Start the query for one of the sources in PRE_AGGREGATED without
+        waiting for it. Its state is refreshed with job.reload(), and
+        download(job) gives the same result as pre_aggregated(source).
+
+        Return
+        ------
+        google.cloud.bigquery.QueryJob
+        """
+        _, query = PRE_AGGREGATED[source]
+        return self._query(query.format(project=self.gcp_project))
+
+    def pre_aggregated_batch(self, sources) -> dict:
+        """
+        Description
+        -----------
+        Read several sources in PRE_AGGREGATED with a single query job. The
+        queries are combined with UNION ALL into one result, where the column
+        'kilde' tells which source a row came from. Columns not returned by a
+        source are NULL in its rows.
+
+        Return
+        ------
+        dict: keys - source name,
+              values - dataframe or pyarrow table with the columns listed
+                       for the source.
+        """
+        branches = []
+        for source in sources:
+            columns, query = PRE_AGGREGATED[source]
+            select = ", ".join(
+                f"CAST({column if column in columns else 'NULL'} AS {type_}) AS {column}"
+                for column, type_ in BATCH_COLUMNS.items()
+            )
+            branches.append(
+                f"SELECT '{source}' AS kilde, {select} "
+                f"FROM ({query.format(project=self.gcp_project)})"
+            )
+        df = self._query_job_result("\nUNION ALL\n".join(branches))
+
+        result = {}
+        for source in sources:
+            columns, _ = PRE_AGGREGATED[source]
+            result[source] = results.select(df, "kilde", source, columns)
+        return result
+
+    def pre_aggregate_total_and_uniques(self) -> pandas.DataFrame:
+        return self.pre_aggregated("total_and_distinct")
 
     def count_total_and_uniques(self, database, table, column) -> dict:
         """
@@ -60,23 +553,93 @@ class BigQuery:
 
         return result
 
-    def pre_aggregated_number_of_citizenships(self) -> pandas.DataFrame:
-        query = f"""
-            SELECT datasett, gruppe, antall
-            FROM `{self.gcp_project}.kvalitet.metrics_antall_statsborgerskap`
+    def count_rows_from_metadata(self, database, table) -> float:
         """
-        df = self._query_job_dataframe(query)
-        return df
+        Description
+        -----------
+        The number of rows of a table, read from its metadata without running
+        a query. Unlike the total of count_total_and_uniques, rows with NULL
+        in the column are counted too.
+        """
+        return float(self.table_fingerprint(database, table)[1])
 
-    def pre_aggregated_valid_fnr(self) -> pandas.DataFrame:
+    def count_total_and_uniques_approx(
+        self, database, table, column, partition_column, watermark=None, sketch=None
+    ) -> dict:
+        """
+        Description
+        -----------
+        Count the rows for a column like count_total_and_uniques, with the
+        unique number of rows estimated from a HyperLogLog++ sketch. Only the
+        rows with partition_column after watermark are read, and their sketch
+        is merged with the sketch from the last count. This requires a table
+        that is only appended to, with a partition_column that only
+        increases, e.g. an ingestion time: rows added later with the value of
+        watermark are missed, so an ingestion date only works with one load
+        a day. Without a watermark and sketch, the whole table is read.
+
+        Return
+        ------
+        dict: {
+            'total': int (count of the new rows only),
+            'unique': int (estimated count, all rows),
+            'sketch': bytes (sketch of all rows, to pass on to the next count),
+            'watermark': the latest value of partition_column
+        }
+        """
+        import datetime
+
+        from google.cloud import bigquery
+
+        condition = ""
+        parameters = [bigquery.ScalarQueryParameter("sketch", "BYTES", sketch)]
+        if type(watermark) is datetime.date:
+            logger.warning(
+                f"{database}.{table}.{partition_column} is a date, rows loaded "
+                f"later on {watermark} are not counted."
+            )
+        if watermark is not None:
+            condition = f"WHERE {partition_column} > @watermark"
+            parameters.append(_watermark_parameter(watermark))
         query = f"""
-            SELECT datasett, tabell, variabel,
-                fnr_total_count, fnr_invalid_format, fnr_invalid_first_digit, fnr_invalid_date, fnr_invalid_control,
-                dnr_total_count, dnr_invalid_format, dnr_invalid_first_digit, dnr_invalid_date, dnr_invalid_control
-            FROM `{self.gcp_project}.kvalitet.metrics_count_valid_fnr_dnr`
+            WITH new_rows AS (
+                SELECT
+                    COUNT({column}) AS total,
+                    HLL_COUNT.INIT({column}, {HLL_PRECISION}) AS sketch,
+                    MAX({partition_column}) AS watermark
+                FROM `{self.gcp_project}.{database}.{table}`
+                {condition}
+            ),
+            merged AS (
+                SELECT HLL_COUNT.MERGE_PARTIAL(sketch) AS sketch
+                FROM (
+                    SELECT sketch FROM new_rows
+                    UNION ALL
+                    SELECT @sketch AS sketch
+                )
+            )
+            SELECT
+                new_rows.total,
+                IFNULL(HLL_COUNT.EXTRACT(merged.sketch), 0) AS unique,
+                merged.sketch,
+                new_rows.watermark
+            FROM new_rows, merged
         """
-        df = self._query_job_dataframe(query)
-        return df
+        df = self._query_job_dataframe(query, parameters)
+        result = {
+            "total": float(df.total[0]),
+            "unique": float(df.unique[0]),
+            "sketch": df.sketch[0],
+            # No new rows, so the watermark stays where it was
+            "watermark": watermark if df.watermark.isna()[0] else df.watermark[0],
+        }
+        return result
+
+    def pre_aggregated_number_of_citizenships(self) -> pandas.DataFrame:
+        return self.pre_aggregated("number_of_citizenships")
+
+    def pre_aggregated_valid_fnr(self) -> pandas.DataFrame:
+        return self.pre_aggregated("valid_fnr")
 
     def pre_aggregated_count_group_by(self) -> pandas.DataFrame:
         """
@@ -84,15 +647,9 @@ class BigQuery:
 
         Return: dataframe
         """
+        return self.pre_aggregated("count_group_by")
 
-        query = f"""
-        SELECT datasett, tabell, variabel, gruppe, antall
-        FROM `{self.gcp_project}.kvalitet.metrics_count_group_by`
-        """
-        df = self._query_job_dataframe(query)
-        return df
-
-    def group_by_and_count(self, database, table, column) -> dict:
+    def group_by_and_count(self, database, table, column, page_size=None) -> dict:
         """
         Description
         -----------
@@ -101,12 +658,30 @@ class BigQuery:
         on gyldighetstidspunkt.
         * Group by 'column'.
         * Count no. of rows per column group.
+        The result is read page_size groups at a time, see
+        group_by_and_count_pages() to not hold all of it.
 
         Return
         ------
         dict: keys - each value,
               values - int, occurence of the value.
         """
+        result = {}
+        for page in self.group_by_and_count_pages(database, table, column, page_size):
+            result.update(zip(page.key.tolist(), page.occurence.tolist()))
+        return result
+
+    def group_by_and_count_pages(self, database, table, column, page_size=None):
+        """
+        Description
+        -----------
+        Same as group_by_and_count, read page_size groups at a time, from
+        the largest count to the smallest.
+
+        Return
+        ------
+        iterator of dataframes: key, occurence.
+        """
         query = f"""
             WITH ordered_records_per_person AS (
                 SELECT t.*, ROW_NUMBER() OVER (
@@ -121,20 +696,108 @@ class BigQuery:
             FROM ordered_records_per_person
             WHERE row_number = 1
             GROUP BY {column}
+            ORDER BY occurence DESC
         """
-        df = self._query_job_dataframe(query)
-        result = {}
-        for i, row in df.iterrows():
-            result[row.key] = row.occurence
-        return result
+        return self._query_pages(query, page_size=page_size)
 
-    def pre_aggregated_latest_timestamp(self) -> pandas.DataFrame:
+    def _latest_records_query(
+        self, database, table, column, watermark_column, watermark
+    ) -> tuple:
+        """
+        Description: Internal method for this class. The query of
+            latest_records_since().
+        Returns: (query string, list of query parameters).
+        """
+        # QUALIFY needs a WHERE, GROUP BY or HAVING clause in BigQuery
+        condition = "WHERE TRUE"
+        parameters = []
+        if watermark is not None:
+            condition = f"WHERE {watermark_column} > @watermark"
+            parameters.append(_watermark_parameter(watermark))
         query = f"""
-            SELECT datasett, tabell, variabel, latest_timestamp
-            FROM `{self.gcp_project}.kvalitet.metrics_latest_timestamp`
+            SELECT
+                folkeregisteridentifikator AS ident,
+                gyldighetstidspunkt,
+                {column} AS value,
+                MAX({watermark_column}) OVER () AS watermark
+            FROM `{self.gcp_project}.{database}.{table}`
+            {condition}
+            QUALIFY ROW_NUMBER() OVER (
+                PARTITION BY folkeregisteridentifikator
+                ORDER BY gyldighetstidspunkt DESC
+            ) = 1
         """
-        df = self._query_job_dataframe(query)
-        return df
+        return query, parameters
+
+    def latest_records_since(
+        self, database, table, column, watermark_column, watermark=None
+    ) -> pandas.DataFrame:
+        """
+        Description
+        -----------
+        The latest record (by gyldighetstidspunkt) of every person among the
+        rows with watermark_column after watermark, i.e. the rows added since
+        the last call, with the value of column. Merged into
+        incremental.LatestRecords, this gives the counts of
+        group_by_and_count while only reading the new rows. Without a
+        watermark, the whole table is read.
+
+        Return
+        ------
+        dataframe: ident, gyldighetstidspunkt, value and watermark (the
+        latest value of watermark_column), one row per person.
+        """
+        return self._query_job_dataframe(
+            *self._latest_records_query(
+                database, table, column, watermark_column, watermark
+            )
+        )
+
+    def latest_records_since_pages(
+        self, database, table, column, watermark_column, watermark=None, page_size=None
+    ):
+        """
+        Description
+        -----------
+        Same as latest_records_since, read page_size persons at a time.
+
+        Return
+        ------
+        iterator of dataframes, with the columns of latest_records_since.
+        """
+        query, parameters = self._latest_records_query(
+            database, table, column, watermark_column, watermark
+        )
+        return self._query_pages(query, parameters, page_size)
+
+    def valid_and_invalid_idents(
+        self, database, table, column, chunk_size=1_000_000
+    ) -> pandas.DataFrame:
+        """
+        Description
+        -----------
+        Check the fnr and dnr in a column in Python (see idents), reading
+        the column in chunks of chunk_size rows. Gives the counts of
+        kvalitet.metrics_count_valid_fnr_dnr for tables it does not cover.
+
+        Return
+        ------
+        dataframe: the columns of the valid_fnr source in PRE_AGGREGATED,
+        one row.
+        """
+        import pandas
+
+        query = f"""
+            SELECT {column}
+            FROM `{self.gcp_project}.{database}.{table}`
+        """
+        counts = idents.count_chunks(self._query_column_chunks(query, chunk_size))
+        return pandas.DataFrame(
+            [{"datasett": database, "tabell": table, "variabel": column, **counts}]
+        )
+
+    def pre_aggregated_latest_timestamp(self) -> pandas.DataFrame:
+        return self.pre_aggregated("latest_timestamp")
 
     def latest_timestamp_from_string(
         self, database, table, column, parse_format
@@ -183,13 +846,8 @@ class BigQuery:
         -----------
         Get the latest (max) timestamp for when DSF_SITUASJONSUTTAK was run
         """
-        query = f"""
-            select FORMAT_TIMESTAMP("%d-%m-%Y %H:%M:%S", max(tidspunkt)) as latest_timestamp
-                from `{self.gcp_project}.kvalitet.qa_nullvalue_columns`
-                where datasett='klargjort' and tabell='dsf_situasjonsuttak'
-        """
-        df = self._query_job_dataframe(query)
-        result = {"timestamp": df["latest_timestamp"][0]}
+        df = self.pre_aggregated("dsfsit_latest_timestamp")
+        result = {"timestamp": results.values(df, "latest_timestamp")[0]}
         return result
 
     def dsfsit_qa_nullvals_latest(self) -> pandas.DataFrame:
@@ -199,26 +857,43 @@ class BigQuery:
         Gets quality-info on which vairables in dsf_situasjonsuttak that contains
         missing values, how many rows, and the percentage.
         """
+        return self.pre_aggregated("dsfsit_qa_nullvals_latest")
+
+    def dsfsit_qa_nullvals_since(self, watermark=None):
+        """
+        Description
+        -----------
+        Get the rows of qa_nullvalue_columns for dsf_situasjonsuttak with a
+        tidspunkt after watermark, to keep an incremental.NullvalueHistory up
+        to date. Without a watermark, the two latest rows per column are
+        returned, which is all the history needs to start from.
+
+        Return
+        ------
+        dataframe or pyarrow table: tidspunkt, kolonne, ant_nullvals, pct_nullvals
+        """
+        parameters = []
+        if watermark is None:
+            condition = """
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY kolonne ORDER BY tidspunkt DESC) <= 2
+            """
+        else:
+            import datetime
+
+            # tidspunkt is a TIMESTAMP, and a naive watermark is in UTC
+            if watermark.tzinfo is None:
+                watermark = watermark.replace(tzinfo=datetime.timezone.utc)
+            condition = """
+                and tidspunkt > @watermark
+            """
+            parameters.append(_watermark_parameter(watermark))
         query = f"""
-            with ranked_values as
-            (
-              select tidspunkt, kolonne, ant_nullvals, pct_nullvals,
-              ROW_NUMBER() OVER (PARTITION BY datasett, tabell, kolonne order by tidspunkt desc) as rank
-              from `kvalitet.qa_nullvalue_columns`
-              where datasett='klargjort' and tabell='dsf_situasjonsuttak'
-            ),
-            max_dato as
-            (
-              select cast(max(tidspunkt) AS DATE) as dato
-              from ranked_values
-            )
-            select kolonne, ant_nullvals, pct_nullvals
-            from ranked_values a, max_dato d
-            where a.rank=1
-            and tidspunkt > d.dato  -- This makes sure we only get variables from the latest run
+            select tidspunkt, kolonne, ant_nullvals, pct_nullvals
+            from `{self.gcp_project}.kvalitet.qa_nullvalue_columns`
+            where datasett='klargjort' and tabell='dsf_situasjonsuttak'
+            {condition}
         """
-        df = self._query_job_dataframe(query)
-        return df
+        return self._query_job_result(query, parameters)
 
     def dsfsit_qa_nullvals_diff(self) -> pandas.DataFrame:
         """
@@ -228,29 +903,61 @@ class BigQuery:
         or a drop in number of missing values.
         Has a filter of at least 0.1 difference
         """
-        query = f"""
-            with differanser as
-            (
-              select tidspunkt, kolonne, ant_nullvals, pct_nullvals,
-              IFNULL((pct_nullvals - LAG(pct_nullvals) OVER (PARTITION BY kolonne ORDER BY tidspunkt)), pct_nullvals) as pct_diff
-              from `kvalitet.qa_nullvalue_columns`
-              where datasett='klargjort' and tabell='dsf_situasjonsuttak'
-            ), ranked_nyeste as
-            (
-              SELECT *, ROW_NUMBER() OVER (PARTITION BY kolonne ORDER BY tidspunkt desc) as ranked
-              from differanser
-            ),
-            max_dato as
-            (
-              select cast(max(tidspunkt) AS DATE) as dato
-              from differanser
-            )
-            select d.dato, kolonne, ant_nullvals, pct_nullvals, round(pct_diff,2) as pct_diff_last
-            from ranked_nyeste, max_dato d where ranked=1 and tidspunkt > d.dato
-            and (pct_diff >= 0.1 or pct_diff <= -0.1)
-        """
-        df = self._query_job_dataframe(query)
-        return df
+        return self.pre_aggregated("dsfsit_qa_nullvals_diff")
+
+
+@functools.lru_cache(maxsize=None)
+def _storage_api_installed() -> bool:
+    """Whether the client of the Storage Read API (the storage extra) is installed."""
+    import importlib.util
+
+    if importlib.util.find_spec("google.cloud.bigquery_storage") is None:
+        logger.warning(
+            "STORAGE_API_MIN_ROWS is set, but google-cloud-bigquery-storage is "
+            "not installed, so results are downloaded with the REST API."
+        )
+        return False
+    return True
+
+
+def _job_config(parameters):
+    """The QueryJobConfig of a query with parameters, None without."""
+    if not parameters:
+        return None
+    from google.cloud import bigquery
+
+    return bigquery.QueryJobConfig(query_parameters=parameters)
+
+
+def _watermark_parameter(watermark):
+    """The @watermark query parameter, with the BigQuery type of watermark."""
+    import numbers
+
+    from google.cloud import bigquery
+
+    # numpy scalars, e.g. a watermark read back from a dataframe, as the
+    # Python values the client knows how to pass
+    if isinstance(watermark, numbers.Number) and hasattr(watermark, "item"):
+        watermark = watermark.item()
+    return bigquery.ScalarQueryParameter(
+        "watermark", _parameter_type(watermark), watermark
+    )
+
+
+def _parameter_type(value) -> str:
+    """The BigQuery type of a query parameter holding a watermark value."""
+    import datetime
+    import numbers
+
+    if isinstance(value, datetime.datetime):
+        return "TIMESTAMP" if value.tzinfo is not None else "DATETIME"
+    if isinstance(value, datetime.date):
+        return "DATE"
+    if isinstance(value, numbers.Integral):
+        return "INT64"
+    if isinstance(value, numbers.Real):
+        return "FLOAT64"
+    return "STRING"
 
 
 if __name__ == "__main__":
@@ -0,0 +1,69 @@
+"""
+Budgets for the bytes processed by the queries of the app, per cycle (a
+window of BUDGET_CYCLE_MINUTES) and per UTC day. A query is charged the
+bytes estimated with a dry run before it is submitted, see
+bigquery.BigQuery.estimate_bytes(). A query that would exceed a budget is
+not submitted, and the job running it is postponed or downgraded instead,
+see metrics.run_job().
+"""
+import datetime
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+logger.debug("Logging is configured.")
+
+
+# The outcome of a refresh postponed since its query would exceed a byte
+# budget, which leaves the interval of the job as it is, see
+# intervals.JobInterval.record()
+POSTPONED = "postponed"
+
+
+class BudgetExceeded(Exception):
+    """A query was not submitted, since it would exceed a byte budget."""
+
+
+class ByteBudget:
+    """
+    At most per_cycle bytes per window of cycle_seconds, and per_day bytes
+    per UTC day. None is no limit.
+    """
+
+    def __init__(self, per_cycle=None, per_day=None, cycle_seconds=300.0):
+        self.per_cycle = per_cycle
+        self.per_day = per_day
+        self.cycle_seconds = cycle_seconds
+        # (window, bytes charged in it) for the cycle and the day
+        self._cycle = (None, 0)
+        self._day = (None, 0)
+        self._lock = threading.Lock()
+
+    def charge(self, estimate: int) -> None:
+        """
+        Description
+        -----------
+        Charge estimate bytes to the budgets of the current cycle and day,
+        or raise BudgetExceeded, charging nothing, if either would be
+        exceeded.
+        """
+        now = time.time()
+        cycle = int(now // self.cycle_seconds)
+        day = datetime.datetime.fromtimestamp(now, datetime.timezone.utc).date()
+        with self._lock:
+            cycle_spent = self._cycle[1] if self._cycle[0] == cycle else 0
+            day_spent = self._day[1] if self._day[0] == day else 0
+            for window, spent, limit in [
+                ("cycle", cycle_spent, self.per_cycle),
+                ("day", day_spent, self.per_day),
+            ]:
+                if limit is not None and spent + estimate > limit:
+                    raise BudgetExceeded(
+                        f"{estimate} bytes would exceed the budget of the {window}, "
+                        f"{spent} of {limit} bytes spent."
+                    )
+            self._cycle = (cycle, cycle_spent + estimate)
+            self._day = (day, day_spent + estimate)
+        return None
@@ -5,7 +5,150 @@ import os
 MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
 METRIC_PREFIX = "freg_"
 GCP_PROJECT = os.environ.get("GCP_PROJECT", "dev-freg-3896")
+# The projects to compute the metrics of, as "project,...". All metrics get
+# a project label, and the queries of every project share one client and the
+# job concurrency limit. Defaults to GCP_PROJECT alone.
+GCP_PROJECTS = [
+    project.strip()
+    for project in os.environ.get("GCP_PROJECTS", GCP_PROJECT).split(",")
+    if project.strip()
+]
 INTERVAL_MINUTES = os.environ.get("INTERVAL_MINUTES", "5")
+# Base interval of a job, overriding INTERVAL_MINUTES, as "job=minutes,...".
+# Intervals adapt by INTERVAL_GROWTH per refresh (1 keeps them fixed) and
+# back off after failures, up to MAX_INTERVAL_MINUTES, and vary by a random
+# fraction of up to INTERVAL_JITTER. See intervals.py.
+JOB_INTERVALS = {
+    name.strip(): float(minutes)
+    for name, minutes in (
+        item.split("=")
+        for item in os.environ.get("JOB_INTERVALS", "").split(",")
+        if item.strip()
+    )
+}
+INTERVAL_GROWTH = float(os.environ.get("INTERVAL_GROWTH", "1.5"))
+MAX_INTERVAL_MINUTES = float(os.environ.get("MAX_INTERVAL_MINUTES", "60"))
+INTERVAL_JITTER = float(os.environ.get("INTERVAL_JITTER", "0.1"))
+# Where the metrics are computed: "bigquery", or "local" to run the same
+# queries with DuckDB over Parquet exports of the tables in LOCAL_DATA_DIR,
+# laid out as <database>/<table>.parquet or <database>/<table>/*.parquet, in
+# a directory <project>/ per project when there are several GCP_PROJECTS
+BACKEND = os.environ.get("BACKEND", "bigquery")
+LOCAL_DATA_DIR = os.environ.get("LOCAL_DATA_DIR", "data")
+# Read all pre-aggregated tables with one query job per refresh cycle
+BATCH_REFRESH = os.environ.get("BATCH_REFRESH", "false").lower() == "true"
+# How the jobs are run: "scheduler" runs each job in a thread of an
+# APScheduler BackgroundScheduler, "asyncio" starts the queries of all jobs
+# from one event loop and polls them, see engine.py
+REFRESH_ENGINE = os.environ.get("REFRESH_ENGINE", "scheduler")
+# Seconds between polls of the state of a running query job with asyncio
+POLL_SECONDS = float(os.environ.get("POLL_SECONDS", "1"))
+# Directory shared by the app processes of a host, e.g. uwsgi workers, to
+# elect the one process running the jobs. The others serve the snapshots of
+# its metrics. Unset to run the jobs in every process. See coordination.py.
+COORDINATION_DIR = os.environ.get("COORDINATION_DIR")
+# Seconds between the attempts of a follower to take over as leader
+LEADER_RETRY_SECONDS = float(os.environ.get("LEADER_RETRY_SECONDS", "10"))
+# Max number of jobs (and so BigQuery queries) running at the same time, or
+# threads for the calls to BigQuery with asyncio, and the delay between the
+# first runs of consecutive jobs
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "4"))
+# Max number of query jobs running in BigQuery at the same time with asyncio,
+# which only holds one of the MAX_CONCURRENT_JOBS threads for each call to the
+# BigQuery API, not while a query runs
+MAX_INFLIGHT_QUERIES = int(os.environ.get("MAX_INFLIGHT_QUERIES", "16"))
+STAGGER_SECONDS = int(os.environ.get("STAGGER_SECONDS", "5"))
+# Max bytes the queries may process per cycle of BUDGET_CYCLE_MINUTES
+# (INTERVAL_MINUTES by default) and per UTC day, as estimated with dry runs.
+# Jobs over budget are postponed, or downgraded to a cheaper variant where
+# they have one. Unset for no limit. See budget.py.
+BYTES_PER_CYCLE = os.environ.get("BYTES_PER_CYCLE")
+if BYTES_PER_CYCLE is not None:
+    BYTES_PER_CYCLE = int(BYTES_PER_CYCLE)
+BYTES_PER_DAY = os.environ.get("BYTES_PER_DAY")
+if BYTES_PER_DAY is not None:
+    BYTES_PER_DAY = int(BYTES_PER_DAY)
+BUDGET_CYCLE_MINUTES = float(os.environ.get("BUDGET_CYCLE_MINUTES", INTERVAL_MINUTES))
+# Max seconds since the last refresh of a job before a scrape of /metrics
+# triggers a new one, waiting up to SCRAPE_WAIT_SECONDS for it before serving
+# the metrics. Unset to only refresh on schedule. See ondemand.py. The wait is
+# also kept within the scrape timeout Prometheus sends with each scrape, as
+# the X-Prometheus-Scrape-Timeout-Seconds header (10 s by default).
+MAX_STALENESS_SECONDS = os.environ.get("MAX_STALENESS_SECONDS")
+if MAX_STALENESS_SECONDS is not None:
+    MAX_STALENESS_SECONDS = float(MAX_STALENESS_SECONDS)
+SCRAPE_WAIT_SECONDS = float(os.environ.get("SCRAPE_WAIT_SECONDS", "5"))
+# Skip a job when the metadata of its source table shows no change since its
+# last run. Only works for tables, the metadata of a view does not change
+# with the data it reads.
+CHANGE_DETECTION = os.environ.get("CHANGE_DETECTION", "true").lower() == "true"
+# Query results of the scheduled jobs as "pandas" dataframes or "arrow" tables
+RESULT_FORMAT = os.environ.get("RESULT_FORMAT", "pandas")
+# Download results of at least this many rows with the BigQuery Storage Read
+# API instead of the REST API. Unset to always use the REST API. Needs the
+# storage extra (google-cloud-bigquery-storage).
+STORAGE_API_MIN_ROWS = os.environ.get("STORAGE_API_MIN_ROWS")
+if STORAGE_API_MIN_ROWS is not None:
+    STORAGE_API_MIN_ROWS = int(STORAGE_API_MIN_ROWS)
+# Remove label series that a job has not written in this many of its
+# refreshes, e.g. a group no longer in the source table. 0 keeps them forever.
+EVICT_AFTER_CYCLES = int(os.environ.get("EVICT_AFTER_CYCLES", "3"))
+# SQLite file with the last good result of each job, loaded at startup so a
+# restarted app serves the last known values. Unset to not save results.
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH")
+# Keep the history of kvalitet.qa_nullvalue_columns in memory and only fetch
+# new rows, instead of running the dsfsit_* queries over the whole table
+INCREMENTAL_NULLVALS = os.environ.get("INCREMENTAL_NULLVALS", "false").lower() == "true"
+# Columns to count the total and unique number of rows of, in
+# freg_counted_total_rows and freg_counted_unique_rows, as
+# "database.table.column=mode,..." where mode is "exact" (COUNT DISTINCT over
+# the whole table) or "approx:<watermark column>" (HyperLogLog++ sketch,
+# merging in only the rows with a watermark column after the last count).
+# The watermark column must be an ingestion time that only increases, with
+# every load getting a later value than all rows before it. Rows added with
+# the value of the last count, e.g. a second load into the same ingestion
+# date partition, are never counted.
+DISTINCT_COUNTS = {
+    tuple(column.strip().split(".")): tuple(mode.strip().split(":") + [None])[:2]
+    for column, mode in (
+        item.split("=")
+        for item in os.environ.get("DISTINCT_COUNTS", "").split(",")
+        if item.strip()
+    )
+}
+# Columns to count the latest record of every person by, in
+# freg_latest_group_by, kept up to date from the rows added since the last
+# refresh, as "database.table.column[=watermark column],..."
+# The watermark column tells which rows are new, and defaults to
+# gyldighetstidspunkt, which only works if records are loaded in that order;
+# use an ingestion time column otherwise.
+GROUP_BY_COUNTS = {
+    tuple(column.strip().split(".")): (watermark or "gyldighetstidspunkt").strip()
+    for column, watermark in (
+        (item.split("=") + [None])[:2]
+        for item in os.environ.get("GROUP_BY_COUNTS", "").split(",")
+        if item.strip()
+    )
+}
+# Rows per page when reading the results that grow with the size of a table
+# (group_by_counts and group_by_and_count) page by page, applying each page
+# before the next is read, so that memory stays bounded. Unset to read
+# group_by_counts whole, and group_by_and_count in pages of the API default.
+STREAM_PAGE_SIZE = os.environ.get("STREAM_PAGE_SIZE")
+if STREAM_PAGE_SIZE is not None:
+    STREAM_PAGE_SIZE = int(STREAM_PAGE_SIZE)
+# Max number of values of the folded label (e.g. group of freg_group_by) per
+# metric family and refresh. Values past the limit are summed into "other".
+# CARDINALITY_LIMITS overrides the limit per family, as "family=limit,...".
+CARDINALITY_LIMIT = int(os.environ.get("CARDINALITY_LIMIT", "1000"))
+CARDINALITY_LIMITS = {
+    family.strip(): int(limit)
+    for family, limit in (
+        item.split("=")
+        for item in os.environ.get("CARDINALITY_LIMITS", "").split(",")
+        if item.strip()
+    )
+}
 
 
 def configure_logging():
@@ -0,0 +1,102 @@
+"""
+Coordination of the app processes of one host, e.g. the workers of uwsgi,
+so that only one of them runs the jobs. The leader is the process holding
+an exclusive lock on a file in COORDINATION_DIR. It shares every snapshot
+of its metrics, once it has loaded them, in a file next to it, which the
+other processes (the followers) serve on /metrics, so that every process
+serves the same values. A follower tries to take the lock every
+LEADER_RETRY_SECONDS, and takes over when the leader exits.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+from . import exposition
+from .config import LEADER_RETRY_SECONDS
+
+
+logger = logging.getLogger(__name__)
+logger.debug("Logging is configured.")
+
+
+class Leadership:
+    """
+    An exclusive lock on the file path, held by at most one process at a
+    time until it releases it or exits.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._file is not None
+
+    def try_acquire(self) -> bool:
+        """Take the lock if no other process holds it. Return whether it is held."""
+        import fcntl
+
+        if self._file is not None:
+            return True
+        file = open(self.path, "a")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return False
+        self._file = file
+        return True
+
+    def release(self) -> None:
+        """Release the lock, if held."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return None
+
+
+def elect(
+    directory,
+    on_elected: Callable,
+    retry_seconds=LEADER_RETRY_SECONDS,
+    collector=exposition.COLLECTOR,
+) -> Leadership:
+    """
+    Description
+    -----------
+    Elect the leader among the processes sharing directory. When this
+    process is elected, now or after the leader exits, on_elected() is
+    called to start the jobs, and its snapshots are shared once it has
+    loaded metrics. Until then, collector serves the snapshots of the
+    leader.
+
+    Return
+    ------
+    Leadership: the lock of this process.
+    """
+    os.makedirs(directory, exist_ok=True)
+    leadership = Leadership(os.path.join(directory, "leader.lock"))
+    snapshot_path = os.path.join(directory, "snapshot")
+
+    def lead():
+        logger.info(f"Process {os.getpid()} is the leader, running the jobs.")
+        collector.share(snapshot_path)
+        on_elected()
+
+    if leadership.try_acquire():
+        lead()
+        return leadership
+
+    logger.info(f"Process {os.getpid()} follows the leader, serving its metrics.")
+    collector.follow(snapshot_path)
+
+    def retry():
+        while not leadership.try_acquire():
+            time.sleep(retry_seconds)
+        lead()
+
+    threading.Thread(target=retry, name="leader-election", daemon=True).start()
+    return leadership
@@ -0,0 +1,224 @@
+"""
+Refresh engine running all jobs from one asyncio event loop, as an
+alternative to the BackgroundScheduler in scheduler.py (see
+config.REFRESH_ENGINE). The queries of due jobs are started as soon as one
+of MAX_INFLIGHT_QUERIES slots is free, and their state is polled without
+holding a thread while BigQuery runs them. Threads from a small pool of
+MAX_CONCURRENT_JOBS are only used for the calls to the BigQuery API, the
+download of results and the setting of metrics.
+"""
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+import logging
+import threading
+
+from . import budget, metrics, ondemand
+from .config import (
+    GCP_PROJECTS,
+    MAX_CONCURRENT_JOBS,
+    MAX_INFLIGHT_QUERIES,
+    POLL_SECONDS,
+    STAGGER_SECONDS,
+)
+from .intervals import JobInterval
+
+
+logger = logging.getLogger(__name__)
+logger.debug("Logging is configured.")
+
+
+class RefreshEngine:
+    """
+    Refreshes the jobs in names of every project in projects, each at its
+    own interval (see intervals.py) starting from interval_minutes, in an
+    event loop running in a thread of its own. At most max_inflight jobs run
+    at the same time, over all projects, with the blocking calls of all of
+    them in a pool of max_workers threads. With batch, the pre-aggregated jobs
+    of a project are read with one query per refresh, like
+    metrics.preagg_batch().
+    """
+
+    def __init__(
+        self,
+        names,
+        interval_minutes: float,
+        batch=False,
+        poll_seconds=POLL_SECONDS,
+        max_workers=MAX_CONCURRENT_JOBS,
+        max_inflight=MAX_INFLIGHT_QUERIES,
+        projects=GCP_PROJECTS,
+    ):
+        self.poll_seconds = poll_seconds
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix="refresh"
+        )
+        self.loop = asyncio.new_event_loop()
+        self._stopped = asyncio.Event()
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._thread = None
+
+        # The refreshes to run, as (JobInterval, function returning the
+        # coroutine of one refresh)
+        self.refreshes = []
+        for project in projects:
+            if batch:
+                self.refreshes.append(
+                    (
+                        JobInterval("preagg_batch", project, interval_minutes),
+                        functools.partial(
+                            self._in_thread, metrics.preagg_batch, project
+                        ),
+                    )
+                )
+            self.refreshes += [
+                (
+                    JobInterval(name, project, interval_minutes),
+                    functools.partial(self.refresh, name, project),
+                )
+                for name in names
+                if not batch or metrics.JOBS[name].fetch is not None
+            ]
+
+    async def _in_thread(self, function, *args):
+        """Internal method. Run a blocking call in the thread pool."""
+        return await self.loop.run_in_executor(self.executor, function, *args)
+
+    def submit(self, function, *args) -> concurrent.futures.Future:
+        """
+        Run function(*args) in the thread pool once a slot is free, from any
+        thread, like Executor.submit(). Runs the refreshes triggered by
+        scrapes under the same limits as the scheduled ones, see ondemand.py.
+        """
+
+        async def run():
+            async with self._slots:
+                return await self._in_thread(function, *args)
+
+        return asyncio.run_coroutine_threadsafe(run(), self.loop)
+
+    async def refresh(self, name, project) -> bool:
+        """
+        Description
+        -----------
+        Refresh the job name of project. The query of a job reading a
+        pre-aggregated source is started and polled until done; other jobs,
+        and all jobs of a backend without query jobs, run metrics.run_job()
+        in a thread.
+
+        Return
+        ------
+        The outcome of the refresh, see metrics.run_job().
+        """
+        job = metrics.JOBS[name]
+        if job.fetch is not None or not metrics.BACKENDS[project].query_jobs:
+            return await self._in_thread(metrics.run_job, name, project)
+
+        start = datetime.datetime.now()
+        fingerprint = None
+        if metrics.CHANGE_DETECTION:
+            changed = await self._in_thread(metrics.changed_jobs, [name], project)
+            if name not in changed:
+                return False
+            fingerprint = changed[name]
+
+        query_job = await self._in_thread(metrics.submit_job, name, project)
+        if query_job is None:
+            # Postponed, over the byte budget
+            return budget.POSTPONED
+        while True:
+            await self._in_thread(query_job.reload)
+            if query_job.state == "DONE":
+                break
+            await asyncio.sleep(self.poll_seconds)
+
+        df = await self._in_thread(metrics.download_result, name, query_job, project)
+        await self._in_thread(
+            metrics.apply_result, name, df, start, fingerprint, project
+        )
+        return True
+
+    async def _refresh_once(self, interval: JobInterval, refresh) -> None:
+        """
+        Internal method. Run refresh() once a slot is free, or wait for the
+        refresh of the job a scrape started (see ondemand.py), logging
+        instead of raising errors, and adapt interval to the outcome.
+        """
+        changed = None
+        future, started = ondemand.FLIGHTS.join(interval.key)
+        if not started:
+            try:
+                changed = await asyncio.wrap_future(future)
+            except Exception:
+                logger.exception(f"Refresh of {interval.key} failed.")
+            interval.record(changed)
+            return None
+
+        error = None
+        async with self._slots:
+            try:
+                changed = await refresh()
+            except Exception as exception:
+                logger.exception(f"Refresh of {interval.key} failed.")
+                error = exception
+        ondemand.land(interval.key, changed, error)
+        interval.record(changed)
+        return None
+
+    async def refresh_all(self) -> None:
+        """Refresh all jobs at the same time, and wait for them to finish."""
+        await asyncio.gather(
+            *(
+                self._refresh_once(interval, refresh)
+                for interval, refresh in self.refreshes
+            )
+        )
+        return None
+
+    async def _wait(self, delay: float) -> bool:
+        """Internal method. Wait delay seconds. Return whether stopped meanwhile."""
+        try:
+            await asyncio.wait_for(self._stopped.wait(), delay)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def _every(self, interval: JobInterval, refresh, delay: float) -> None:
+        """Internal method. Refresh after delay, then at interval, until stopped."""
+        while not await self._wait(delay):
+            await self._refresh_once(interval, refresh)
+            delay = interval.delay()
+        return None
+
+    async def _main(self) -> None:
+        """
+        Internal method. Run every refresh at its interval until stopped,
+        with the first runs staggered like in scheduler.py.
+        """
+        await asyncio.gather(
+            *(
+                self._every(interval, refresh, i * STAGGER_SECONDS)
+                for i, (interval, refresh) in enumerate(self.refreshes)
+            )
+        )
+        return None
+
+    def start(self) -> None:
+        """Start refreshing, in a daemon thread running the event loop."""
+        self._thread = threading.Thread(
+            target=self.loop.run_until_complete,
+            args=(self._main(),),
+            name="refresh-engine",
+            daemon=True,
+        )
+        self._thread.start()
+        return None
+
+    def shutdown(self) -> None:
+        """Stop after the refreshes running now, and wait for them."""
+        if self._thread is not None:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+            self._thread.join()
+        self.executor.shutdown()
+        return None
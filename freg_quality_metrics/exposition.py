@@ -0,0 +1,236 @@
+import gzip
+import logging
+import os
+import threading
+import time
+
+import prometheus_client
+from prometheus_client import openmetrics
+
+
+logger = logging.getLogger(__name__)
+logger.debug("Logging is configured.")
+
+# Held while a refresh writes its metrics and while a snapshot is taken, so
+# that a snapshot never contains half of a refresh.
+lock = threading.RLock()
+
+# Part of every ETag, so that ETags from before a restart never match the
+# snapshots of this process, which count their generations from 1 again.
+_EPOCH = f"{time.time_ns():x}"
+
+OPENMETRICS_CONTENT_TYPE = openmetrics.exposition.CONTENT_TYPE_LATEST
+
+
+class Snapshot:
+    """
+    The metric families collected at one point in time, with the text
+    exposition rendered once when the snapshot is taken. A snapshot read
+    from another process (see read_shared()) has its bodies, but no
+    families, and the epoch of that process. ready tells whether the process
+    taking it had metrics loaded, see metrics.READY.
+    """
+
+    def __init__(
+        self, generation: int, families, epoch=_EPOCH, bodies=None, ready=False
+    ):
+        self.generation = generation
+        self.epoch = epoch
+        self.ready = ready
+        self.families = tuple(families)
+        if bodies is None:
+            bodies = {(False, False): prometheus_client.generate_latest(self)}
+        self._bodies = dict(bodies)
+        self.text = self._bodies[(False, False)]
+
+    def collect(self):
+        return iter(self.families)
+
+    def body(self, openmetrics_format: bool, compressed: bool) -> bytes:
+        """
+        The exposition of this snapshot in the text or OpenMetrics format,
+        optionally gzipped. Each variant is rendered on first request and
+        kept for as long as the snapshot is current.
+        """
+        key = (openmetrics_format, compressed)
+        if key not in self._bodies:
+            if compressed:
+                body = gzip.compress(self.body(openmetrics_format, False))
+            else:
+                body = openmetrics.exposition.generate_latest(self)
+            self._bodies[key] = body
+        return self._bodies[key]
+
+    def etag(self, openmetrics_format: bool, compressed: bool) -> str:
+        variant = "openmetrics" if openmetrics_format else "text"
+        if compressed:
+            variant += "-gzip"
+        return f'"{self.epoch}-{self.generation}-{variant}"'
+
+
+def write_shared(snapshot: Snapshot, path) -> None:
+    """
+    Description
+    -----------
+    Write the text and OpenMetrics bodies of snapshot to path, for other
+    processes to serve, see read_shared(). The file is replaced in one step,
+    so a reader never sees half of it.
+    """
+    text = snapshot.body(False, False)
+    header = (
+        f"{snapshot.epoch} {snapshot.generation} {len(text)} {int(snapshot.ready)}\n"
+    ).encode()
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(header + text + snapshot.body(True, False))
+    os.replace(temporary, path)
+    return None
+
+
+def read_shared(path) -> Snapshot:
+    """Read a snapshot written by write_shared()."""
+    with open(path, "rb") as file:
+        header, data = file.read().split(b"\n", 1)
+    epoch, generation, length, ready = header.decode().split()
+    bodies = {
+        (False, False): data[: int(length)],
+        (True, False): data[int(length) :],
+    }
+    return Snapshot(int(generation), [], epoch=epoch, bodies=bodies, ready=ready == "1")
+
+
+class SnapshotCollector:
+    """
+    Collector serving the last published snapshot of a registry. The metrics
+    in the registry are only read by publish(), never by a scrape.
+
+    A collector can instead share its snapshots with other processes through
+    a file (see share()), or serve the snapshots another process shares
+    (see follow()).
+    """
+
+    def __init__(self, source=prometheus_client.REGISTRY):
+        self._source = source
+        self._snapshot = Snapshot(0, [])
+        self._generation = 0
+        # Whether the metrics in source are loaded, recorded in every
+        # snapshot so that followers know whether the leader is ready
+        self.ready = threading.Event()
+        self._shared_path = None
+        self._shared_stat = None
+        self.following = False
+        # Whether to share the snapshots once ready, see share()
+        self._sharing = False
+
+    @property
+    def snapshot(self) -> Snapshot:
+        """The snapshot to serve, read again from the shared file if it changed."""
+        if self.following:
+            self._read_shared()
+        return self._snapshot
+
+    def collect(self):
+        return self.snapshot.collect()
+
+    def publish(self) -> Snapshot:
+        """
+        Take a new snapshot of the source registry and swap it in. Scrapes
+        running while this happens keep serving the previous snapshot. A
+        collector still following the snapshots of another process keeps
+        serving those instead, see share().
+        """
+        with lock:
+            self._generation += 1
+            snapshot = Snapshot(
+                self._generation, self._source.collect(), ready=self.ready.is_set()
+            )
+            if self._sharing and snapshot.ready:
+                self.following = False
+                write_shared(snapshot, self._shared_path)
+            if not self.following:
+                self._snapshot = snapshot
+        logger.debug(f"Published metrics snapshot {snapshot.generation}.")
+        return snapshot
+
+    def share(self, path) -> None:
+        """
+        Description
+        -----------
+        Write the snapshots published to path once ready is set, starting
+        with a new one if it is already. Until then, a collector following path keeps
+        serving the last snapshot shared there, so that the followers of a
+        leader taking over are not left with an empty snapshot until it has
+        loaded its metrics.
+        """
+        with lock:
+            self._shared_path = path
+            self._sharing = True
+        if self.ready.is_set():
+            self.publish()
+        return None
+
+    def follow(self, path) -> None:
+        """Serve the snapshots another process shares in path, see share()."""
+        self._shared_path = path
+        self._sharing = False
+        self.following = True
+        return None
+
+    def _read_shared(self) -> None:
+        """Internal method. Swap in the shared snapshot, if it changed."""
+        try:
+            stat = os.stat(self._shared_path)
+        except FileNotFoundError:
+            # The leader has not shared a snapshot yet
+            return None
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key != self._shared_stat:
+            self._snapshot = read_shared(self._shared_path)
+            self._shared_stat = key
+        return None
+
+
+COLLECTOR = SnapshotCollector()
+
+
+def _accepts(header: str, value: str) -> bool:
+    """Whether value is one of the comma separated entries of an Accept* header."""
+    return any(entry.split(";")[0].strip() == value for entry in header.split(","))
+
+
+def make_wsgi_app(collector: SnapshotCollector = COLLECTOR, before_scrape=None):
+    """
+    WSGI app serving the current snapshot. The format (text or OpenMetrics)
+    and compression (gzip or none) follow the Accept and Accept-Encoding
+    headers. Each response carries an ETag for the snapshot generation, and
+    a request with a matching If-None-Match gets an empty 304 response.
+    before_scrape(environ) is called before the snapshot is read, if given,
+    e.g. to refresh stale metrics first.
+    """
+
+    def prometheus_app(environ, start_response):
+        if before_scrape is not None:
+            before_scrape(environ)
+        snapshot = collector.snapshot
+        openmetrics_format = _accepts(
+            environ.get("HTTP_ACCEPT", ""), "application/openmetrics-text"
+        )
+        compressed = _accepts(environ.get("HTTP_ACCEPT_ENCODING", ""), "gzip")
+
+        etag = snapshot.etag(openmetrics_format, compressed)
+        headers = [("ETag", etag), ("Vary", "Accept, Accept-Encoding")]
+        if_none_match = environ.get("HTTP_IF_NONE_MATCH", "")
+        if if_none_match.strip() == "*" or _accepts(if_none_match, etag):
+            start_response("304 Not Modified", headers)
+            return [b""]
+
+        if openmetrics_format:
+            headers.append(("Content-Type", OPENMETRICS_CONTENT_TYPE))
+        else:
+            headers.append(("Content-Type", prometheus_client.CONTENT_TYPE_LATEST))
+        if compressed:
+            headers.append(("Content-Encoding", "gzip"))
+        start_response("200 OK", headers)
+        return [snapshot.body(openmetrics_format, compressed)]
+
+    return prometheus_app
@@ -0,0 +1,151 @@
+"""
+Validation of fødselsnummer (fnr) and d-nummer (dnr) in Python, for idents
+from other sources than the kvalitet tables, e.g. local extracts. Gives the
+same counts as kvalitet.metrics_count_valid_fnr_dnr.
+
+An ident is an fnr when its first digit is 0-3 and a dnr when it is 4-9 (a
+dnr adds 4 to the first digit of the day). Each invalid ident is counted
+under the first check it fails, in the order of the query (see
+metrics.preagg_valid_and_invalid_idents()):
+* 'format' (not 11 digits). Counted as dnr when the first character is 4-9.
+* 'date' (no such date, with the century given by the individnummer).
+* 'control' (the two last digits are not the mod-11 control digits).
+* 'first_digit' (a dnr starting with 8 or 9). Such a dnr has a day of 40 or
+  more and fails the date check first, so with the type given by the first
+  digit no ident is counted here.
+"""
+import logging
+
+
+logger = logging.getLogger(__name__)
+logger.debug("Logging is configured.")
+
+CHECKS = ["invalid_format", "invalid_first_digit", "invalid_date", "invalid_control"]
+
+# The columns of metrics_count_valid_fnr_dnr holding counts
+COLUMNS = [
+    f"{ident_type}_{check}"
+    for ident_type in ["fnr", "dnr"]
+    for check in ["total_count"] + CHECKS
+]
+
+# Weights of the digits in the first and second control digit
+_WEIGHTS_K1 = [3, 7, 6, 1, 8, 9, 4, 5, 2]
+_WEIGHTS_K2 = [5, 4, 3, 2, 7, 6, 5, 4, 3, 2]
+
+_DAYS_IN_MONTH = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+
+def _control_digit(digits: list, weights: list):
+    """
+    Internal function. The mod-11 control digit of idents given as a list of
+    arrays, one per digit. 10 when there is no valid control digit.
+    """
+    total = sum(digit * weight for digit, weight in zip(digits, weights))
+    return (11 - total % 11) % 11
+
+
+def classify(idents) -> tuple:
+    """
+    Description
+    -----------
+    Check an array of idents (strings, None counts as invalid format).
+
+    Return
+    ------
+    tuple: (is_dnr, failed), numpy arrays with one element per ident, where
+        is_dnr is a bool and failed is the index in CHECKS of the first check
+        failed, or -1 for a valid ident.
+    """
+    import numpy
+    import pandas
+
+    idents = numpy.asarray(idents, dtype=object)
+    text = numpy.where(pandas.isna(idents), "", idents).astype(str)
+
+    # The code points of every ident of 11 characters as an (n, 11) array,
+    # all zeros for the other idents
+    fixed = numpy.where(numpy.char.str_len(text) == 11, text, "").astype("U11")
+    codes = fixed.view(numpy.uint32).reshape(-1, 11)
+    valid_format = ((codes >= ord("0")) & (codes <= ord("9"))).all(axis=1)
+    digits = numpy.where(valid_format[:, None], codes - ord("0"), 0)
+    digits = digits.astype(numpy.int16)
+
+    first_character = text.astype("U1").view(numpy.uint32)
+    is_dnr = (first_character >= ord("4")) & (first_character <= ord("9"))
+    valid_first_digit = digits[:, 0] <= 7
+
+    day = digits[:, 0] * 10 + digits[:, 1] - numpy.where(is_dnr, 40, 0)
+    month = digits[:, 2] * 10 + digits[:, 3]
+    yy = digits[:, 4] * 10 + digits[:, 5]
+    individnummer = digits[:, 6] * 100 + digits[:, 7] * 10 + digits[:, 8]
+    year = numpy.select(
+        [
+            individnummer < 500,
+            (individnummer < 750) & (yy >= 54),
+            yy < 40,
+            individnummer >= 900,
+        ],
+        [1900 + yy, 1800 + yy, 2000 + yy, 1900 + yy],
+        default=-1,
+    )
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    days_in_month = numpy.array(_DAYS_IN_MONTH)[numpy.clip(month, 0, 12)]
+    days_in_month = days_in_month + (leap & (month == 2))
+    valid_date = (year > 0) & (month >= 1) & (month <= 12)
+    valid_date &= (day >= 1) & (day <= days_in_month)
+
+    # Column by column, which is faster than a matrix product of integers
+    columns = [digits[:, i] for i in range(9)]
+    k1 = _control_digit(columns, _WEIGHTS_K1)
+    k2 = _control_digit(columns + [k1], _WEIGHTS_K2)
+    valid_control = (k1 == digits[:, 9]) & (k2 == digits[:, 10])
+
+    # In the order of the checks in the query, not of CHECKS
+    failed = numpy.select(
+        [~valid_format, ~valid_date, ~valid_control, ~valid_first_digit],
+        [0, 2, 3, 1],
+        default=-1,
+    )
+    return is_dnr, failed
+
+
+def count(idents) -> dict:
+    """
+    Description
+    -----------
+    Count the idents of each type, and the invalid ones by the check failed.
+
+    Return
+    ------
+    dict: keys - the columns in COLUMNS,
+          values - int (count).
+    """
+    import numpy
+
+    is_dnr, failed = classify(idents)
+    counts = {}
+    for ident_type, of_type in [("fnr", ~is_dnr), ("dnr", is_dnr)]:
+        failures = numpy.bincount(failed[of_type] + 1, minlength=len(CHECKS) + 1)
+        counts[f"{ident_type}_total_count"] = int(of_type.sum())
+        for i, check in enumerate(CHECKS):
+            counts[f"{ident_type}_{check}"] = int(failures[i + 1])
+    return counts
+
+
+def count_chunks(chunks) -> dict:
+    """
+    Description
+    -----------
+    Same as count(), for idents coming in chunks, e.g. the pages of a query
+    result. Only one chunk is held in memory at a time.
+    """
+    counts = dict.fromkeys(COLUMNS, 0)
+    for chunk in chunks:
+        for column, value in count(chunk).items():
+            counts[column] += value
+    logger.debug(
+        f"Counted {counts['fnr_total_count']} fnr and "
+        f"{counts['dnr_total_count']} dnr."
+    )
+    return counts
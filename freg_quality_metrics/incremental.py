@@ -0,0 +1,328 @@
+import collections
+import logging
+import threading
+
+from . import results
+
+
+logger = logging.getLogger(__name__)
+logger.debug("Logging is configured.")
+
+
+class NullvalueHistory:
+    """
+    The latest and previous number of nullvalues per column of
+    dsf_situasjonsuttak, kept up to date from the rows added to
+    kvalitet.qa_nullvalue_columns since the last fetch. Gives the same results
+    as the dsfsit_* queries in bigquery.PRE_AGGREGATED, without scanning the
+    whole history of the table on every refresh.
+    """
+
+    def __init__(self):
+        # kolonne -> (latest row, previous row or None), where a row is
+        # (tidspunkt, ant_nullvals, pct_nullvals)
+        self.columns = {}
+        self._lock = threading.Lock()
+
+    @property
+    def watermark(self):
+        """The latest tidspunkt seen for any column, None before the first fetch."""
+        if not self.columns:
+            return None
+        return max(latest[0] for latest, _ in self.columns.values())
+
+    def update(self, rows) -> None:
+        """
+        Description
+        -----------
+        Add new rows of qa_nullvalue_columns (tidspunkt, kolonne, ant_nullvals,
+        pct_nullvals). Rows not newer than the last seen tidspunkt of their
+        column are ignored, so fetching a row twice does no harm.
+        """
+        new_rows = sorted(
+            zip(
+                results.values(rows, "tidspunkt"),
+                results.values(rows, "kolonne"),
+                results.values(rows, "ant_nullvals"),
+                results.values(rows, "pct_nullvals"),
+            ),
+            key=lambda row: row[0],
+        )
+        with self._lock:
+            for tidspunkt, kolonne, ant_nullvals, pct_nullvals in new_rows:
+                latest, _ = self.columns.get(kolonne, (None, None))
+                if latest is not None and tidspunkt <= latest[0]:
+                    continue
+                self.columns[kolonne] = (
+                    (tidspunkt, ant_nullvals, pct_nullvals),
+                    latest,
+                )
+        logger.debug(f"Added {len(new_rows)} rows to the nullvalue history.")
+        return None
+
+    def rows(self):
+        """
+        The latest and previous row of every column, which is all update()
+        needs to rebuild the history, e.g. after a restart.
+        """
+        import pandas
+
+        rows = [
+            (row[0], kolonne, row[1], row[2])
+            for kolonne, (latest, previous) in self.columns.items()
+            for row in (previous, latest)
+            if row is not None
+        ]
+        return pandas.DataFrame(
+            rows, columns=["tidspunkt", "kolonne", "ant_nullvals", "pct_nullvals"]
+        )
+
+    def _latest_run(self) -> dict:
+        """Internal method. The columns of the latest run, i.e. the latest date."""
+        watermark = self.watermark
+        if watermark is None:
+            return {}
+        date = watermark.replace(hour=0, minute=0, second=0, microsecond=0)
+        return {
+            kolonne: (latest, previous)
+            for kolonne, (latest, previous) in self.columns.items()
+            if latest[0] > date
+        }
+
+    def latest_timestamp(self):
+        """Same result as the dsfsit_latest_timestamp query."""
+        import pandas
+
+        watermark = self.watermark
+        return pandas.DataFrame(
+            {
+                "latest_timestamp": [
+                    None
+                    if watermark is None
+                    else watermark.strftime("%d-%m-%Y %H:%M:%S")
+                ]
+            }
+        )
+
+    def latest(self):
+        """Same result as the dsfsit_qa_nullvals_latest query."""
+        import pandas
+
+        latest_run = self._latest_run()
+        return pandas.DataFrame(
+            {
+                "kolonne": list(latest_run),
+                "ant_nullvals": [latest[1] for latest, _ in latest_run.values()],
+                "pct_nullvals": [latest[2] for latest, _ in latest_run.values()],
+            }
+        )
+
+    def diff(self):
+        """Same result as the dsfsit_qa_nullvals_diff query."""
+        import pandas
+
+        rows = []
+        for kolonne, (latest, previous) in self._latest_run().items():
+            _, ant, pct = latest
+            pct_diff = pct - previous[2] if previous is not None else pct
+            if pct_diff >= 0.1 or pct_diff <= -0.1:
+                rows.append((kolonne, ant, pct, round(pct_diff, 2)))
+        return pandas.DataFrame(
+            rows, columns=["kolonne", "ant_nullvals", "pct_nullvals", "pct_diff_last"]
+        )
+
+
+class DistinctCounts:
+    """
+    The total and unique number of rows of the columns in
+    config.DISTINCT_COUNTS, counted either exactly or approximately. An
+    approximate count keeps the HyperLogLog++ sketch of the column and the
+    watermark of its ingestion time column, so that the next count only
+    reads the rows added since and merges their sketch into the one kept
+    here.
+    """
+
+    COLUMNS = [
+        "datasett",
+        "tabell",
+        "variabel",
+        "totalt",
+        "distinkte",
+        "relativ_feil",
+        "sketch",
+        "watermark",
+    ]
+
+    def __init__(self):
+        # (datasett, tabell, variabel) -> (totalt, distinkte, relativ_feil,
+        # sketch, watermark), where sketch and watermark are None for exact
+        # counts
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def get(self, database, table, column) -> tuple:
+        """The last count of a column, or an empty count if it has none."""
+        return self.counts.get((database, table, column), (0, 0, 0, None, None))
+
+    def update(self, rows) -> None:
+        """
+        Description
+        -----------
+        Replace the counts of the columns in rows, a dataframe with the
+        columns in COLUMNS.
+        """
+        import pandas
+
+        with self._lock:
+            for row in zip(*(results.values(rows, column) for column in self.COLUMNS)):
+                # Missing sketches and watermarks come back from a saved
+                # result as NaN or NaT
+                sketch, watermark = (
+                    None if pandas.isna(value) else value for value in row[6:]
+                )
+                self.counts[row[:3]] = row[3:6] + (sketch, watermark)
+        logger.debug(
+            f"Updated the distinct counts of {results.num_rows(rows)} columns."
+        )
+        return None
+
+    def rows(self):
+        """All counts as a dataframe with the columns in COLUMNS."""
+        import pandas
+
+        return pandas.DataFrame(
+            [key + count for key, count in self.counts.items()], columns=self.COLUMNS
+        )
+
+
+class LatestRecords:
+    """
+    The latest record (by gyldighetstidspunkt) of every person in a table,
+    with the value of one column, and the number of persons per value. Kept
+    up to date from the rows added since the last fetch: a person whose
+    latest record changes is taken out of the group of its old value and
+    counted in the group of the new one. Gives the same counts as
+    bigquery.BigQuery.group_by_and_count, without reading the whole table on
+    every refresh.
+
+    Records of persons already kept are replaced in place. Records of new
+    persons go in a smaller frame first, merged into the main one once it
+    has grown past a share of it, so that adding persons does not copy all
+    records on every refresh.
+    """
+
+    COLUMNS = ["ident", "gyldighetstidspunkt", "value"]
+
+    # Merge the added records into the main frame once they are this share
+    # of it
+    MERGE_SHARE = 0.1
+
+    def __init__(self):
+        # Latest record per person, indexed by ident, with the columns
+        # gyldighetstidspunkt and value, in records or, for persons added
+        # since the last merge, in added
+        self.records = None
+        self.added = None
+        # value -> number of persons whose latest record has that value
+        self.counts = collections.Counter()
+        # The latest value of the watermark column fetched so far
+        self.watermark = None
+        # Idents whose record changed since the last mark_saved()
+        self.unsaved = set()
+        self._lock = threading.Lock()
+
+    def _latest(self, idents):
+        """Internal method. The records kept for idents, NaN where none is."""
+        return self.added.reindex(idents).combine_first(self.records.reindex(idents))
+
+    def update(self, rows, watermark=None) -> None:
+        """
+        Description
+        -----------
+        Add new records, a dataframe with the columns in COLUMNS, fetched up
+        to watermark. Records not newer than the one kept for their person
+        are ignored, so fetching a record twice does no harm.
+        """
+        import pandas
+
+        if results.is_arrow(rows):
+            rows = rows.to_pandas()
+        new = (
+            rows[self.COLUMNS]
+            .sort_values("gyldighetstidspunkt")
+            .drop_duplicates("ident", keep="last")
+            .set_index("ident")
+        )
+
+        with self._lock:
+            if self.records is None:
+                self.records = new.iloc[0:0]
+                self.added = new.iloc[0:0]
+            old = self._latest(new.index)
+            newer = old.gyldighetstidspunkt.isna()
+            known = ~newer
+            newer[known] = (
+                new.gyldighetstidspunkt[known] > old.gyldighetstidspunkt[known]
+            )
+            changed = new[newer]
+
+            self.counts.subtract(old.value[newer].dropna().value_counts().to_dict())
+            self.counts.update(changed.value.dropna().value_counts().to_dict())
+            for value in [value for value, count in self.counts.items() if count <= 0]:
+                del self.counts[value]
+
+            in_records = changed.index.isin(self.records.index)
+            in_added = changed.index.isin(self.added.index)
+            if in_records.any():
+                self.records.loc[changed.index[in_records]] = changed[in_records]
+            if in_added.any():
+                self.added.loc[changed.index[in_added]] = changed[in_added]
+            if not (in_records | in_added).all():
+                self.added = pandas.concat(
+                    [self.added, changed[~(in_records | in_added)]]
+                )
+            if len(self.added) > self.MERGE_SHARE * len(self.records):
+                self.records = pandas.concat([self.records, self.added])
+                self.added = self.added.iloc[0:0]
+            self.unsaved.update(changed.index)
+        self.advance(watermark)
+        logger.debug(f"Updated the latest record of {len(changed)} persons.")
+        return None
+
+    def advance(self, watermark) -> None:
+        """Move the watermark on to watermark, if it is later."""
+        with self._lock:
+            if watermark is not None and (
+                self.watermark is None or watermark > self.watermark
+            ):
+                self.watermark = watermark
+        return None
+
+    def group_counts(self) -> dict:
+        """The number of persons per value, like group_by_and_count."""
+        return dict(self.counts)
+
+    def rows(self, unsaved=False):
+        """
+        The latest record of every person, or with unsaved only of those
+        changed since the last mark_saved(), as a dataframe with the columns
+        in COLUMNS. All rows are all update() needs to rebuild the counts.
+        """
+        import pandas
+
+        if self.records is None:
+            return pandas.DataFrame(columns=self.COLUMNS)
+        with self._lock:
+            if unsaved:
+                return (
+                    self._latest(pandas.Index(list(self.unsaved)))
+                    .rename_axis("ident")
+                    .reset_index()
+                )
+            return pandas.concat([self.records, self.added]).reset_index()
+
+    def mark_saved(self, idents) -> None:
+        """Record that the latest records of idents have been saved."""
+        with self._lock:
+            self.unsaved.difference_update(idents)
+        return None
@@ -0,0 +1,105 @@
+"""
+The interval between the refreshes of each job. A job starts at its base
+interval, from JOB_INTERVALS or else INTERVAL_MINUTES, which then follows
+how often its source changes: it grows by INTERVAL_GROWTH after every
+refresh that finds the source unchanged (see metrics.changed_jobs()), and
+shrinks by the same factor, down to the base, after every refresh that finds
+it changed. After a failed refresh the delay doubles with every failure in a
+row. Every delay varies randomly by up to INTERVAL_JITTER, so that jobs do
+not stay in step.
+"""
+import logging
+import random
+
+import prometheus_client
+
+from . import exposition
+from .budget import POSTPONED
+from .config import (
+    INTERVAL_GROWTH,
+    INTERVAL_JITTER,
+    JOB_INTERVALS,
+    MAX_INTERVAL_MINUTES,
+    METRIC_PREFIX,
+)
+
+
+logger = logging.getLogger(__name__)
+logger.debug("Logging is configured.")
+
+INTERVAL = prometheus_client.Gauge(
+    f"{METRIC_PREFIX}metrics_interval_seconds",
+    "Seconds until the next refresh of a job, before jitter",
+    ["name", "project"],
+)
+
+
+class JobInterval:
+    """The interval between the refreshes of the job name of project."""
+
+    def __init__(
+        self,
+        name,
+        project,
+        base_minutes: float,
+        max_minutes=MAX_INTERVAL_MINUTES,
+        growth=INTERVAL_GROWTH,
+        jitter=INTERVAL_JITTER,
+    ):
+        self.name = name
+        self.project = project
+        self.base_seconds = JOB_INTERVALS.get(name, base_minutes) * 60
+        # The base of a job may be longer than the max for adapted intervals
+        self.max_seconds = max(max_minutes * 60, self.base_seconds)
+        self.growth = growth
+        self.jitter = jitter
+        self.seconds = self.base_seconds
+        self.failures = 0
+        self._export()
+
+    @property
+    def key(self) -> str:
+        return f"{self.project}/{self.name}"
+
+    @property
+    def effective_seconds(self) -> float:
+        """The interval, backed off after failures."""
+        return min(self.seconds * 2**self.failures, self.max_seconds)
+
+    def record(self, changed) -> None:
+        """
+        Description
+        -----------
+        Adapt the interval to the outcome of a refresh: changed is True when
+        the source had changed, False when it had not and the refresh was
+        skipped, None when the refresh failed, and budget.POSTPONED when it
+        was postponed since it is over the byte budget, which says nothing
+        of how often the source changes and leaves the interval as it is.
+        """
+        if changed is POSTPONED:
+            pass
+        elif changed is None:
+            self.failures += 1
+        else:
+            self.failures = 0
+            if changed:
+                self.seconds = max(self.seconds / self.growth, self.base_seconds)
+            else:
+                self.seconds = min(self.seconds * self.growth, self.max_seconds)
+        # The snapshot of the refresh, if any, was published before the
+        # outcome was known, so the interval goes into a snapshot of its own
+        with exposition.lock:
+            self._export()
+        exposition.COLLECTOR.publish()
+        return None
+
+    def delay(self) -> float:
+        """Seconds until the next refresh, with jitter."""
+        return self.effective_seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _export(self) -> None:
+        """Internal method. Set freg_metrics_interval_seconds of the job."""
+        INTERVAL.labels(name=self.name, project=self.project).set(
+            self.effective_seconds
+        )
+        return None
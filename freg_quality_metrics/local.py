@@ -0,0 +1,223 @@
+"""
+A local backend running the queries of bigquery.BigQuery with DuckDB over
+Parquet exports of the BigQuery tables, so that the metrics can be computed
+offline, e.g. for development, load tests and CI. Selected with
+config.BACKEND = "local".
+"""
+from __future__ import annotations
+
+import logging
+import os
+import re
+import threading
+from typing import TYPE_CHECKING
+
+from .bigquery import BigQuery
+
+
+if TYPE_CHECKING:
+    import pandas
+
+
+logger = logging.getLogger(__name__)
+logger.debug("Logging is configured.")
+
+# BigQuery functions used by the queries, defined as DuckDB macros
+MACROS = {
+    "FORMAT_DATETIME(fmt, x)": "strftime(x, fmt)",
+    "FORMAT_TIMESTAMP(fmt, x)": "strftime(x, fmt)",
+    "PARSE_TIMESTAMP(fmt, x)": "strptime(x, fmt)",
+}
+
+# BigQuery syntax the macros cannot cover, as (pattern, replacement)
+TRANSLATIONS = [
+    # `project.database.table` and `database.table` -> database.table
+    (re.compile(r"`(?:[\w-]+\.)?(\w+)\.(\w+)`"), r"\1.\2"),
+    # "string" -> 'string', double quotes are identifiers in DuckDB
+    (re.compile(r'"([^"]*)"'), r"'\1'"),
+    (re.compile(r"\bTIMESTAMP\('([^']*)'\)"), r"CAST('\1' AS TIMESTAMPTZ)"),
+    (re.compile(r"\bFLOAT64\b"), "DOUBLE"),
+    (re.compile(r"\bINT64\b"), "BIGINT"),
+]
+
+
+def translate(query: str) -> str:
+    """Translate a BigQuery query to the DuckDB dialect."""
+    for pattern, replacement in TRANSLATIONS:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+class LocalBackend(BigQuery):
+    """
+    Drop-in replacement for BigQuery, with the same methods. The table
+    database.table is read from <data_dir>/<database>/<table>.parquet, or
+    from all Parquet files in the directory <data_dir>/<database>/<table>/,
+    e.g. an export made with EXPORT DATA.
+    """
+
+    # Queries run to completion in the calling thread
+    query_jobs = False
+
+    def __init__(self, data_dir, result_format="pandas", gcp_project="local"):
+        super().__init__(gcp_project=gcp_project, result_format=result_format)
+        self.data_dir = data_dir
+        self._connection = None
+        self._connection_lock = threading.Lock()
+
+    def _path(self, database, table) -> str:
+        """Internal method. The Parquet files of database.table, as a glob."""
+        path = os.path.join(self.data_dir, database, table)
+        if os.path.isdir(path):
+            return os.path.join(path, "*.parquet")
+        return f"{path}.parquet"
+
+    @property
+    def connection(self):
+        """
+        The DuckDB connection, created on first use with a view per table
+        found in data_dir and the macros in MACROS.
+        """
+        if self._connection is None:
+            with self._connection_lock:
+                if self._connection is None:
+                    self._connection = self._connect()
+        return self._connection
+
+    def _connect(self):
+        """Internal method. Create the connection, see connection."""
+        import duckdb
+
+        connection = duckdb.connect()
+        for signature, body in MACROS.items():
+            connection.execute(f"CREATE MACRO {signature} AS {body}")
+        for database in sorted(os.listdir(self.data_dir)):
+            if not os.path.isdir(os.path.join(self.data_dir, database)):
+                continue
+            connection.execute(f"CREATE SCHEMA IF NOT EXISTS {database}")
+            for entry in sorted(os.listdir(os.path.join(self.data_dir, database))):
+                table = entry.removesuffix(".parquet")
+                connection.execute(
+                    f"CREATE VIEW {database}.{table} AS "
+                    f"SELECT * FROM read_parquet('{self._path(database, table)}')"
+                )
+        logger.debug(f"Connected to the Parquet files in {self.data_dir}.")
+        return connection
+
+    def _execute(self, query: str, parameters=None):
+        """
+        Internal method. Run a BigQuery query, on a cursor of this thread,
+        with the values of the BigQuery query parameters in parameters.
+        """
+        query = translate(query)
+        if not parameters:
+            return self.connection.cursor().execute(query)
+        # @name -> $name, named parameters in DuckDB
+        query = re.sub(r"@(\w+)", r"$\1", query)
+        values = {parameter.name: parameter.value for parameter in parameters}
+        return self.connection.cursor().execute(query, values)
+
+    def _query_job_dataframe(self, query: str, parameters=None) -> pandas.DataFrame:
+        """
+        Description: Internal method for this class.
+        Parameters: query string, and optionally a list of query parameters.
+        Returns: pandas dataframe.
+        """
+        return self._execute(query, parameters).df()
+
+    def _query_job_result(self, query: str, parameters=None):
+        """
+        Description: Internal method for this class. Runs the query and
+            returns the result in self.result_format.
+        Parameters: query string, and optionally a list of query parameters.
+        Returns: pandas dataframe or pyarrow table.
+        """
+        cursor = self._execute(query, parameters)
+        if self.result_format == "arrow":
+            return cursor.fetch_arrow_table()
+        return cursor.df()
+
+    def _query_column_chunks(self, query: str, chunk_size: int):
+        """
+        Description: Internal method for this class. Runs a query returning
+            a single column and yields its values chunk_size rows at a time.
+        Parameters: query string, and the number of rows per chunk.
+        Returns: iterator of numpy arrays.
+        """
+        batches = self._execute(query).to_arrow_reader(chunk_size)
+        for batch in batches:
+            yield batch.column(0).to_numpy(zero_copy_only=False)
+
+    def _query_pages(self, query: str, parameters=None, page_size=None):
+        """
+        Description: Internal method for this class. Runs a query and yields
+            its result page_size rows at a time (DuckDB's default batch
+            size if None).
+        Parameters: query string, optionally a list of query parameters, and
+            the number of rows per page.
+        Returns: iterator of pandas dataframes.
+        """
+        cursor = self._execute(query, parameters)
+        if page_size is None:
+            batches = cursor.to_arrow_reader()
+        else:
+            batches = cursor.to_arrow_reader(page_size)
+        for batch in batches:
+            yield batch.to_pandas()
+
+    def estimate_bytes(self, query: str, job_config=None, by_parameters=True) -> int:
+        """Local queries cost nothing, so they are never dry run."""
+        return 0
+
+    def table_fingerprint(self, database, table) -> tuple:
+        """
+        Description
+        -----------
+        The latest modification time and total size of the files of a
+        table, which change whenever the table is exported again.
+
+        Return
+        ------
+        tuple: (last modified time, size in bytes)
+        """
+        import glob
+
+        files = glob.glob(self._path(database, table))
+        stats = [os.stat(file) for file in files]
+        return (
+            max((stat.st_mtime for stat in stats), default=None),
+            sum(stat.st_size for stat in stats),
+        )
+
+    def count_rows_from_metadata(self, database, table) -> float:
+        """The number of rows of a table, from the metadata of its Parquet files."""
+        df = self._query_job_dataframe(
+            f"SELECT COUNT(*) AS total FROM {database}.{table}"
+        )
+        return float(df.total[0])
+
+    def count_total_and_uniques_approx(
+        self, database, table, column, partition_column, watermark=None, sketch=None
+    ) -> dict:
+        """
+        Description
+        -----------
+        Same as BigQuery.count_total_and_uniques_approx, with the unique
+        number of rows from DuckDB's approx_count_distinct. DuckDB has no
+        mergeable sketches, so the whole table is read every time and no
+        sketch or watermark is returned.
+        """
+        query = f"""
+            SELECT
+                COUNT({column}) AS total,
+                approx_count_distinct({column}) AS unique
+            FROM {database}.{table}
+        """
+        df = self._query_job_dataframe(query)
+        result = {
+            "total": float(df.total[0]),
+            "unique": float(df.unique[0]),
+            "sketch": None,
+            "watermark": None,
+        }
+        return result
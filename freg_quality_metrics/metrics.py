@@ -1,106 +1,370 @@
+import contextlib
+import contextvars
 import datetime
 import logging
+import os
+import resource
+import threading
+from typing import Callable, NamedTuple
 
 import prometheus_client
 from flask import Flask
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 
-from .bigquery import BigQuery
-from .config import GCP_PROJECT, METRIC_PREFIX
+from . import budget, exposition, incremental, registry, results, store
+from .bigquery import HLL_RELATIVE_ERROR, BigQuery
+from .config import (
+    BACKEND,
+    BUDGET_CYCLE_MINUTES,
+    BYTES_PER_CYCLE,
+    BYTES_PER_DAY,
+    CHANGE_DETECTION,
+    DISTINCT_COUNTS,
+    GCP_PROJECTS,
+    GROUP_BY_COUNTS,
+    INCREMENTAL_NULLVALS,
+    LOCAL_DATA_DIR,
+    METRIC_PREFIX,
+    RESULT_FORMAT,
+    SNAPSHOT_PATH,
+    STORAGE_API_MIN_ROWS,
+    STREAM_PAGE_SIZE,
+)
 
 
 logger = logging.getLogger(__name__)
 logger.debug("Logging is configured.")
 
 # Metrics dictionary setup
-graphs = {
-    "freg_metrics_interval": prometheus_client.Gauge(
-        "freg_metrics_interval", "Interval of metrics scheduler (in minutes)"
+graphs = registry.MetricRegistry()
+
+# Statistics of the query jobs run by each job, see _record_query()
+QUERY_SECONDS = prometheus_client.Histogram(
+    f"{METRIC_PREFIX}query_seconds",
+    "Seconds spent in each phase of the queries of a job",
+    ["name", "phase", "project"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+QUERY_BYTES_PROCESSED = prometheus_client.Counter(
+    f"{METRIC_PREFIX}query_bytes_processed",
+    "Bytes processed by the queries of a job",
+    ["name", "project"],
+)
+QUERY_BYTES_BILLED = prometheus_client.Counter(
+    f"{METRIC_PREFIX}query_bytes_billed",
+    "Bytes billed for the queries of a job",
+    ["name", "project"],
+)
+QUERY_SLOT_MILLISECONDS = prometheus_client.Counter(
+    f"{METRIC_PREFIX}query_slot_milliseconds",
+    "Slot milliseconds used by the queries of a job",
+    ["name", "project"],
+)
+QUERY_ROWS = prometheus_client.Counter(
+    f"{METRIC_PREFIX}query_rows",
+    "Rows returned by the queries of a job",
+    ["name", "project"],
+)
+QUERY_CACHE_HITS = prometheus_client.Counter(
+    f"{METRIC_PREFIX}query_cache_hits",
+    "Queries of a job answered from the BigQuery cache",
+    ["name", "project"],
+)
+QUERY_ESTIMATED_BYTES = prometheus_client.Gauge(
+    f"{METRIC_PREFIX}query_estimated_bytes",
+    "Bytes the last query of a job would process, estimated with a dry run",
+    ["name", "project"],
+)
+QUERY_PEAK_PAGE_BYTES = prometheus_client.Gauge(
+    f"{METRIC_PREFIX}query_peak_page_bytes",
+    "Bytes of the largest page of the last query of a job read page by page",
+    ["name", "project"],
+)
+PEAK_MEMORY = prometheus_client.Gauge(
+    f"{METRIC_PREFIX}metrics_peak_memory_bytes",
+    "Peak resident memory of the process since it started",
+)
+PEAK_MEMORY.set_function(
+    # ru_maxrss is in kilobytes on Linux
+    lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    * 1024
+)
+
+# The job the queries of the current thread are run for
+_query_name = contextvars.ContextVar("query_name", default="")
+
+# The project the jobs of the current thread are run for, see for_project()
+_project = contextvars.ContextVar("project", default=GCP_PROJECTS[0])
+
+
+def _record_query(stats) -> None:
+    """Export the bigquery.QueryStats of a query run for _query_name."""
+    labels = {"name": _query_name.get(), "project": _project.get()}
+    QUERY_SECONDS.labels(phase="queue", **labels).observe(stats.queue_seconds)
+    QUERY_SECONDS.labels(phase="execution", **labels).observe(stats.execution_seconds)
+    QUERY_SECONDS.labels(phase="download", **labels).observe(stats.download_seconds)
+    QUERY_BYTES_PROCESSED.labels(**labels).inc(stats.bytes_processed)
+    QUERY_BYTES_BILLED.labels(**labels).inc(stats.bytes_billed)
+    QUERY_SLOT_MILLISECONDS.labels(**labels).inc(stats.slot_millis)
+    QUERY_ROWS.labels(**labels).inc(stats.rows)
+    QUERY_CACHE_HITS.labels(**labels).inc(int(stats.cache_hit))
+    if stats.peak_page_bytes:
+        QUERY_PEAK_PAGE_BYTES.labels(**labels).set(stats.peak_page_bytes)
+    return None
+
+
+def _record_estimate(estimate) -> None:
+    """Export the estimated bytes of a query run for _query_name."""
+    QUERY_ESTIMATED_BYTES.labels(name=_query_name.get(), project=_project.get()).set(
+        estimate
     )
+    return None
+
+
+@contextlib.contextmanager
+def _queries_of(name):
+    """Context manager recording the queries run inside the block under name."""
+    token = _query_name.set(name)
+    try:
+        yield
+    finally:
+        _query_name.reset(token)
+
+
+def _applying(name):
+    """Context manager timing the block as the apply phase of name."""
+    return QUERY_SECONDS.labels(name=name, phase="apply", project=_project.get()).time()
+
+
+@contextlib.contextmanager
+def for_project(project=None):
+    """
+    Context manager running the block for project, or the current project
+    when None: with its backend and state, and its value of the project
+    label on the metrics written.
+    """
+    project = project or _project.get()
+    token = _project.set(project)
+    try:
+        with registry.labelled(project=project):
+            yield project
+    finally:
+        _project.reset(token)
+
+
+# Bytes the queries of all projects may process, see budget.py
+BUDGET = None
+if BYTES_PER_CYCLE is not None or BYTES_PER_DAY is not None:
+    BUDGET = budget.ByteBudget(
+        BYTES_PER_CYCLE, BYTES_PER_DAY, cycle_seconds=BUDGET_CYCLE_MINUTES * 60
+    )
+
+
+def _backend(project):
+    """Internal function. The backend computing the metrics of project."""
+    if BACKEND == "local":
+        from .local import LocalBackend
+
+        data_dir = LOCAL_DATA_DIR
+        if len(GCP_PROJECTS) > 1:
+            data_dir = os.path.join(LOCAL_DATA_DIR, project)
+        return LocalBackend(data_dir, result_format=RESULT_FORMAT, gcp_project=project)
+    return BigQuery(
+        gcp_project=project,
+        result_format=RESULT_FORMAT,
+        storage_api_min_rows=STORAGE_API_MIN_ROWS,
+        on_query=_record_query,
+        on_estimate=_record_estimate,
+        budget=BUDGET,
+    )
+
+
+# The backend of each project in GCP_PROJECTS
+BACKENDS = {project: _backend(project) for project in GCP_PROJECTS}
+
+
+def backend():
+    """The backend of the current project, see for_project()."""
+    return BACKENDS[_project.get()]
+
+
+# Fingerprint of the source table at the last successful run of each job,
+# keyed by (project, job name)
+_fingerprints = {}
+
+# History of qa_nullvalue_columns for dsfsit_qa_nullvals_incremental, total
+# and unique counts of the columns in DISTINCT_COUNTS, and the latest record
+# per person of the columns in GROUP_BY_COUNTS, per project
+NULLVALS = {project: incremental.NullvalueHistory() for project in GCP_PROJECTS}
+DISTINCT = {project: incremental.DistinctCounts() for project in GCP_PROJECTS}
+LATEST = {
+    project: {column: incremental.LatestRecords() for column in GROUP_BY_COUNTS}
+    for project in GCP_PROJECTS
 }
 
-BQ = BigQuery(gcp_project=GCP_PROJECT)
+# Last good result of each job, for warm restarts
+STORE = store.ResultStore(SNAPSHOT_PATH) if SNAPSHOT_PATH else None
 
+# Set once metrics have been loaded, from STORE or from a first refresh.
+# Recorded in every snapshot, so that followers sharing the snapshots of
+# this process only report ready once it is.
+READY = exposition.COLLECTOR.ready
 
-def configure_prometheus(app: Flask, **kwargs):
+
+def _gauge(metric_key, documentation, labelnames) -> prometheus_client.Gauge:
+    """Get the Gauge metric_key from graphs, creating it on first use."""
+    return graphs.get_or_create(
+        metric_key,
+        lambda: prometheus_client.Gauge(metric_key, documentation, labelnames),
+    )
+
+
+def _info(metric_key, documentation, labelnames) -> prometheus_client.Info:
+    """Get the Info metric_key from graphs, creating it on first use."""
+    return graphs.get_or_create(
+        metric_key,
+        lambda: prometheus_client.Info(metric_key, documentation, labelnames),
+    )
+
+
+def _counter(metric_key, documentation, labelnames) -> prometheus_client.Counter:
+    """Get the Counter metric_key from graphs, creating it on first use."""
+    return graphs.get_or_create(
+        metric_key,
+        lambda: prometheus_client.Counter(metric_key, documentation, labelnames),
+    )
+
+
+def configure_prometheus(app: Flask, before_scrape=None, **kwargs):
 
     logger.debug("Setting up prometheus client.")
     app.wsgi_app = DispatcherMiddleware(
-        app.wsgi_app, {"/metrics": prometheus_client.make_wsgi_app()}
+        app.wsgi_app,
+        {"/metrics": exposition.make_wsgi_app(before_scrape=before_scrape)},
     )
-    graphs["freg_metrics_interval"].set(kwargs["minutes"])
+    # The interval of each job is exported by the scheduler, see intervals.py
+    exposition.COLLECTOR.publish()
+
+
+@contextlib.contextmanager
+def refresh():
+    """
+    Context manager around the writing of metrics from one refresh. Scrapes
+    see either none or all of the values written inside the block, since
+    the snapshot served on /metrics is only published when it exits.
+    """
+    with exposition.lock:
+        yield
+    exposition.COLLECTOR.publish()
 
 
 def metrics_timestamp() -> None:
-    logger.debug(f"Submitting metrics_timestamp")
-    start = datetime.datetime.now()
-    metrics_count_calls()
-    metric_key = f"{METRIC_PREFIX}metrics_timestamp"
+    run_job("metrics_timestamp")
+    return None
 
-    result = BQ.latest_timestamp_from_datetime(
-        "kvalitet", "metrics_count_total_and_distinct", "tidspunkt"
-    )
-    if metric_key not in graphs:
-        graphs[metric_key] = prometheus_client.Info(
-            metric_key,
-            (
-                "Timestamp for when metrics was last updated in Bigquery.kvalitet "
-                "aggregated tables"
-            ),
-        )
-    graphs[metric_key].info(result)
 
-    end = datetime.datetime.now()
-    metrics_time_used(
-        "metrics_timestamp",
-        "kvalitet",
-        "metrics_count_total_and_distinct",
-        "tidspunkt",
-        start,
-        end,
+def set_metrics_timestamp(df) -> None:
+    metric_key = f"{METRIC_PREFIX}metrics_timestamp"
+
+    result = {"timestamp": results.values(df, "latest_timestamp")[0]}
+    metric = _info(
+        metric_key,
+        (
+            "Timestamp for when metrics was last updated in Bigquery.kvalitet "
+            "aggregated tables"
+        ),
+        ["project"],
     )
+    registry.child(metric).info(result)
     return None
 
 
 def metrics_count_calls() -> None:
     metric_key = f"{METRIC_PREFIX}metrics_calls_to_bigquery"
-    if metric_key not in graphs:
-        graphs[metric_key] = prometheus_client.Gauge(
-            metric_key, "The total number of calls to BigQuery."
-        )
-    graphs[metric_key].inc()
+    metric = _gauge(metric_key, "The total number of calls to BigQuery.", ["project"])
+    registry.child(metric).inc()
+    return None
+
+
+def metrics_count_skipped(metricname) -> None:
+    metric = _counter(
+        f"{METRIC_PREFIX}metrics_refresh_skipped",
+        "Refreshes skipped since the source table had not changed.",
+        ["name", "project"],
+    )
+    registry.child(metric, name=metricname).inc()
+    return None
+
+
+def metrics_count_over_budget(metricname, action) -> None:
+    metric = _counter(
+        f"{METRIC_PREFIX}metrics_refresh_over_budget",
+        "Refreshes over the byte budget, postponed or downgraded.",
+        ["name", "action", "project"],
+    )
+    registry.child(metric, name=metricname, action=action).inc()
     return None
 
 
+def changed_jobs(names, project=None) -> dict:
+    """
+    Description
+    -----------
+    Find which of the jobs in names have a source table in project
+    that changed since their last successful run.
+
+    Return
+    ------
+    dict: keys - name of each changed job,
+          values - the current fingerprint of its source table.
+    """
+    with for_project(project) as project:
+        # Jobs without a single source table in kvalitet are always run
+        fingerprints = {None: None}
+        for table in {JOBS[name].table for name in names} - {None}:
+            try:
+                fingerprints[table] = backend().table_fingerprint("kvalitet", table)
+            except Exception:
+                # Unknown state, so the jobs reading the table are run
+                logger.warning(
+                    f"Could not read metadata of {project}.kvalitet.{table}."
+                )
+                fingerprints[table] = None
+
+        changed = {}
+        for name in names:
+            fingerprint = fingerprints[JOBS[name].table]
+            if fingerprint is None or fingerprint != _fingerprints.get((project, name)):
+                changed[name] = fingerprint
+            else:
+                logger.debug(f"Skipping {name}, kvalitet.{JOBS[name].table} unchanged.")
+                metrics_count_skipped(name)
+    return changed
+
+
 def metrics_time_used(
     metricname,
     database,
     table,
     column,
-    start=datetime.datetime.now(),
-    end=datetime.datetime.now(),
+    start=None,
+    end=None,
 ) -> None:
     metric_key = f"{METRIC_PREFIX}metrics_time_used"
-    if metric_key not in graphs:
-        graphs[metric_key] = prometheus_client.Gauge(
-            metric_key,
-            "Time used to generate metric",
-            ["name", "database", "table", "column"],
-        )
-        graphs[metric_key].labels(
-            name=f"{metricname}",
-            database=f"{database}",
-            table=f"{table}",
-            column=f"{column}",
-        )  # Initialize label
+    metric = _gauge(
+        metric_key,
+        "Time used to generate metric",
+        ["name", "database", "table", "column", "project"],
+    )
 
+    # Defaults are set here, a default in the signature is only evaluated
+    # once, when the module is imported
+    start = start or datetime.datetime.now()
+    end = end or datetime.datetime.now()
     diff = end - start
     sec = diff.total_seconds()
-    graphs[metric_key].labels(
-        name=f"{metricname}",
-        database=f"{database}",
-        table=f"{table}",
-        column=f"{column}",
+    registry.child(
+        metric, name=metricname, database=database, table=table, column=column
     ).set(sec)
     return None
 
@@ -113,54 +377,116 @@ def preagg_total_and_distinct() -> None:
 
     Then, these metrics are stored as prometheus Gauges within the graph's dictionary.
     """
-    # Read from BigQuery
-    logger.debug("Submitting count_total_and_uniques query to BigQuery.")
-    start = datetime.datetime.now()
-    metrics_count_calls()
-    df = BQ.pre_aggregate_total_and_uniques()
-
-    # Create and set Prometheus variables
-    metric_total = f"{METRIC_PREFIX}total_rows"
-    metric_unique = f"{METRIC_PREFIX}unique_rows"
-
-    for i, row in df.iterrows():
-        if metric_total not in graphs:
-            graphs[metric_total] = prometheus_client.Gauge(
-                metric_total,
-                f"The total number of rows",
-                ["database", "table", "column"],
+    run_job("preagg_total_and_distinct")
+    return None
+
+
+def set_total_and_distinct(df, kind="") -> None:
+    # Create and set Prometheus variables, with kind in the names of the
+    # metrics of other jobs than preagg_total_and_distinct
+    metric_total = _gauge(
+        f"{METRIC_PREFIX}{kind}total_rows",
+        f"The total number of rows",
+        ["database", "table", "column", "project"],
+    )
+    metric_unique = _gauge(
+        f"{METRIC_PREFIX}{kind}unique_rows",
+        f"The unique number of rows",
+        ["database", "table", "column", "project"],
+    )
+    labels = {"database": "datasett", "table": "tabell", "column": "variabel"}
+    registry.set_from_frame(metric_total, df, labels, "totalt")
+    registry.set_from_frame(metric_unique, df, labels, "distinkte")
+    return None
+
+
+def fetch_distinct_counts():
+    """
+    Count the total and unique number of rows of the columns in
+    DISTINCT_COUNTS. Approximate counts continue from the sketch and
+    watermark kept in DISTINCT, so only rows added since the last count are
+    read.
+    """
+    import pandas
+
+    rows = []
+    for (database, table, column), (mode, partition_column) in DISTINCT_COUNTS.items():
+        if mode == "approx":
+            total, _, _, sketch, watermark = _state(DISTINCT).get(
+                database, table, column
             )
-            graphs[metric_total].labels(
-                database=f"{row.datasett}",
-                table=f"{row.tabell}",
-                column=f"{row.variabel}",
-            )  # Initialize label
-        graphs[metric_total].labels(
-            database=f"{row.datasett}", table=f"{row.tabell}", column=f"{row.variabel}"
-        ).set(row.totalt)
-        if metric_unique not in graphs:
-            graphs[metric_unique] = prometheus_client.Gauge(
-                metric_unique,
-                f"The unique number of rows",
-                ["database", "table", "column"],
+            if sketch is None:
+                # First count, or the column was counted exactly before
+                total, watermark = 0, None
+            result = backend().count_total_and_uniques_approx(
+                database, table, column, partition_column, watermark, sketch
             )
-            graphs[metric_unique].labels(
-                database=f"{row.datasett}",
-                table=f"{row.tabell}",
-                column=f"{row.variabel}",
-            )  # Initialize label
-        graphs[metric_unique].labels(
-            database=f"{row.datasett}", table=f"{row.tabell}", column=f"{row.variabel}"
-        ).set(row.distinkte)
-
-    end = datetime.datetime.now()
-    metrics_time_used(
-        f"preagg_total_and_distinct",
-        "kvalitet",
-        "metrics_count_total_and_distinct",
-        "",
-        start,
-        end,
+            rows.append(
+                (
+                    database,
+                    table,
+                    column,
+                    total + result["total"],
+                    result["unique"],
+                    HLL_RELATIVE_ERROR,
+                    result["sketch"],
+                    result["watermark"],
+                )
+            )
+        else:
+            result = backend().count_total_and_uniques(database, table, column)
+            rows.append(
+                (database, table, column, result["total"], result["unique"], 0.0)
+                + (None, None)
+            )
+    return pandas.DataFrame(rows, columns=incremental.DistinctCounts.COLUMNS)
+
+
+def fetch_distinct_counts_metadata():
+    """
+    Downgrade of fetch_distinct_counts() for refreshes over the byte budget:
+    the total number of rows of each table from its metadata, which costs no
+    query, and the unique number of rows of the last count. The sketch and
+    watermark are dropped, since the metadata total already has the rows
+    after the watermark, so the next approximate count reads the whole
+    table again instead of adding them twice.
+    """
+    import pandas
+
+    counts = _state(DISTINCT)
+    rows = []
+    for database, table, column in DISTINCT_COUNTS:
+        _, unique, relative_error, _, _ = counts.get(database, table, column)
+        if (database, table, column) not in counts.counts:
+            # Never counted, so the unique number of rows is unknown
+            unique = float("nan")
+        total = backend().count_rows_from_metadata(database, table)
+        rows.append(
+            (database, table, column, total, unique, relative_error) + (None, None)
+        )
+    return pandas.DataFrame(rows, columns=incremental.DistinctCounts.COLUMNS)
+
+
+def set_distinct_counts(rows) -> None:
+    """
+    Keep the counts in DISTINCT and set freg_counted_total_rows and
+    freg_counted_unique_rows from them, with the relative standard error of
+    each unique count. These are apart from freg_total_rows and
+    freg_unique_rows of preagg_total_and_distinct, which may have the same
+    columns.
+    """
+    _state(DISTINCT).update(rows)
+    set_total_and_distinct(rows, kind="counted_")
+    metric_error = _gauge(
+        f"{METRIC_PREFIX}counted_unique_rows_relative_error",
+        "The relative standard error of freg_counted_unique_rows, 0 for exact counts",
+        ["database", "table", "column", "project"],
+    )
+    registry.set_from_frame(
+        metric_error,
+        rows,
+        {"database": "datasett", "table": "tabell", "column": "variabel"},
+        "relativ_feil",
     )
     return None
 
@@ -174,375 +500,706 @@ def preagg_valid_and_invalid_idents() -> None:
     * 'control' (invalid control digits, i.e., the two last digits).
     * 'digit' (invalid first digit, fnr > 3, dnr < 4)
     """
-    # Read from BigQuery
-    logger.debug("Submitting valid_and_invalid_fnr query to BigQuery.")
-    start = datetime.datetime.now()
-    metrics_count_calls()
-    df = BQ.pre_aggregated_valid_fnr()
-
-    # Create and set Prometheus variables
-    metric_total = f"{METRIC_PREFIX}ident_total"
-    metric_format = f"{METRIC_PREFIX}ident_invalid_format"
-    metric_digit = f"{METRIC_PREFIX}ident_invalid_first_digit"
-    metric_date = f"{METRIC_PREFIX}ident_invalid_date"
-    metric_control = f"{METRIC_PREFIX}ident_invalid_control_digit"
-
-    for i, row in df.iterrows():
-        if metric_total not in graphs:
-            graphs[metric_total] = prometheus_client.Gauge(
-                metric_total,
-                f"The number of records with identa by type ",
-                ["database", "table", "column", "type"],
-            )
-            graphs[metric_total].labels(
-                database=f"{row.datasett}",
-                table=f"{row.tabell}",
-                column=f"{row.variabel}",
-                type="fnr",
-            )  # Initialize label
-        if metric_format not in graphs:
-            graphs[metric_format] = prometheus_client.Gauge(
-                metric_format,
-                f"Idents with invalid format ",
-                ["database", "table", "column", "type"],
-            )
-            graphs[metric_format].labels(
-                database=f"{row.datasett}",
-                table=f"{row.tabell}",
-                column=f"{row.variabel}",
-                type="fnr",
-            )  # Initialize label
-        if metric_digit not in graphs:
-            graphs[metric_digit] = prometheus_client.Gauge(
-                metric_digit,
-                f"Idents with invalid first digit ",
-                ["database", "table", "column", "type"],
-            )
-            graphs[metric_digit].labels(
-                database=f"{row.datasett}",
-                table=f"{row.tabell}",
-                column=f"{row.variabel}",
-                type="fnr",
-            )  # Initialize label
-        if metric_date not in graphs:
-            graphs[metric_date] = prometheus_client.Gauge(
-                metric_date,
-                f"Idents with invalide date ",
-                ["database", "table", "column", "type"],
-            )
-            graphs[metric_date].labels(
-                database=f"{row.datasett}",
-                table=f"{row.tabell}",
-                column=f"{row.variabel}",
-                type="fnr",
-            )  # Initialize label
-        if metric_control not in graphs:
-            graphs[metric_control] = prometheus_client.Gauge(
-                metric_control,
-                f"Idents with invalid control digits ",
-                ["database", "table", "column", "type"],
+    run_job("preagg_valid_and_invalid_idents")
+    return None
+
+
+def set_valid_and_invalid_idents(df) -> None:
+    # Create and set Prometheus variables, one gauge per kind of check with
+    # the counts for fnr and dnr as children labelled by type
+    labelnames = ["database", "table", "column", "type", "project"]
+    checks = {
+        "total_count": _gauge(
+            f"{METRIC_PREFIX}ident_total",
+            f"The number of records with identa by type ",
+            labelnames,
+        ),
+        "invalid_format": _gauge(
+            f"{METRIC_PREFIX}ident_invalid_format",
+            f"Idents with invalid format ",
+            labelnames,
+        ),
+        "invalid_first_digit": _gauge(
+            f"{METRIC_PREFIX}ident_invalid_first_digit",
+            f"Idents with invalid first digit ",
+            labelnames,
+        ),
+        "invalid_date": _gauge(
+            f"{METRIC_PREFIX}ident_invalid_date",
+            f"Idents with invalide date ",
+            labelnames,
+        ),
+        "invalid_control": _gauge(
+            f"{METRIC_PREFIX}ident_invalid_control_digit",
+            f"Idents with invalid control digits ",
+            labelnames,
+        ),
+    }
+    labels = {"database": "datasett", "table": "tabell", "column": "variabel"}
+    for check, metric in checks.items():
+        for ident_type in ["fnr", "dnr"]:
+            registry.set_from_frame(
+                metric, df, labels, f"{ident_type}_{check}", type=ident_type
             )
-            graphs[metric_control].labels(
-                database=f"{row.datasett}",
-                table=f"{row.tabell}",
-                column=f"{row.variabel}",
-                type="fnr",
-            )  # Initialize label
-        graphs[metric_total].labels(
-            database=f"{row.datasett}",
-            table=f"{row.tabell}",
-            column=f"{row.variabel}",
-            type="fnr",
-        ).set(row.fnr_total_count)
-        graphs[metric_total].labels(
-            database=f"{row.datasett}",
-            table=f"{row.tabell}",
-            column=f"{row.variabel}",
-            type="dnr",
-        ).set(row.dnr_total_count)
-        graphs[metric_format].labels(
-            database=f"{row.datasett}",
-            table=f"{row.tabell}",
-            column=f"{row.variabel}",
-            type="fnr",
-        ).set(row.fnr_invalid_format)
-        graphs[metric_format].labels(
-            database=f"{row.datasett}",
-            table=f"{row.tabell}",
-            column=f"{row.variabel}",
-            type="dnr",
-        ).set(row.dnr_invalid_format)
-        graphs[metric_digit].labels(
-            database=f"{row.datasett}",
-            table=f"{row.tabell}",
-            column=f"{row.variabel}",
-            type="fnr",
-        ).set(row.fnr_invalid_first_digit)
-        graphs[metric_digit].labels(
-            database=f"{row.datasett}",
-            table=f"{row.tabell}",
-            column=f"{row.variabel}",
-            type="dnr",
-        ).set(row.dnr_invalid_first_digit)
-        graphs[metric_date].labels(
-            database=f"{row.datasett}",
-            table=f"{row.tabell}",
-            column=f"{row.variabel}",
-            type="fnr",
-        ).set(row.fnr_invalid_date)
-        graphs[metric_date].labels(
-            database=f"{row.datasett}",
-            table=f"{row.tabell}",
-            column=f"{row.variabel}",
-            type="dnr",
-        ).set(row.dnr_invalid_date)
-        graphs[metric_control].labels(
-            database=f"{row.datasett}",
-            table=f"{row.tabell}",
-            column=f"{row.variabel}",
-            type="fnr",
-        ).set(row.fnr_invalid_control)
-        graphs[metric_control].labels(
-            database=f"{row.datasett}",
-            table=f"{row.tabell}",
-            column=f"{row.variabel}",
-            type="dnr",
-        ).set(row.dnr_invalid_control)
-
-    end = datetime.datetime.now()
-    metrics_time_used(
-        "preagg_valid_and_invalid_idents",
-        "kvalitet",
-        "metrics_count_valid_fnr_dnr",
-        "",
-        start,
-        end,
-    )
     return None
 
 
 def preagg_group_by_and_count() -> None:
-    logger.debug("Submitting preagg_group_by_and_count query to BigQuery.")
-    start = datetime.datetime.now()
-    metrics_count_calls()
-    metric_key = f"{METRIC_PREFIX}group_by"
-
-    df = BQ.pre_aggregated_count_group_by()
-    for i, row in df.iterrows():
-        if metric_key not in graphs:
-            graphs[metric_key] = prometheus_client.Gauge(
-                metric_key,
-                f"The number of rows by group",
-                ["group", "database", "table", "column"],
-            )
-            graphs[metric_key].labels(
-                group=f"{row.gruppe}",
-                database=f"{row.datasett}",
-                table=f"{row.tabell}",
-                column=f"{row.variabel}",
-            )  # Initialize label
-        graphs[metric_key].labels(
-            group=f"{row.gruppe}",
-            database=f"{row.datasett}",
-            table=f"{row.tabell}",
-            column=f"{row.variabel}",
-        ).set(row.antall)
-
-    end = datetime.datetime.now()
-    metrics_time_used(
-        f"preagg_group_by_and_count",
-        "kvalitet",
-        "metrics_count_group_by",
-        "",
-        start,
-        end,
+    run_job("preagg_group_by_and_count")
+    return None
+
+
+def set_group_by(df, kind="") -> None:
+    # With kind in the name of the metric of other jobs than
+    # preagg_group_by_and_count
+    metric = _gauge(
+        f"{METRIC_PREFIX}{kind}group_by",
+        f"The number of rows by group",
+        ["group", "database", "table", "column", "project"],
+    )
+    registry.set_from_frame(
+        metric,
+        df,
+        {
+            "group": "gruppe",
+            "database": "datasett",
+            "table": "tabell",
+            "column": "variabel",
+        },
+        "antall",
+        fold="group",
     )
     return None
 
 
 def preagg_num_citizenships() -> None:
-    logger.debug("Submitting preagg_num_citizenships query to BigQuery.")
-    start = datetime.datetime.now()
-    metrics_count_calls()
-    metric_key = f"{METRIC_PREFIX}ant_statsborgerskap"
-
-    df = BQ.pre_aggregated_number_of_citizenships()
-    for i, row in df.iterrows():
-        if metric_key not in graphs:
-            graphs[metric_key] = prometheus_client.Gauge(
-                metric_key,
-                f"The number of persons with multiple citizenships",
-                ["group", "database"],
-            )
-            graphs[metric_key].labels(
-                group=f"{row.gruppe}", database=f"{row.datasett}"
-            )  # Initialize label
-        graphs[metric_key].labels(
-            group=f"{row.gruppe}", database=f"{row.datasett}"
-        ).set(row.antall)
-
-    end = datetime.datetime.now()
-    metrics_time_used(
-        f"preagg_num_citizenships",
-        "kvalitet",
-        "metrics_antall_statsborgerskap",
-        "",
-        start,
-        end,
+    run_job("preagg_num_citizenships")
+    return None
+
+
+def set_num_citizenships(df) -> None:
+    metric = _gauge(
+        f"{METRIC_PREFIX}ant_statsborgerskap",
+        f"The number of persons with multiple citizenships",
+        ["group", "database", "project"],
+    )
+    registry.set_from_frame(
+        metric, df, {"group": "gruppe", "database": "datasett"}, "antall"
     )
     return None
 
 
 def group_by_and_count(database, table, column) -> None:
-    # Read from BigQuery
+    # Read from BigQuery, setting the metrics of each page of the result
+    # before the next is read
     logger.debug("Submitting group_by_and_count query to BigQuery.")
     start = datetime.datetime.now()
     metrics_count_calls()
-    result = BQ.group_by_and_count(database=database, table=table, column=column)
+    scope = f"group_by_and_count:{database}.{table}.{column}"
+    with refresh():
+        with registry.cycle(scope), _queries_of("group_by_and_count"):
+            pages = backend().group_by_and_count_pages(
+                database=database,
+                table=table,
+                column=column,
+                page_size=STREAM_PAGE_SIZE,
+            )
+            map_group_by_pages_to_metric(
+                pages=pages, database=database, table=table, column=column
+            )
+
+        end = datetime.datetime.now()
+        metrics_time_used(f"group_by_and_count", database, table, column, start, end)
+    return None
+
 
-    map_group_by_result_to_metric(
-        result=result, database=database, table=table, column=column
+def map_group_by_pages_to_metric(pages, database, table, column) -> None:
+    # Create and set Prometheus variables, from pages of key and occurence
+    # from the largest occurence to the smallest
+    metric = _gauge(
+        f"{METRIC_PREFIX}group_by",
+        f"The number of rows by group",
+        ["group", "database", "table", "column", "project"],
+    )
+    registry.set_from_pages(
+        metric,
+        pages,
+        {"group": "key"},
+        "occurence",
+        fold="group",
+        database=database,
+        table=table,
+        column=column,
     )
+    return None
+
+
+# The columns of the result of group_by_counts, see fetch_group_by_counts()
+GROUP_BY_COUNTS_COLUMNS = [
+    "datasett",
+    "tabell",
+    "variabel",
+    *incremental.LatestRecords.COLUMNS,
+    "watermark",
+]
+
+
+def _concat_group_by_counts(frames):
+    """Internal function. One frame with the GROUP_BY_COUNTS_COLUMNS of frames."""
+    import pandas
+
+    if not frames:
+        return pandas.DataFrame(columns=GROUP_BY_COUNTS_COLUMNS)
+    return pandas.concat(frames, ignore_index=True)[GROUP_BY_COUNTS_COLUMNS]
 
-    end = datetime.datetime.now()
-    metrics_time_used(f"group_by_and_count", database, table, column, start, end)
+
+def fetch_group_by_counts():
+    """
+    Read the latest record per person among the rows added since the last
+    fetch, for each column in GROUP_BY_COUNTS. With STREAM_PAGE_SIZE, they
+    are merged into LATEST page by page instead, and not returned.
+    """
+    frames = []
+    for (database, table, column), watermark_column in GROUP_BY_COUNTS.items():
+        records = _state(LATEST)[(database, table, column)]
+        if STREAM_PAGE_SIZE is not None:
+            _merge_latest_records_pages(records, database, table, column)
+            continue
+        df = backend().latest_records_since(
+            database, table, column, watermark_column, records.watermark
+        )
+        frames.append(df.assign(datasett=database, tabell=table, variabel=column))
+    return _concat_group_by_counts(frames)
+
+
+def _merge_latest_records_pages(records, database, table, column) -> None:
+    """
+    Internal function. Merge the new records of a column in GROUP_BY_COUNTS
+    into records one page of STREAM_PAGE_SIZE persons at a time, instead of
+    returning them, so that only one page is held in memory besides records.
+    The watermark is only moved on once all pages are merged, so a refresh
+    failing half way reads the same rows again the next time.
+    """
+    import pandas
+
+    watermark = None
+    for page in backend().latest_records_since_pages(
+        database,
+        table,
+        column,
+        GROUP_BY_COUNTS[(database, table, column)],
+        records.watermark,
+        STREAM_PAGE_SIZE,
+    ):
+        records.update(page)
+        # The same in every row, the latest of all new rows
+        if not page.empty and not pandas.isna(page.watermark.iloc[0]):
+            watermark = page.watermark.iloc[0]
+    records.advance(watermark)
     return None
 
 
-def map_group_by_result_to_metric(result, database, table, column) -> None:
-    # Create and set Prometheus variables
-    for key, val in result.items():
-        metric_key = f"{METRIC_PREFIX}group_by"
-        if metric_key not in graphs:
-            graphs[metric_key] = prometheus_client.Gauge(
-                metric_key,
-                f"The number of rows by group",
-                ["group", "database", "table", "column"],
-            )
-            graphs[metric_key].labels(
-                group=f"{key}",
-                database=f"{database}",
-                table=f"{table}",
-                column=f"{column}",
-            )  # Initialize label
-        graphs[metric_key].labels(
-            group=f"{key}", database=f"{database}", table=f"{table}", column=f"{column}"
-        ).set(val)
+def group_by_counts_rows(unsaved=False):
+    """
+    The records kept in LATEST, which is all set_group_by_counts() needs,
+    or with unsaved only those not saved to STORE yet.
+    """
+    frames = [
+        records.rows(unsaved).assign(
+            datasett=database,
+            tabell=table,
+            variabel=column,
+            watermark=records.watermark,
+        )
+        for (database, table, column), records in _state(LATEST).items()
+    ]
+    return _concat_group_by_counts(frames)
+
+
+def group_by_counts_saved(rows) -> None:
+    """Record that the records in rows, from group_by_counts_rows(), are saved."""
+    for (database, table, column), records in _state(LATEST).items():
+        saved = rows[
+            (rows.datasett == database)
+            & (rows.tabell == table)
+            & (rows.variabel == column)
+        ]
+        records.mark_saved(saved.ident)
+    return None
+
+
+def set_group_by_counts(rows) -> None:
+    """
+    Merge new records into LATEST, and set freg_latest_group_by from the
+    number of persons per value of each column in GROUP_BY_COUNTS. It is
+    apart from freg_group_by of preagg_group_by_and_count, which may have
+    the same columns.
+    """
+    import pandas
+
+    counts = []
+    for key, records in _state(LATEST).items():
+        new = rows[
+            (rows.datasett == key[0])
+            & (rows.tabell == key[1])
+            & (rows.variabel == key[2])
+        ]
+        watermark = new.watermark.max() if len(new) else None
+        records.update(new, None if pandas.isna(watermark) else watermark)
+        counts += [key + group for group in records.group_counts().items()]
+    set_group_by(
+        pandas.DataFrame(
+            counts, columns=["datasett", "tabell", "variabel", "gruppe", "antall"]
+        ),
+        kind="latest_",
+    )
     return None
 
 
 def preagg_latest_timestamp() -> None:
-    logger.debug(f"Submitting pre_aggregated_latest_timestamp ")
-    start = datetime.datetime.now()
-    metrics_count_calls()
-    metric_key = f"{METRIC_PREFIX}latest_timestamp"
+    run_job("preagg_latest_timestamp")
+    return None
 
-    df = BQ.pre_aggregated_latest_timestamp()
-    for i, row in df.iterrows():
-        if metric_key not in graphs:
-            graphs[metric_key] = prometheus_client.Info(
-                metric_key, "The latest timestamp ", ["database", "table", "column"]
-            )
-            graphs[metric_key].labels(
-                database=f"{row.datasett}",
-                table=f"{row.tabell}",
-                column=f"{row.variabel}",
-            )  # Initialize label
-        result = {"timestamp": row.latest_timestamp}  # Info-metric needs key-value
-        graphs[metric_key].labels(
-            database=f"{row.datasett}", table=f"{row.tabell}", column=f"{row.variabel}"
-        ).info(result)
-
-    end = datetime.datetime.now()
-    metrics_time_used(
-        "preagg_latest_timestamp",
-        "kvalitet",
-        "metrics_latest_timestamp",
-        "",
-        start,
-        end,
+
+def set_latest_timestamp(df) -> None:
+    metric = _info(
+        f"{METRIC_PREFIX}latest_timestamp",
+        "The latest timestamp ",
+        ["database", "table", "column", "project"],
+    )
+    # Info-metric needs key-value
+    registry.info_from_frame(
+        metric,
+        df,
+        {"database": "datasett", "table": "tabell", "column": "variabel"},
+        "latest_timestamp",
+        "timestamp",
     )
     return None
 
 
 def dsfsit_latest_timestamp() -> None:
-    logger.debug(f"Submitting dsfsit_latest_timestamp ")
-    start = datetime.datetime.now()
-    metrics_count_calls()
-    metric_key = f"{METRIC_PREFIX}dsfsit_latest_timestamp"
+    run_job("dsfsit_latest_timestamp")
+    return None
 
-    result = BQ.dsfsit_latest_timestamp()
-    if metric_key not in graphs:
-        graphs[metric_key] = prometheus_client.Info(
-            metric_key,
-            "The latest run of DSF_SITUASJONSUTTAK ",
-        )
-    graphs[metric_key].info(result)
 
-    end = datetime.datetime.now()
-    metrics_time_used(
-        "dsfsit_latest_timestamp", "kvalitet", "qa_nullvalue_columns", "", start, end
-    )
+def set_dsfsit_latest_timestamp(df) -> None:
+    metric_key = f"{METRIC_PREFIX}dsfsit_latest_timestamp"
+
+    result = {"timestamp": results.values(df, "latest_timestamp")[0]}
+    metric = _info(metric_key, "The latest run of DSF_SITUASJONSUTTAK ", ["project"])
+    registry.child(metric).info(result)
     return None
 
 
 def dsfsit_qa_nullvals_latest() -> None:
-    logger.debug(f"Submitting dsfsit_qa_nullvals_latest ")
-    start = datetime.datetime.now()
-    metrics_count_calls()
-    metric_num = f"{METRIC_PREFIX}dsfsit_nullvals_latest"
-    metric_pct = f"{METRIC_PREFIX}dsfsit_nullvals_latest_pct"
-
-    df = BQ.dsfsit_qa_nullvals_latest()
-    for i, row in df.iterrows():
-        if metric_num not in graphs:
-            graphs[metric_num] = prometheus_client.Gauge(
-                metric_num,
-                "DSF_SITUASJONSUTTAK: Num of rows with nullvalues ",
-                ["column"],
-            )
-            graphs[metric_num].labels(column=f"{row.kolonne}")  # Initialize label
-        if metric_pct not in graphs:
-            graphs[metric_pct] = prometheus_client.Gauge(
-                metric_pct,
-                "DSF_SITUASJONSUTTAK: Percentage of rows with nullvalues ",
-                ["column"],
-            )
-            graphs[metric_pct].labels(column=f"{row.kolonne}")  # Initialize label
+    run_job("dsfsit_qa_nullvals_latest")
+    return None
 
-        graphs[metric_num].labels(column=f"{row.kolonne}").set(row.ant_nullvals)
-        graphs[metric_pct].labels(column=f"{row.kolonne}").set(row.pct_nullvals)
 
-    end = datetime.datetime.now()
-    metrics_time_used(
-        "dsfsit_qa_nullvals_latest", "kvalitet", "qa_nullvalue_columns", "", start, end
+def set_dsfsit_qa_nullvals_latest(df) -> None:
+    metric_num = _gauge(
+        f"{METRIC_PREFIX}dsfsit_nullvals_latest",
+        "DSF_SITUASJONSUTTAK: Num of rows with nullvalues ",
+        ["column", "project"],
+    )
+    metric_pct = _gauge(
+        f"{METRIC_PREFIX}dsfsit_nullvals_latest_pct",
+        "DSF_SITUASJONSUTTAK: Percentage of rows with nullvalues ",
+        ["column", "project"],
+    )
+    labels = {"column": "kolonne"}
+    registry.set_from_frame(metric_num, df, labels, "ant_nullvals", fold="column")
+    registry.set_from_frame(
+        metric_pct, df, labels, "pct_nullvals", fold="column", fold_with=max
     )
     return None
 
 
 def dsfsit_qa_nullvals_diff() -> None:
-    logger.debug(f"Submitting dsfsit_qa_nullvals_diff ")
+    run_job("dsfsit_qa_nullvals_diff")
+    return None
+
+
+def set_dsfsit_qa_nullvals_diff(df) -> None:
+    metric_pct = _gauge(
+        f"{METRIC_PREFIX}dsfsit_nullvals_diff_pct",
+        ("DSF_SITUASJONSUTTAK: Rise or drop in percentage of rows with " "nullvalues "),
+        ["column", "project"],
+    )
+    registry.set_from_frame(
+        metric_pct,
+        df,
+        {"column": "kolonne"},
+        "pct_diff_last",
+        fold="column",
+        fold_with=lambda diffs: max(diffs, key=abs),
+    )
+    return None
+
+
+def fetch_dsfsit_qa_nullvals():
+    """Read the rows added to qa_nullvalue_columns since the last fetch."""
+    return backend().dsfsit_qa_nullvals_since(_state(NULLVALS).watermark)
+
+
+def set_dsfsit_qa_nullvals_incremental(rows) -> None:
+    """
+    Add new rows of qa_nullvalue_columns to NULLVALS, and set the metrics of
+    dsfsit_latest_timestamp, dsfsit_qa_nullvals_latest and
+    dsfsit_qa_nullvals_diff from it.
+    """
+    nullvals = _state(NULLVALS)
+    nullvals.update(rows)
+    set_dsfsit_latest_timestamp(nullvals.latest_timestamp())
+    set_dsfsit_qa_nullvals_latest(nullvals.latest())
+    set_dsfsit_qa_nullvals_diff(nullvals.diff())
+    return None
+
+
+def _state(states):
+    """Internal function. The entry of NULLVALS, DISTINCT or LATEST of the current project."""
+    return states[_project.get()]
+
+
+class Job(NamedTuple):
+    """A scheduled job: the pre-aggregated source it reads (see
+    bigquery.PRE_AGGREGATED), the function setting its metrics, and the
+    table/column reported in freg_metrics_time_used. The table is None for
+    jobs without a single source table in kvalitet. Jobs that do not read a
+    pre-aggregated source give a fetch function returning their result.
+    Jobs whose result alone cannot restore their metrics give a state
+    function returning what to save in STORE instead. Jobs whose state grows
+    with a source table give the columns identifying a row of it as
+    state_key; their state function then only returns the rows changed since
+    the last save, which are upserted into the saved rows, and saved is
+    called with them once saved. Jobs with a cheaper variant, for refreshes
+    over the byte budget, give a downgrade function returning its result."""
+
+    source: str
+    apply: Callable
+    table: str
+    column: str = ""
+    fetch: Callable = None
+    state: Callable = None
+    downgrade: Callable = None
+    state_key: list = None
+    saved: Callable = None
+
+
+JOBS = {
+    "preagg_total_and_distinct": Job(
+        "total_and_distinct",
+        set_total_and_distinct,
+        "metrics_count_total_and_distinct",
+    ),
+    "preagg_group_by_and_count": Job(
+        "count_group_by", set_group_by, "metrics_count_group_by"
+    ),
+    "preagg_valid_and_invalid_idents": Job(
+        "valid_fnr", set_valid_and_invalid_idents, "metrics_count_valid_fnr_dnr"
+    ),
+    "preagg_latest_timestamp": Job(
+        "latest_timestamp", set_latest_timestamp, "metrics_latest_timestamp"
+    ),
+    "preagg_num_citizenships": Job(
+        "number_of_citizenships",
+        set_num_citizenships,
+        "metrics_antall_statsborgerskap",
+    ),
+    "dsfsit_latest_timestamp": Job(
+        "dsfsit_latest_timestamp",
+        set_dsfsit_latest_timestamp,
+        "qa_nullvalue_columns",
+    ),
+    "dsfsit_qa_nullvals_latest": Job(
+        "dsfsit_qa_nullvals_latest",
+        set_dsfsit_qa_nullvals_latest,
+        "qa_nullvalue_columns",
+    ),
+    "dsfsit_qa_nullvals_diff": Job(
+        "dsfsit_qa_nullvals_diff",
+        set_dsfsit_qa_nullvals_diff,
+        "qa_nullvalue_columns",
+    ),
+    "metrics_timestamp": Job(
+        "metrics_timestamp",
+        set_metrics_timestamp,
+        "metrics_count_total_and_distinct",
+        "tidspunkt",
+    ),
+    "dsfsit_qa_nullvals_incremental": Job(
+        None,
+        set_dsfsit_qa_nullvals_incremental,
+        "qa_nullvalue_columns",
+        fetch=fetch_dsfsit_qa_nullvals,
+        state=lambda: _state(NULLVALS).rows(),
+    ),
+    "distinct_counts": Job(
+        None,
+        set_distinct_counts,
+        None,
+        fetch=fetch_distinct_counts,
+        state=lambda: _state(DISTINCT).rows(),
+        downgrade=fetch_distinct_counts_metadata,
+    ),
+    "group_by_counts": Job(
+        None,
+        set_group_by_counts,
+        None,
+        fetch=fetch_group_by_counts,
+        state=lambda: group_by_counts_rows(unsaved=True),
+        state_key=["datasett", "tabell", "variabel", "ident"],
+        saved=group_by_counts_saved,
+    ),
+}
+
+# The jobs replaced by dsfsit_qa_nullvals_incremental with INCREMENTAL_NULLVALS
+_NULLVALS_JOBS = [
+    "dsfsit_latest_timestamp",
+    "dsfsit_qa_nullvals_latest",
+    "dsfsit_qa_nullvals_diff",
+]
+
+
+def scheduled_jobs() -> list:
+    """The names of the jobs in JOBS to schedule with the current config."""
+    if INCREMENTAL_NULLVALS:
+        skip = _NULLVALS_JOBS
+    else:
+        skip = ["dsfsit_qa_nullvals_incremental"]
+    if not DISTINCT_COUNTS:
+        skip = skip + ["distinct_counts"]
+    if not GROUP_BY_COUNTS:
+        skip = skip + ["group_by_counts"]
+    return [name for name in JOBS if name not in skip]
+
+
+def run_job(name, project=None):
+    """
+    Description
+    -----------
+    Run one of the jobs in JOBS for project (by default the current one):
+    read its source from BigQuery and set the metrics from the result.
+
+    A job over the byte budget is downgraded if it has a cheaper variant,
+    and else postponed to its next run.
+
+    Return
+    ------
+    True when the job was run, False when it was skipped since its source
+    had not changed, and budget.POSTPONED when it was postponed.
+    """
+    job = JOBS[name]
     start = datetime.datetime.now()
-    metrics_count_calls()
-    metric_pct = f"{METRIC_PREFIX}dsfsit_nullvals_diff_pct"
+    with for_project(project) as project:
+        if CHANGE_DETECTION:
+            changed = changed_jobs([name])
+            if name not in changed:
+                return False
+        else:
+            changed = {name: None}
 
-    df = BQ.dsfsit_qa_nullvals_diff()
-    for i, row in df.iterrows():
-        if metric_pct not in graphs:
-            graphs[metric_pct] = prometheus_client.Gauge(
-                metric_pct,
-                (
-                    "DSF_SITUASJONSUTTAK: Rise or drop in percentage of rows with "
-                    "nullvalues "
-                ),
-                ["column"],
+        logger.debug(f"Submitting {name} query to BigQuery for {project}.")
+        metrics_count_calls()
+        with _queries_of(name):
+            try:
+                if job.fetch is not None:
+                    df = job.fetch()
+                else:
+                    df = backend().pre_aggregated(job.source)
+            except budget.BudgetExceeded as error:
+                if job.downgrade is None:
+                    logger.warning(f"Postponing {name} for {project}: {error}")
+                    metrics_count_over_budget(name, "postponed")
+                    return budget.POSTPONED
+                logger.warning(f"Downgrading {name} for {project}: {error}")
+                metrics_count_over_budget(name, "downgraded")
+                df = job.downgrade()
+        apply_result(name, df, start, changed[name])
+    return True
+
+
+def submit_job(name, project=None):
+    """
+    Start the query job of the job name, reading a pre-aggregated source,
+    for project, without waiting for it to finish. Return the QueryJob, or
+    None when the job is postponed since it is over the byte budget.
+    """
+    with for_project(project) as project:
+        logger.debug(f"Submitting {name} query to BigQuery for {project}.")
+        metrics_count_calls()
+        try:
+            with _queries_of(name):
+                return backend().submit_pre_aggregated(JOBS[name].source)
+        except budget.BudgetExceeded as error:
+            logger.warning(f"Postponing {name} for {project}: {error}")
+            metrics_count_over_budget(name, "postponed")
+            return None
+
+
+def download_result(name, query_job, project=None):
+    """Download the result of a query job started for the job name."""
+    with for_project(project), _queries_of(name):
+        return backend().download(query_job)
+
+
+def apply_result(name, df, start, fingerprint=None, project=None) -> None:
+    """
+    Set the metrics of the job name in project from its result df, for a
+    run started at start on a source table with the given fingerprint.
+    """
+    job = JOBS[name]
+    with for_project(project) as project:
+        with refresh():
+            with registry.cycle(name), _applying(name):
+                job.apply(df)
+
+            end = datetime.datetime.now()
+            metrics_time_used(name, "kvalitet", job.table or "", job.column, start, end)
+            _result_loaded(name, datetime.datetime.now(datetime.timezone.utc))
+
+        _save_result(name, df)
+        if CHANGE_DETECTION:
+            _fingerprints[(project, name)] = fingerprint
+    return None
+
+
+def preagg_batch(project=None):
+    """
+    Description
+    -----------
+    Run all scheduled jobs reading a pre-aggregated source with a single
+    query job, so that one refresh cycle of a project costs one round trip
+    to BigQuery and all its metrics come from the same point in time. With
+    change detection, only the jobs whose source table changed are included.
+
+    Return
+    ------
+    True when the jobs were run, False when none was since no source had
+    changed, and budget.POSTPONED when the batch was postponed since it is
+    over the byte budget.
+    """
+    start = datetime.datetime.now()
+    names = [name for name in scheduled_jobs() if JOBS[name].fetch is None]
+    with for_project(project) as project:
+        if CHANGE_DETECTION:
+            changed = changed_jobs(names)
+            names = list(changed)
+            if not names:
+                return False
+
+        logger.debug(f"Submitting preagg_batch query to BigQuery for {project}.")
+        metrics_count_calls()
+        try:
+            with _queries_of("preagg_batch"):
+                frames = backend().pre_aggregated_batch(
+                    [JOBS[name].source for name in names]
+                )
+        except budget.BudgetExceeded as error:
+            logger.warning(f"Postponing preagg_batch for {project}: {error}")
+            metrics_count_over_budget("preagg_batch", "postponed")
+            return budget.POSTPONED
+        with refresh():
+            for name in names:
+                with registry.cycle(name), _applying(name):
+                    JOBS[name].apply(frames[JOBS[name].source])
+
+            end = datetime.datetime.now()
+            metrics_time_used("preagg_batch", "kvalitet", "", "", start, end)
+            for name in names:
+                _result_loaded(name, datetime.datetime.now(datetime.timezone.utc))
+
+        for name in names:
+            _save_result(name, frames[JOBS[name].source])
+
+        if CHANGE_DETECTION:
+            _fingerprints.update(
+                {(project, name): fingerprint for name, fingerprint in changed.items()}
             )
-            graphs[metric_pct].labels(column=f"{row.kolonne}")  # Initialize label
+    return True
 
-        graphs[metric_pct].labels(column=f"{row.kolonne}").set(row.pct_diff_last)
 
-    end = datetime.datetime.now()
-    metrics_time_used(
-        "dsfsit_qa_nullvals_diff", "kvalitet", "qa_nullvalue_columns", "", start, end
+def _result_loaded(name, fetched_at) -> None:
+    """
+    Internal function. Record that the metrics of job name in the current
+    project now come from a result fetched at fetched_at, which makes the
+    app ready. Called inside refresh(), so that both are published with the
+    metrics. The age of the result is time() minus the exported timestamp,
+    since a value computed here would be frozen until the next publish.
+    """
+    metric = _gauge(
+        f"{METRIC_PREFIX}metrics_fetched_timestamp_seconds",
+        "When the result behind the metrics of a job was fetched from BigQuery",
+        ["name", "project"],
     )
+    registry.child(metric, name=name).set(fetched_at.timestamp())
+    READY.set()
+    return None
+
+
+def _store_key(name) -> str:
+    """Internal function. The name the result of job name is saved under."""
+    return f"{_project.get()}/{name}"
+
+
+def _save_result(name, df) -> None:
+    """Internal function. Save the result of job name to STORE, if configured."""
+    if STORE is None:
+        return None
+    job = JOBS[name]
+    try:
+        state = job.state() if job.state is not None else df
+        STORE.save(_store_key(name), state, key=job.state_key)
+        if job.saved is not None:
+            job.saved(state)
+    except Exception:
+        # The metrics are set, only a warm restart would miss this result
+        logger.exception(f"Could not save the result of {name}.")
+    return None
+
+
+def load_saved_results() -> None:
+    """
+    Set the metrics of the scheduled jobs of every project from the results
+    saved in STORE, so that a restarted app serves the last known values
+    right away.
+    """
+    if STORE is None:
+        return None
+    saved = STORE.load()
+    for project in GCP_PROJECTS:
+        with for_project(project):
+            for name in scheduled_jobs():
+                if _store_key(name) not in saved:
+                    continue
+                saved_at, df = saved[_store_key(name)]
+                try:
+                    with refresh():
+                        with registry.cycle(name):
+                            JOBS[name].apply(df)
+                        _result_loaded(name, saved_at)
+                except Exception:
+                    logger.exception(
+                        f"Could not load the saved result of {name} for {project}."
+                    )
+    return None
+
+
+def estimate_costs() -> None:
+    """
+    Estimate the bytes processed by the queries of the scheduled jobs of
+    every project with dry runs, exported as freg_query_estimated_bytes.
+    Queries of other jobs are estimated when they are first run.
+    """
+    for project in GCP_PROJECTS:
+        with for_project(project):
+            for name in scheduled_jobs():
+                if JOBS[name].source is None:
+                    continue
+                try:
+                    with _queries_of(name):
+                        backend().estimate_pre_aggregated(JOBS[name].source)
+                except Exception:
+                    logger.exception(f"Could not estimate {name} for {project}.")
     return None
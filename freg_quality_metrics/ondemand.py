@@ -0,0 +1,201 @@
+"""
+Refreshes triggered by scrapes. With config.MAX_STALENESS_SECONDS set, a
+scrape of /metrics finding a job not refreshed for that long starts a
+refresh of it, and waits for it up to config.SCRAPE_WAIT_SECONDS before
+serving the metrics, or less when the scrape timeout Prometheus sends is
+shorter. Scrapes finding all jobs fresh are served right away.
+
+All refreshes of a job, scheduled or triggered, go through FLIGHTS, so that
+a refresh asked for while one of the same job is running waits for that one
+and gets its outcome, instead of starting another query job. Triggered
+refreshes run in the pool of the scheduler or the engine, under the same
+limit of concurrent jobs as the scheduled ones.
+"""
+import concurrent.futures
+import logging
+import threading
+import time
+
+import prometheus_client
+
+from .config import MAX_STALENESS_SECONDS, METRIC_PREFIX, SCRAPE_WAIT_SECONDS
+
+
+logger = logging.getLogger(__name__)
+logger.debug("Logging is configured.")
+
+SCRAPE_REFRESHES = prometheus_client.Counter(
+    f"{METRIC_PREFIX}metrics_scrape_refreshes",
+    "Refreshes of a job triggered by a scrape finding its metrics stale.",
+    ["name", "project"],
+)
+
+
+class SingleFlight:
+    """
+    Calls by key, where a call made while another with the same key is in
+    flight waits for that one and gets its result (or exception) instead of
+    running again.
+    """
+
+    def __init__(self):
+        # key -> concurrent.futures.Future of the call in flight
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key) -> tuple:
+        """
+        Description
+        -----------
+        Join the call with key in flight, or start one. The caller starting
+        it must end it with land().
+
+        Return
+        ------
+        tuple: (future of the call, whether the caller started it)
+        """
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                return future, False
+            future = self._flights[key] = concurrent.futures.Future()
+        return future, True
+
+    def land(self, key, result=None, error=None) -> None:
+        """End the call with key, passing its result or error to those waiting."""
+        with self._lock:
+            future = self._flights.pop(key)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+        return None
+
+
+FLIGHTS = SingleFlight()
+
+# When each job (by JobInterval.key) last finished a refresh without error,
+# from time.monotonic(), and when a scrape last triggered a refresh of it
+_refreshed_at = {}
+_triggered_at = {}
+
+# The refreshes scrapes may trigger, as (key, function, job name, project),
+# see configure()
+_refreshes = []
+
+# Runs the refreshes triggered by scrapes, the pool of the scheduler or the
+# engine, see configure()
+_executor = None
+
+# Seconds of the scrape timeout left for serving the metrics after the wait
+SCRAPE_TIMEOUT_MARGIN_SECONDS = 0.5
+
+
+def land(key, result=None, error=None) -> None:
+    """End the refresh of the job with key started with FLIGHTS.join()."""
+    if error is None:
+        _refreshed_at[key] = time.monotonic()
+    FLIGHTS.land(key, result, error)
+    return None
+
+
+def configure(refreshes, executor) -> None:
+    """
+    Let scrapes trigger refreshes, given as (function, job name, project)
+    like scheduler.scheduled(), where function(project) refreshes the job.
+    They run with executor.submit(), in the pool of the scheduler or engine.
+    The jobs count as refreshed now, so that their first runs keep the
+    spread of STAGGER_SECONDS instead of all running on the first scrape.
+    """
+    global _executor
+    _executor = executor
+    _refreshes[:] = [
+        (f"{project}/{name}", function, name, project)
+        for function, name, project in refreshes
+    ]
+    now = time.monotonic()
+    for key, *_ in _refreshes:
+        _refreshed_at.setdefault(key, now)
+    return None
+
+
+def _stale(max_staleness: float) -> list:
+    """
+    Internal function. The refreshes not run for max_staleness seconds,
+    leaving out those a scrape has triggered within that time, e.g. of a
+    job failing on every run.
+    """
+    now = time.monotonic()
+    return [
+        refresh
+        for refresh in _refreshes
+        if now - _refreshed_at.get(refresh[0], -float("inf")) > max_staleness
+        and now - _triggered_at.get(refresh[0], -float("inf")) > max_staleness
+    ]
+
+
+def execute(key, function, project) -> None:
+    """
+    Run the refresh of the job with key (see JobInterval.key) started with
+    FLIGHTS.join(), by calling function(project), logging errors, and end it.
+    """
+    try:
+        result = function(project)
+    except Exception as error:
+        logger.exception(f"Refresh of {key} failed.")
+        land(key, error=error)
+        return None
+    land(key, result)
+    return None
+
+
+def refresh_stale(
+    max_staleness=MAX_STALENESS_SECONDS, wait_seconds=SCRAPE_WAIT_SECONDS
+) -> None:
+    """
+    Description
+    -----------
+    Called before serving a scrape. Start a refresh of every job not
+    refreshed for max_staleness seconds, joining the refreshes of them
+    already in flight, and wait up to wait_seconds for them to finish. The
+    scrape then serves whatever has been published by then.
+    """
+    if max_staleness is None or not _refreshes:
+        return None
+    futures = []
+    for key, function, name, project in _stale(max_staleness):
+        _triggered_at[key] = time.monotonic()
+        future, started = FLIGHTS.join(key)
+        if started:
+            logger.info(f"Refreshing {key}, stale on scrape.")
+            SCRAPE_REFRESHES.labels(name=name, project=project).inc()
+            _executor.submit(execute, key, function, project)
+        futures.append(future)
+    if futures:
+        concurrent.futures.wait(futures, timeout=wait_seconds)
+    return None
+
+
+def scrape_wait_seconds(environ, wait_seconds=SCRAPE_WAIT_SECONDS) -> float:
+    """
+    Description
+    -----------
+    How long a scrape with the WSGI environ may wait for refreshes: at most
+    wait_seconds, and short of the scrape timeout Prometheus sends in the
+    X-Prometheus-Scrape-Timeout-Seconds header, if any.
+    """
+    timeout = environ.get("HTTP_X_PROMETHEUS_SCRAPE_TIMEOUT_SECONDS")
+    if timeout is None:
+        return wait_seconds
+    try:
+        timeout = float(timeout)
+    except ValueError:
+        logger.warning(f"Invalid scrape timeout {timeout!r}, ignored.")
+        return wait_seconds
+    return max(0.0, min(wait_seconds, timeout - SCRAPE_TIMEOUT_MARGIN_SECONDS))
+
+
+def before_scrape(environ) -> None:
+    """Called before serving the scrape with the WSGI environ, see refresh_stale()."""
+    refresh_stale(wait_seconds=scrape_wait_seconds(environ))
+    return None
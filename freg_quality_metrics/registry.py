@@ -0,0 +1,355 @@
+import collections
+import contextlib
+import contextvars
+import itertools
+import logging
+import threading
+
+import prometheus_client
+
+from . import results
+from .config import (
+    CARDINALITY_LIMIT,
+    CARDINALITY_LIMITS,
+    EVICT_AFTER_CYCLES,
+    GCP_PROJECTS,
+    METRIC_PREFIX,
+)
+
+
+logger = logging.getLogger(__name__)
+logger.debug("Logging is configured.")
+
+# Label children per metric, keyed by the tuple of label values. Looking a
+# child up here is a single dict lookup, instead of the label validation and
+# string conversion done by prometheus_client on every .labels() call.
+# Two threads creating the same child both get the one prometheus_client
+# keeps, so the cache needs no lock of its own.
+_children = {}
+
+# Refreshes are grouped in cycles per scope (usually a job name). For every
+# child written in a cycle, _written holds the scope and the generation of
+# that cycle, so children a scope stops writing can be found and evicted.
+# The cycle is kept per context, so that children written by other threads
+# meanwhile, e.g. counters of the calls of a job, are never tagged with it.
+# _written is only changed under _cycle_lock, which a cycle holds.
+_written = {}
+_generations = {}
+_cycle = contextvars.ContextVar("cycle", default=None)
+_cycle_lock = threading.RLock()
+
+# Label values shared by all children written in the current context, used
+# by the metrics having those labels, see labelled()
+_context_labels = contextvars.ContextVar(
+    "context_labels", default={"project": GCP_PROJECTS[0]}
+)
+
+SERIES = prometheus_client.Gauge(
+    f"{METRIC_PREFIX}metrics_series",
+    "The number of live label series per metric family.",
+    ["family"],
+)
+SERIES_EVICTED = prometheus_client.Counter(
+    f"{METRIC_PREFIX}metrics_series_evicted",
+    "Label series removed since no refresh had written them for a while.",
+    ["family"],
+)
+CARDINALITY_OVERFLOW = prometheus_client.Gauge(
+    f"{METRIC_PREFIX}metrics_cardinality_overflow",
+    "Label values folded into 'other' in the last refresh of a metric family.",
+    ["family"],
+)
+
+
+class MetricRegistry(dict):
+    """
+    Metrics by name, shared by the jobs of the scheduler. Reading an existing
+    metric takes no lock; creating one is done under a lock, so that two jobs
+    needing the same new metric never both register it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+
+    def get_or_create(self, metric_key, factory):
+        """
+        Description
+        -----------
+        Get the metric metric_key, calling factory() to create it if it does
+        not exist yet.
+        """
+        metric = self.get(metric_key)
+        if metric is None:
+            with self._lock:
+                metric = self.get(metric_key)
+                if metric is None:
+                    metric = self[metric_key] = factory()
+        return metric
+
+
+def _children_of(metric, columns: dict):
+    """
+    Description
+    -----------
+    Internal function. Yield the child of metric for each row, creating and
+    caching children that have not been seen before.
+
+    Parameters
+    ----------
+    columns: dict with label name as key and an iterable of the label value
+        of each row as value. Labels of the context (see labelled()) that
+        are not in columns are added.
+    """
+    # Children are keyed by their label values in the order of the label
+    # names of the metric, like prometheus_client does, so that the key can
+    # be passed on to .labels() and .remove() as it is.
+    columns = {
+        **{
+            name: itertools.repeat(value)
+            for name, value in _context_labels.get().items()
+        },
+        **columns,
+    }
+    children = _children.setdefault(metric, {})
+    cycle = _cycle.get()
+    written = _written.setdefault(metric, {}) if cycle is not None else None
+    for key in zip(*(columns[name] for name in metric._labelnames)):
+        child = children.get(key)
+        if child is None:
+            child = children[key] = metric.labels(*key)
+        if cycle is not None:
+            written[key] = cycle
+        yield child
+
+
+def _fold(metric, columns: dict, values: list, fold: str, fold_with) -> tuple:
+    """
+    Description
+    -----------
+    Internal function. Limit the number of distinct values of the label fold
+    to the cardinality limit of the metric family. Past the limit, the
+    values with the largest absolute totals are kept, and the rest are renamed to
+    "other", with the values of rows that end up with the same labels
+    combined by fold_with. This works on the label strings of the result,
+    before any child is created.
+
+    Return
+    ------
+    tuple: (columns, values) after folding.
+    """
+    family = metric.describe()[0].name
+    limit = CARDINALITY_LIMITS.get(family, CARDINALITY_LIMIT)
+    distinct = set(columns[fold])
+    if len(distinct) <= limit:
+        CARDINALITY_OVERFLOW.labels(family=family).set(0)
+        return columns, values
+
+    totals = collections.Counter()
+    for label, value in zip(columns[fold], values):
+        totals[label] += abs(value or 0)
+    keep = {label for label, _ in totals.most_common(limit - 1)}
+    logger.warning(
+        f"{family} has {len(distinct)} values of label {fold}, "
+        f"folding {len(distinct) - len(keep)} of them into 'other'."
+    )
+    CARDINALITY_OVERFLOW.labels(family=family).set(len(distinct) - len(keep))
+
+    names = list(columns)
+    position = names.index(fold)
+    rows = {}
+    for row, value in zip(zip(*columns.values()), values):
+        if row[position] not in keep:
+            row = row[:position] + ("other",) + row[position + 1 :]
+        rows.setdefault(row, []).append(value)
+    columns = dict(zip(names, zip(*rows)))
+    values = [fold_with(row_values) for row_values in rows.values()]
+    return columns, values
+
+
+@contextlib.contextmanager
+def labelled(**labels):
+    """
+    Description
+    -----------
+    Context manager giving the children written inside the block the label
+    values in labels, for the metrics that have those labels. Refresh
+    cycles inside the block are kept apart from those with other values.
+    """
+    token = _context_labels.set({**_context_labels.get(), **labels})
+    try:
+        yield
+    finally:
+        _context_labels.reset(token)
+
+
+def child(metric, **labels):
+    """The child of metric with labels and the context labels, see labelled()."""
+    if not metric._labelnames:
+        return metric
+    columns = {name: [f"{value}"] for name, value in labels.items()}
+    return next(_children_of(metric, columns))
+
+
+@contextlib.contextmanager
+def cycle(scope):
+    """
+    Description
+    -----------
+    Context manager around one refresh of scope. Children written inside the
+    block are tagged with the generation of this cycle. When the block
+    succeeds, the children of scope that have not been written in the last
+    EVICT_AFTER_CYCLES cycles are removed, e.g. groups that no longer exist
+    in the source table.
+    """
+    scope = (scope, *_context_labels.get().values())
+    with _cycle_lock:
+        generation = _generations.get(scope, 0) + 1
+        _generations[scope] = generation
+        token = _cycle.set((scope, generation))
+        try:
+            yield
+        finally:
+            _cycle.reset(token)
+        _evict(scope, generation)
+
+
+def _evict(scope, generation) -> None:
+    """Internal function. Remove the stale children of scope, see cycle()."""
+    for metric, written in list(_written.items()):
+        family = metric.describe()[0].name
+        if EVICT_AFTER_CYCLES > 0:
+            stale = [
+                key
+                for key, (written_scope, written_generation) in written.items()
+                if written_scope == scope
+                and written_generation <= generation - EVICT_AFTER_CYCLES
+            ]
+            for key in stale:
+                metric.remove(*key)
+                del written[key]
+                del _children[metric][key]
+            if stale:
+                logger.debug(f"Evicted {len(stale)} series of {family}.")
+                SERIES_EVICTED.labels(family=family).inc(len(stale))
+        SERIES.labels(family=family).set(len(_children.get(metric, ())))
+    return None
+
+
+def set_from_frame(
+    metric, df, labels: dict, value: str, fold=None, fold_with=sum, **const_labels
+) -> None:
+    """
+    Description
+    -----------
+    Set one child of a labelled Gauge per row of a result dataframe.
+
+    Parameters
+    ----------
+    metric: prometheus_client.Gauge.
+    df: query result (dataframe or pyarrow table), one row per child.
+    labels: dict with label name as key and the column in df holding the
+        label value as value.
+    value: the column in df holding the value of the gauge.
+    fold: optional name of a label whose number of distinct values is kept
+        within the cardinality limit of the metric family, see _fold().
+    fold_with: combines the values of rows folded into the same child.
+    const_labels: labels with the same value for all rows, e.g. type="fnr".
+    """
+    columns = {name: results.labels(df, column) for name, column in labels.items()}
+    values = results.values(df, value)
+    if fold is not None:
+        columns, values = _fold(metric, columns, values, fold, fold_with)
+    for name, const in const_labels.items():
+        columns[name] = itertools.repeat(f"{const}")
+
+    for child, val in zip(_children_of(metric, columns), values):
+        child.set(val)
+    return None
+
+
+def set_from_pages(
+    metric, pages, labels: dict, value: str, fold=None, **const_labels
+) -> None:
+    """
+    Description
+    -----------
+    Same as set_from_frame(), for a result read page by page, e.g. with
+    BigQuery._query_pages(). The children of each page are set before the
+    next page is read, so that only one page is held in memory.
+
+    With fold, every row must have a value of fold of its own, and the rows
+    must come in decreasing order of value. Past the cardinality limit of
+    the metric family, the first rows are kept, which are then the largest
+    as in _fold(), and the values of the rest are summed into "other".
+    """
+    if fold is None:
+        for page in pages:
+            set_from_frame(metric, page, labels, value, **const_labels)
+        return None
+
+    family = metric.describe()[0].name
+    limit = CARDINALITY_LIMITS.get(family, CARDINALITY_LIMIT)
+    names = list(labels)
+    position = names.index(fold)
+
+    def put(rows) -> None:
+        if not rows:
+            return None
+        columns = dict(zip(names, zip(*rows.keys())))
+        for name, const in const_labels.items():
+            columns[name] = itertools.repeat(f"{const}")
+        for child, val in zip(_children_of(metric, columns), rows.values()):
+            child.set(val)
+        return None
+
+    seen = 0
+    # The row at the limit, kept only if it is the last one
+    held = {}
+    other = {}
+    for page in pages:
+        columns = [results.labels(page, labels[name]) for name in names]
+        kept = {}
+        for row, val in zip(zip(*columns), results.values(page, value)):
+            seen += 1
+            if seen < limit:
+                kept[row] = val
+                continue
+            held[row] = val
+            if seen > limit:
+                for held_row, held_val in held.items():
+                    held_row = (
+                        held_row[:position] + ("other",) + held_row[position + 1 :]
+                    )
+                    other[held_row] = other.get(held_row, 0) + (held_val or 0)
+                held = {}
+        put(kept)
+    put(held)
+    put(other)
+
+    folded = seen - limit + 1 if seen > limit else 0
+    if folded:
+        logger.warning(
+            f"{family} has {seen} values of label {fold}, "
+            f"folding {folded} of them into 'other'."
+        )
+    CARDINALITY_OVERFLOW.labels(family=family).set(folded)
+    return None
+
+
+def info_from_frame(
+    metric, df, labels: dict, value: str, key: str, **const_labels
+) -> None:
+    """
+    Description
+    -----------
+    Set one child of a labelled Info per row of a result dataframe, as
+    {key: <value column>}.
+    """
+    columns = {name: results.labels(df, column) for name, column in labels.items()}
+    for name, const in const_labels.items():
+        columns[name] = itertools.repeat(f"{const}")
+
+    for child, val in zip(_children_of(metric, columns), results.values(df, value)):
+        child.info({key: f"{val}"})
+    return None
@@ -0,0 +1,82 @@
+"""
+Access to query results, which are either pandas dataframes or pyarrow tables
+depending on config.RESULT_FORMAT. The metric writers only read results
+through these functions, so they work the same for both.
+"""
+import logging
+import sys
+
+
+logger = logging.getLogger(__name__)
+logger.debug("Logging is configured.")
+
+
+def is_arrow(result) -> bool:
+    # Checked without importing pyarrow, which is only loaded when the
+    # arrow result format is used
+    pyarrow = sys.modules.get("pyarrow")
+    return pyarrow is not None and isinstance(result, pyarrow.Table)
+
+
+def num_rows(result) -> int:
+    return result.num_rows if is_arrow(result) else len(result)
+
+
+def values(result, column) -> list:
+    """
+    The values of a column as a list of Python objects. Nulls in numeric
+    columns are NaN, like in a dataframe, so they can be set on a gauge.
+    """
+    if is_arrow(result):
+        import pyarrow
+
+        array = result.column(column)
+        numeric = pyarrow.types.is_integer(array.type) or pyarrow.types.is_floating(
+            array.type
+        )
+        if numeric and array.null_count:
+            array = array.cast(pyarrow.float64()).fill_null(float("nan"))
+        return array.to_pylist()
+    return result[column].tolist()
+
+
+def labels(result, column) -> list:
+    """
+    Description
+    -----------
+    The values of a column as label strings. The column is dictionary
+    encoded, so each distinct value is converted to a string only once,
+    however many rows it is repeated in.
+    """
+    import numpy
+
+    if is_arrow(result):
+        import pyarrow
+
+        array = result.column(column)
+        if pyarrow.types.is_dictionary(array.type):
+            array = array.unify_dictionaries().combine_chunks()
+        else:
+            array = array.combine_chunks().dictionary_encode(null_encoding="encode")
+        names = [f"{value}" for value in array.dictionary.to_pylist()]
+        indices = array.indices
+        if indices.null_count:
+            indices = indices.fill_null(len(names))
+            names.append("None")
+        codes = indices.to_numpy(zero_copy_only=False)
+    else:
+        import pandas
+
+        codes, uniques = pandas.factorize(result[column], use_na_sentinel=False)
+        names = [f"{value}" for value in uniques]
+    return numpy.array(names, dtype=object)[codes].tolist()
+
+
+def select(result, column, value, columns):
+    """The given columns of the rows where column equals value."""
+    if is_arrow(result):
+        import pyarrow.compute
+
+        mask = pyarrow.compute.equal(result.column(column), value)
+        return result.filter(mask).select(list(columns))
+    return result.loc[result[column] == value, list(columns)].reset_index(drop=True)
@@ -1,88 +1,151 @@
 import atexit
+import concurrent.futures
+import datetime
+import functools
 import logging
 
+from apscheduler.executors.pool import BasePoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
 
-from . import metrics
+from . import metrics, ondemand
+from .config import (
+    BATCH_REFRESH,
+    GCP_PROJECTS,
+    MAX_CONCURRENT_JOBS,
+    MAX_STALENESS_SECONDS,
+    REFRESH_ENGINE,
+    STAGGER_SECONDS,
+)
+from .intervals import JobInterval
 
 
 logger = logging.getLogger(__name__)
 logger.debug("Logging is configured.")
 
 
-def configure_scheduler(**kwargs):
+class SharedPoolExecutor(BasePoolExecutor):
+    """
+    APScheduler executor running the jobs in pool, a
+    concurrent.futures.ThreadPoolExecutor shared with the refreshes
+    triggered by scrapes, see ondemand.py.
+    """
 
-    # Scheduling of function triggers
-    logger.debug("Configuring job scheduler.")
-    scheduler = BackgroundScheduler()
-
-    # Count total/unique folkeregisteridentifikator
-    scheduler.add_job(
-        lambda: metrics.preagg_total_and_distinct(),
-        "interval",
-        name="preagg_total_and_distinct",
-        **kwargs,
-    )
+    def __init__(self, pool):
+        super().__init__(pool)
 
-    # Count how many with each status
-    scheduler.add_job(
-        lambda: metrics.preagg_group_by_and_count(),
-        "interval",
-        name="preagg_group_by_and_count",
-        **kwargs,
-    )
 
-    scheduler.add_job(
-        lambda: metrics.preagg_valid_and_invalid_idents(),
-        "interval",
-        name="preagg_valid_and_invalid_idents",
-        **kwargs,
-    )
-
-    scheduler.add_job(
-        lambda: metrics.preagg_latest_timestamp(),
-        "interval",
-        name="preagg_latest_timestamp",
-        **kwargs,
-    )
-
-    scheduler.add_job(
-        lambda: metrics.preagg_num_citizenships(),
-        "interval",
-        name="preagg_num_citizenships",
-        **kwargs,
-    )
+def configure_scheduler(**kwargs):
 
-    # ---
-    # DSF SITUASJONSUTTAK
-    scheduler.add_job(
-        lambda: metrics.dsfsit_latest_timestamp(),
-        "interval",
-        name="dsfsit_latest_timestamp",
-        **kwargs,
-    )
+    if REFRESH_ENGINE == "asyncio":
+        return configure_engine(**kwargs)
 
-    scheduler.add_job(
-        lambda: metrics.dsfsit_qa_nullvals_latest(),
-        "interval",
-        name="dsfsit_qa_nullvals_latest",
-        **kwargs,
+    # Scheduling of function triggers
+    logger.debug("Configuring job scheduler.")
+    # At most MAX_CONCURRENT_JOBS queries to BigQuery at the same time, over
+    # all projects, scheduled or triggered by scrapes
+    pool = concurrent.futures.ThreadPoolExecutor(
+        MAX_CONCURRENT_JOBS, thread_name_prefix="refresh"
     )
-
-    scheduler.add_job(
-        lambda: metrics.dsfsit_qa_nullvals_diff(),
-        "interval",
-        name="dsfsit_qa_nullvals_diff",
-        **kwargs,
+    scheduler = BackgroundScheduler(
+        executors={"default": SharedPoolExecutor(pool)},
+        # A job never overlaps itself, and missed runs are merged into one.
+        # A run waiting for a free thread runs late rather than not at all.
+        job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": None},
     )
 
-    scheduler.add_job(
-        lambda: metrics.metrics_timestamp(),
-        "interval",
-        name="metrics_timestamp",
-        **kwargs,
-    )
+    # One query job per metric and project, see metrics.JOBS, or with
+    # BATCH_REFRESH all pre-aggregated tables of a project in one query job
+    # and the other jobs on their own. The first runs are staggered so that
+    # the jobs do not all hit BigQuery at once.
+    start = kwargs.get("next_run_time", datetime.datetime.now())
+    with metrics.refresh():
+        for i, (function, name, project) in enumerate(scheduled(BATCH_REFRESH)):
+            interval = JobInterval(name, project, kwargs["minutes"])
+            run_date = start + datetime.timedelta(seconds=i * STAGGER_SECONDS)
+            _schedule(scheduler, interval, function, run_date)
 
     # Start/shutdown
     scheduler.start()
     atexit.register(lambda: scheduler.shutdown())
+    if MAX_STALENESS_SECONDS is not None:
+        ondemand.configure(scheduled(BATCH_REFRESH), pool)
+
+
+def scheduled(batch=False) -> list:
+    """
+    The refreshes to schedule, as (function, job name, project), where
+    function(project) refreshes the job of project.
+    """
+    names = metrics.scheduled_jobs()
+    refreshes = []
+    for project in GCP_PROJECTS:
+        if batch:
+            refreshes.append((metrics.preagg_batch, "preagg_batch", project))
+        refreshes += [
+            (functools.partial(metrics.run_job, name), name, project)
+            for name in names
+            if not batch or metrics.JOBS[name].fetch is not None
+        ]
+    return refreshes
+
+
+def _schedule(scheduler, interval: JobInterval, function, run_date) -> None:
+    """
+    Internal function. Add the job of interval, first run at run_date. It
+    stays in the scheduler, and each run moves the next one, see _run().
+    Until then, the next run is due after the longest interval, so that a
+    run that is somehow lost does not end the refreshes of the job.
+    """
+    scheduler.add_job(
+        _run,
+        "interval",
+        seconds=interval.max_seconds,
+        next_run_time=run_date,
+        args=[scheduler, interval, function],
+        id=interval.key,
+        name=interval.key,
+        replace_existing=True,
+    )
+    return None
+
+
+def _run(scheduler, interval: JobInterval, function) -> None:
+    """
+    Internal function. Refresh the job of interval, or join the refresh of
+    it a scrape started (see ondemand.py), and then adapt the interval to
+    the outcome, see _ran(). A joined refresh may still wait for a thread
+    of the same pool, so it is not waited for in this one.
+    """
+    future, started = ondemand.FLIGHTS.join(interval.key)
+    if started:
+        ondemand.execute(interval.key, function, interval.project)
+    future.add_done_callback(functools.partial(_ran, scheduler, interval))
+    return None
+
+
+def _ran(scheduler, interval: JobInterval, future) -> None:
+    """
+    Internal function. Adapt the interval to the outcome of the refresh in
+    future, with errors logged by ondemand.execute(), and move the next
+    refresh to the adapted interval.
+    """
+    changed = None if future.exception() is not None else future.result()
+    interval.record(changed)
+    run_date = datetime.datetime.now() + datetime.timedelta(seconds=interval.delay())
+    scheduler.modify_job(interval.key, next_run_time=run_date)
+    return None
+
+
+def configure_engine(**kwargs):
+    """Refresh all jobs from one event loop instead, see engine.py."""
+    from .engine import RefreshEngine
+
+    logger.debug("Configuring asyncio refresh engine.")
+    with metrics.refresh():
+        engine = RefreshEngine(
+            metrics.scheduled_jobs(), kwargs["minutes"], batch=BATCH_REFRESH
+        )
+    engine.start()
+    atexit.register(engine.shutdown)
+    if MAX_STALENESS_SECONDS is not None:
+        ondemand.configure(scheduled(BATCH_REFRESH), engine)
@@ -0,0 +1,148 @@
+import contextlib
+import datetime
+import logging
+import sqlite3
+import threading
+
+from . import results
+
+
+logger = logging.getLogger(__name__)
+logger.debug("Logging is configured.")
+
+
+class ResultStore:
+    """
+    The last good result of each job, kept in a SQLite file so that a
+    restarted app can serve the last known values before its jobs have run.
+    Every job has a table job_<name> with its result, and the table
+    saved_results tells when it was saved.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS saved_results "
+                "(name TEXT PRIMARY KEY, saved_at TEXT, timestamp_columns TEXT)"
+            )
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """Internal method. A connection committed and closed on exit."""
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def save(self, name, result, key=None) -> None:
+        """
+        Description
+        -----------
+        Save result (dataframe or pyarrow table) as the last good result of
+        the job name, replacing the one saved before. With key, a list of
+        columns identifying a row, the rows of result are upserted into the
+        rows saved before instead, so that a result of only the rows changed
+        since the last save is enough.
+        """
+        if results.is_arrow(result):
+            df = result.to_pandas()
+        else:
+            df = result
+        # As column=aware or column=naive, so that columns without a time
+        # zone are not given one when loaded
+        timestamp_columns = [
+            f"{column}={'aware' if df[column].dt.tz is not None else 'naive'}"
+            for column in df.columns
+            if str(df[column].dtype).startswith("datetime64")
+        ]
+        saved_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+        with self._lock, self._connect() as connection:
+            if key is None:
+                df.to_sql(f"job_{name}", connection, if_exists="replace", index=False)
+            else:
+                # The timestamp columns of the rows saved before, by column,
+                # updated with those of df
+                kinds = dict(
+                    entry.partition("=")[::2]
+                    for entry in self._upsert(connection, name, df, key)
+                )
+                kinds.update(entry.partition("=")[::2] for entry in timestamp_columns)
+                timestamp_columns = [
+                    f"{column}={kind}" if kind else column
+                    for column, kind in kinds.items()
+                ]
+            connection.execute(
+                "INSERT OR REPLACE INTO saved_results VALUES (?, ?, ?)",
+                (name, saved_at, ",".join(timestamp_columns)),
+            )
+        logger.debug(f"Saved result of {name} to {self.path}.")
+        return None
+
+    def _upsert(self, connection, name, df, key) -> list:
+        """
+        Internal method. Insert or replace the rows of df in the table of
+        job name by key, see save().
+
+        Return
+        ------
+        list: the timestamp columns recorded for the rows saved before, which
+        an empty df cannot tell.
+        """
+        table = f"job_{name}"
+        previous = connection.execute(
+            "SELECT timestamp_columns FROM saved_results WHERE name = ?", (name,)
+        ).fetchone()
+        # Create the table, and the unique index upserts are matched on
+        df.head(0).to_sql(table, connection, if_exists="append", index=False)
+        columns = ", ".join(f'"{column}"' for column in key)
+        connection.execute(
+            f'CREATE UNIQUE INDEX IF NOT EXISTS "{table}_key" ON "{table}" ({columns})'
+        )
+
+        def insert_or_replace(pandas_table, connection, keys, data_iter):
+            names = ", ".join(f'"{name}"' for name in keys)
+            placeholders = ", ".join("?" for _ in keys)
+            connection.executemany(
+                f'INSERT OR REPLACE INTO "{table}" ({names}) VALUES ({placeholders})',
+                list(data_iter),
+            )
+
+        df.to_sql(
+            table, connection, if_exists="append", index=False, method=insert_or_replace
+        )
+        if previous is None:
+            return []
+        return [entry for entry in previous[0].split(",") if entry]
+
+    def load(self) -> dict:
+        """
+        Description
+        -----------
+        Load the saved results of all jobs.
+
+        Return
+        ------
+        dict: keys - job name,
+              values - (time saved, dataframe)
+        """
+        import pandas
+
+        loaded = {}
+        with self._lock, self._connect() as connection:
+            saved = connection.execute(
+                "SELECT name, saved_at, timestamp_columns FROM saved_results"
+            ).fetchall()
+            for name, saved_at, timestamp_columns in saved:
+                df = pandas.read_sql(f'SELECT * FROM "job_{name}"', connection)
+                for entry in filter(None, timestamp_columns.split(",")):
+                    # Saved before time zones were recorded: all were aware
+                    column, _, kind = entry.partition("=")
+                    df[column] = pandas.to_datetime(df[column], utc=kind != "naive")
+                loaded[name] = (datetime.datetime.fromisoformat(saved_at), df)
+        logger.debug(f"Loaded {len(loaded)} saved results from {self.path}.")
+        return loaded
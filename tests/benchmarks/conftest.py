@@ -0,0 +1,124 @@
+"""
+Fixtures for the benchmarks: a fake BigQuery client returning synthetic
+result frames, and the baseline the measurements are compared against.
+"""
+import json
+import os
+
+import numpy
+import pandas
+import pytest
+
+
+BASELINE_PATH = os.environ.get(
+    "BENCHMARK_BASELINE", os.path.join(os.path.dirname(__file__), "baseline.json")
+)
+# Save the measurements of this run as the new baseline
+SAVE_BASELINE = os.environ.get("BENCHMARK_SAVE", "false").lower() == "true"
+# A measurement regresses when it is this many times its baseline
+TOLERANCE = float(os.environ.get("BENCHMARK_TOLERANCE", "1.5"))
+# Max number of distinct label values per column in the synthetic frames
+MAX_SERIES = int(os.environ.get("BENCHMARK_MAX_SERIES", "10000"))
+
+
+class FakeRows:
+    """Stands in for the RowIterator of a query job."""
+
+    def __init__(self, df):
+        self.df = df
+        self.total_rows = len(df)
+
+    def to_dataframe(self, **kwargs):
+        return self.df
+
+    def to_arrow(self, **kwargs):
+        import pyarrow
+
+        return pyarrow.Table.from_pandas(self.df, preserve_index=False)
+
+
+class FakeClient:
+    """
+    Stands in for google.cloud.bigquery.Client, answering every query with
+    the frame in self.result.
+    """
+
+    def __init__(self):
+        self.result = pandas.DataFrame()
+
+    def query(self, query, job_config=None, project=None):
+        job = type("FakeQueryJob", (), {})()
+        job.result = lambda **kwargs: FakeRows(self.result)
+        return job
+
+
+def synthetic_frame(source, rows) -> pandas.DataFrame:
+    """
+    A result of rows rows for one of the sources in bigquery.PRE_AGGREGATED.
+    String columns cycle through at most MAX_SERIES values, numbers are
+    random.
+    """
+    from freg_quality_metrics.bigquery import BATCH_COLUMNS, PRE_AGGREGATED
+
+    columns, _ = PRE_AGGREGATED[source]
+    index = numpy.arange(rows) % min(rows, MAX_SERIES)
+    rng = numpy.random.default_rng(0)
+    data = {}
+    for column in columns:
+        if column == "latest_timestamp":
+            data[column] = ["2022-11-01 12:00:00"] * rows
+        elif BATCH_COLUMNS[column] == "STRING":
+            data[column] = pandas.Series(index).map(f"{column}{{}}".format)
+        else:
+            data[column] = rng.random(rows) * 1000
+    return pandas.DataFrame(data)
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    from freg_quality_metrics import metrics
+    from freg_quality_metrics.bigquery import BigQuery
+
+    client = FakeClient()
+    bq = BigQuery()
+    bq.client = client
+    monkeypatch.setitem(metrics.BACKENDS, metrics.GCP_PROJECTS[0], bq)
+    monkeypatch.setattr(metrics, "CHANGE_DETECTION", False)
+    monkeypatch.setattr(metrics, "STORE", None)
+    return client
+
+
+@pytest.fixture(autouse=True)
+def no_series():
+    """
+    Remove the label series left by earlier benchmarks, so that every
+    benchmark renders only the series it creates itself.
+    """
+    from freg_quality_metrics import metrics, registry
+
+    for metric in metrics.graphs.values():
+        if metric._labelnames:
+            metric.clear()
+    registry._children.clear()
+    registry._written.clear()
+    yield
+
+
+@pytest.fixture(scope="session")
+def baseline():
+    """
+    Description
+    -----------
+    The baseline measurements, keyed by benchmark id. Measurements added to
+    the dict by the benchmarks are saved as the new baseline at the end of
+    the session when BENCHMARK_SAVE is set.
+    """
+    saved = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as file:
+            saved = json.load(file)
+    measured = {}
+    yield saved, measured
+    if SAVE_BASELINE and measured:
+        with open(BASELINE_PATH, "w") as file:
+            json.dump({**saved, **measured}, file, indent=2, sort_keys=True)
@@ -0,0 +1,134 @@
+"""
+Benchmarks of the refresh and scrape hot paths. Synthetic results of 10 to
+1M rows are fed through a fake BigQuery client into each metric function,
+measuring the refresh wall time, its peak memory, and the time to render
+/metrics with the resulting series. Run with:
+
+    BENCHMARKS=true pytest tests/benchmarks
+
+and add BENCHMARK_SAVE=true to save the measurements as the new baseline.
+BENCHMARK_SIZES selects the numbers of rows, e.g. "10,1000" for a quick run.
+"""
+import os
+import time
+import tracemalloc
+
+import pytest
+from werkzeug.test import Client
+
+from .conftest import TOLERANCE, synthetic_frame
+
+
+pytestmark = [
+    pytest.mark.benchmark,
+    pytest.mark.skipif(
+        os.environ.get("BENCHMARKS", "false").lower() != "true",
+        reason="Benchmarks only run with BENCHMARKS=true",
+    ),
+]
+
+SIZES = [
+    int(size)
+    for size in os.environ.get("BENCHMARK_SIZES", "10,1000,100000,1000000").split(",")
+]
+
+# Absolute difference from the baseline allowed per measurement
+SLACK = {"seconds": 0.05, "peak_bytes": 1_000_000, "render_seconds": 0.05}
+
+# Function in metrics -> the source its query reads
+REFRESHES = {
+    "preagg_total_and_distinct": "total_and_distinct",
+    "preagg_group_by_and_count": "count_group_by",
+    "preagg_valid_and_invalid_idents": "valid_fnr",
+    "preagg_latest_timestamp": "latest_timestamp",
+    "preagg_num_citizenships": "number_of_citizenships",
+    "dsfsit_latest_timestamp": "dsfsit_latest_timestamp",
+    "dsfsit_qa_nullvals_latest": "dsfsit_qa_nullvals_latest",
+    "dsfsit_qa_nullvals_diff": "dsfsit_qa_nullvals_diff",
+    "metrics_timestamp": "metrics_timestamp",
+}
+
+
+def _measure(refresh) -> dict:
+    """
+    Run refresh once under tracemalloc, which also creates its series, then
+    timed, and time a render of /metrics afterwards. The time is the best of
+    up to 5 runs, as many as fit in 2 seconds.
+    """
+    from freg_quality_metrics import exposition
+
+    tracemalloc.start()
+    try:
+        refresh()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    runs = []
+    while len(runs) < 5 and sum(runs) < 2:
+        start = time.perf_counter()
+        refresh()
+        runs.append(time.perf_counter() - start)
+    seconds = min(runs)
+
+    client = Client(exposition.make_wsgi_app())
+    start = time.perf_counter()
+    snapshot = exposition.COLLECTOR.publish()
+    body = client.get("/").get_data()
+    render_seconds = time.perf_counter() - start
+
+    series = sum(1 for line in snapshot.text.splitlines() if not line.startswith(b"#"))
+    return {
+        "seconds": seconds,
+        "peak_bytes": peak_bytes,
+        "render_seconds": render_seconds,
+        "series": series,
+        "body_bytes": len(body),
+    }
+
+
+def _compare(baseline, key, measurement) -> None:
+    """
+    Add measurement to the measured results, and check it against the saved
+    baseline. Differences within SLACK are never regressions, so that
+    the fastest benchmarks do not fail on noise.
+    """
+    saved, measured = baseline
+    measured[key] = measurement
+    if key not in saved:
+        return None
+    for name, slack in SLACK.items():
+        limit = max(saved[key][name] * TOLERANCE, saved[key][name] + slack)
+        assert (
+            measurement[name] <= limit
+        ), f"{key}: {name} {measurement[name]} regressed from {saved[key][name]}"
+    return None
+
+
+@pytest.mark.parametrize("rows", SIZES)
+@pytest.mark.parametrize("name", list(REFRESHES))
+def test_refresh(name, rows, fake_client, baseline):
+    from freg_quality_metrics import metrics
+
+    fake_client.result = synthetic_frame(REFRESHES[name], rows)
+    _compare(baseline, f"{name}[{rows}]", _measure(getattr(metrics, name)))
+
+
+@pytest.mark.parametrize("rows", SIZES)
+def test_map_group_by_pages_to_metric(rows, baseline):
+    import pandas
+
+    from freg_quality_metrics import metrics
+
+    page = pandas.DataFrame(
+        {"key": [f"group{i}" for i in range(rows)], "occurence": range(rows, 0, -1)}
+    )
+    _compare(
+        baseline,
+        f"map_group_by_pages_to_metric[{rows}]",
+        _measure(
+            lambda: metrics.map_group_by_pages_to_metric(
+                [page], "inndata", "v_status", "status"
+            )
+        ),
+    )
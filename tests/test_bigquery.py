@@ -12,14 +12,191 @@ def bq(bigquery_client):
     return BigQuery()
 
 
-""" Commented out since check is no longer done in python but in bigquery
-
-@pytest.mark.parametrize("test_input,expected", [
-    ("2222",(False,"format")),
-    ("01234567891",(False,"date")),
-    ("01012000a1",(False,"format")),
-    ("010120002398573984753241",(False,"format")),
-])
-def test_valid_fnr_or_dnr(test_input,expected,BQ):
-    assert BQ._valid_fnr_or_dnr(test_input) == expected
-"""
+def test_pre_aggregated_batch(bq, monkeypatch):
+    import pandas
+
+    monkeypatch.setattr(bq, "client", MagicMock())
+    combined = pandas.DataFrame(
+        {
+            "kilde": ["count_group_by", "count_group_by", "metrics_timestamp"],
+            "datasett": ["inndata", "inndata", None],
+            "tabell": ["v_status", "v_status", None],
+            "variabel": ["status", "status", None],
+            "gruppe": ["bosatt", "utflyttet", None],
+            "antall": [10.0, 2.0, None],
+            "latest_timestamp": [None, None, "2022-11-01 12:00:00"],
+        }
+    )
+    bq.client.query.return_value.result.return_value.to_dataframe.return_value = (
+        combined
+    )
+
+    result = bq.pre_aggregated_batch(["count_group_by", "metrics_timestamp"])
+
+    query = bq.client.query.call_args[0][0]
+    assert query.count("UNION ALL") == 1
+    assert "'count_group_by' AS kilde" in query
+    assert list(result["count_group_by"].gruppe) == ["bosatt", "utflyttet"]
+    assert list(result["metrics_timestamp"].columns) == ["latest_timestamp"]
+    assert result["metrics_timestamp"].latest_timestamp[0] == "2022-11-01 12:00:00"
+
+
+def test_count_total_and_uniques_approx(bq, monkeypatch):
+    import pandas
+
+    monkeypatch.setattr(bq, "client", MagicMock())
+    rows = bq.client.query.return_value.result.return_value
+    rows.to_dataframe.return_value = pandas.DataFrame(
+        {"total": [0], "unique": [90], "sketch": [b"merged"], "watermark": [None]}
+    )
+
+    result = bq.count_total_and_uniques_approx(
+        "inndata", "v_hendelse", "hendelsesid", "dato", 20221101, b"sketch"
+    )
+
+    query = bq.client.query.call_args[0][0]
+    assert "HLL_COUNT.MERGE_PARTIAL" in query
+    assert "WHERE dato > @watermark" in query
+    parameters = bq.client.query.call_args[1]["job_config"].query_parameters
+    assert [(p.name, p.type_, p.value) for p in parameters] == [
+        ("sketch", "BYTES", b"sketch"),
+        ("watermark", "INT64", 20221101),
+    ]
+    # No new rows, so the watermark is kept
+    assert result == {
+        "total": 0.0,
+        "unique": 90.0,
+        "sketch": b"merged",
+        "watermark": 20221101,
+    }
+
+
+def test_watermark_read_back_from_dataframe(bq, monkeypatch):
+    import pandas
+
+    monkeypatch.setattr(bq, "client", MagicMock())
+    watermark = pandas.Series([20221101], dtype="Int64")[0]
+
+    bq.count_total_and_uniques_approx(
+        "inndata", "v_hendelse", "hendelsesid", "dato", watermark, b"sketch"
+    )
+
+    parameters = bq.client.query.call_args[1]["job_config"].query_parameters
+    assert (parameters[1].type_, parameters[1].value) == ("INT64", 20221101)
+    assert parameters[1].to_api_repr()["parameterValue"] == {"value": "20221101"}
+
+
+def test_query_stats(bq, monkeypatch):
+    import datetime
+
+    import pandas
+
+    recorded = []
+    monkeypatch.setattr(bq, "client", MagicMock())
+    monkeypatch.setattr(bq, "on_query", recorded.append)
+    job = bq.client.query.return_value
+    job.created = datetime.datetime(2022, 11, 1, 12, 0, 0)
+    job.started = job.created + datetime.timedelta(seconds=2)
+    job.ended = job.started + datetime.timedelta(seconds=5)
+    job.total_bytes_processed = 1000
+    job.total_bytes_billed = None
+    job.slot_millis = 300
+    job.cache_hit = False
+    job.result.return_value.total_rows = 1
+    job.result.return_value.to_dataframe.return_value = pandas.DataFrame(
+        {"latest_timestamp": ["2022-11-01 12:00:00"]}
+    )
+
+    bq.pre_aggregated("metrics_timestamp")
+
+    (stats,) = recorded
+    assert stats.queue_seconds == 2
+    assert stats.execution_seconds == 5
+    assert stats.download_seconds >= 0
+    assert (stats.bytes_processed, stats.bytes_billed) == (1000, 0)
+    assert (stats.slot_millis, stats.rows, stats.cache_hit) == (300, 1, False)
+
+
+def test_estimate_bytes_once_per_query_text(bq, monkeypatch):
+    from freg_quality_metrics.budget import BudgetExceeded, ByteBudget
+
+    estimates = []
+    monkeypatch.setattr(bq, "client", MagicMock())
+    monkeypatch.setattr(bq, "on_estimate", estimates.append)
+    monkeypatch.setattr(bq, "budget", ByteBudget(per_cycle=2500))
+    bq.client.query.return_value.total_bytes_processed = 1000
+
+    bq.submit_pre_aggregated("metrics_timestamp")
+    bq.submit_pre_aggregated("metrics_timestamp")
+    with pytest.raises(BudgetExceeded):
+        bq.submit_pre_aggregated("metrics_timestamp")
+
+    dry_runs = [
+        call for call in bq.client.query.call_args_list if call[1]["job_config"]
+    ]
+    assert len(dry_runs) == 1
+    assert dry_runs[0][1]["job_config"].dry_run
+    assert estimates == [1000, 1000, 1000]
+
+
+def test_estimate_bytes_per_parameter_values(bq, monkeypatch):
+    from google.cloud import bigquery
+
+    from freg_quality_metrics.bigquery import _job_config
+
+    monkeypatch.setattr(bq, "client", MagicMock())
+    monkeypatch.setattr(bq, "on_estimate", None)
+    bq.client.query.return_value.total_bytes_processed = 1000
+    query = "SELECT COUNT(*) FROM t WHERE ts > @watermark"
+
+    for watermark in ["2022-11-01", "2022-11-01", "2022-11-02"]:
+        parameter = bigquery.ScalarQueryParameter("watermark", "DATE", watermark)
+        bq.estimate_bytes(query, _job_config([parameter]))
+
+    assert bq.client.query.call_count == 2
+
+
+def test_estimate_once_per_query_text_without_budget(bq, monkeypatch):
+    from google.cloud import bigquery
+
+    from freg_quality_metrics.bigquery import _job_config
+
+    estimates = []
+    monkeypatch.setattr(bq, "client", MagicMock())
+    monkeypatch.setattr(bq, "on_estimate", estimates.append)
+    monkeypatch.setattr(bq, "budget", None)
+    bq.client.query.return_value.total_bytes_processed = 1000
+    query = "SELECT COUNT(*) FROM t WHERE ts > @watermark"
+
+    for watermark in ["2022-11-01", "2022-11-02"]:
+        parameter = bigquery.ScalarQueryParameter("watermark", "DATE", watermark)
+        bq._query(query, _job_config([parameter]))
+
+    dry_runs = [
+        call for call in bq.client.query.call_args_list if call[1]["job_config"].dry_run
+    ]
+    assert len(dry_runs) == 1
+    assert estimates == [1000, 1000]
+
+
+def test_group_by_and_count_reads_pages(bq, monkeypatch):
+    import pandas
+
+    recorded = []
+    monkeypatch.setattr(bq, "client", MagicMock())
+    monkeypatch.setattr(bq, "on_query", recorded.append)
+    job = bq.client.query.return_value
+    job.total_bytes_processed = job.total_bytes_billed = job.slot_millis = 0
+    job.result.return_value.total_rows = 3
+    pages = [
+        pandas.DataFrame({"key": ["bosatt", "utflyttet"], "occurence": [5, 2]}),
+        pandas.DataFrame({"key": ["doed"], "occurence": [1]}),
+    ]
+    job.result.return_value.to_dataframe_iterable.return_value = iter(pages)
+
+    result = bq.group_by_and_count("inndata", "v_status", "status", page_size=2)
+
+    assert result == {"bosatt": 5, "utflyttet": 2, "doed": 1}
+    job.result.assert_called_with(page_size=2)
+    (stats,) = recorded
+    assert stats.peak_page_bytes == pages[0].memory_usage(deep=True).sum()
@@ -0,0 +1,96 @@
+import pytest
+
+
+def test_budget_per_cycle_and_day(monkeypatch):
+    from freg_quality_metrics import budget
+
+    now = [1_667_300_000.0]
+    monkeypatch.setattr(budget.time, "time", lambda: now[0])
+    byte_budget = budget.ByteBudget(per_cycle=100, per_day=250, cycle_seconds=300)
+
+    byte_budget.charge(60)
+    with pytest.raises(budget.BudgetExceeded, match="cycle"):
+        byte_budget.charge(60)
+    byte_budget.charge(40)
+
+    # A new cycle starts from nothing, the day keeps counting
+    now[0] += 300
+    byte_budget.charge(100)
+    now[0] += 300
+    with pytest.raises(budget.BudgetExceeded, match="day"):
+        byte_budget.charge(60)
+
+    now[0] += 24 * 60 * 60
+    byte_budget.charge(60)
+
+
+def test_run_job_over_budget(bigquery_client, monkeypatch):
+    from unittest.mock import MagicMock
+
+    import pandas
+
+    from freg_quality_metrics import metrics
+    from freg_quality_metrics.incremental import DistinctCounts
+
+    column = ("inndata", "v_hendelse", "hendelsesid")
+    monkeypatch.setattr(metrics, "CHANGE_DETECTION", False)
+    monkeypatch.setattr(metrics, "STORE", None)
+    monkeypatch.setattr(metrics, "DISTINCT_COUNTS", {column: ("exact", None)})
+    monkeypatch.setitem(metrics.DISTINCT, metrics.GCP_PROJECTS[0], DistinctCounts())
+    bq = MagicMock()
+    bq.pre_aggregated.side_effect = metrics.budget.BudgetExceeded("Over budget")
+    bq.count_total_and_uniques.side_effect = metrics.budget.BudgetExceeded("Over")
+    bq.count_rows_from_metadata.return_value = 120.0
+    monkeypatch.setitem(metrics.BACKENDS, metrics.GCP_PROJECTS[0], bq)
+
+    # Postponed, without a cheaper variant
+    assert metrics.run_job("preagg_latest_timestamp") is metrics.budget.POSTPONED
+
+    # Downgraded to the total from the table metadata
+    assert metrics.run_job("distinct_counts") is True
+    total, unique, *_ = metrics.DISTINCT[metrics.GCP_PROJECTS[0]].get(*column)
+    assert total == 120.0
+    assert pandas.isna(unique)
+
+
+def test_downgrade_restarts_approx_counts(bigquery_client, monkeypatch):
+    import datetime
+    from unittest.mock import MagicMock
+
+    from freg_quality_metrics import metrics
+    from freg_quality_metrics.incremental import DistinctCounts
+
+    column = ("inndata", "v_hendelse", "hendelsesid")
+    monkeypatch.setattr(metrics, "CHANGE_DETECTION", False)
+    monkeypatch.setattr(metrics, "STORE", None)
+    monkeypatch.setattr(metrics, "DISTINCT_COUNTS", {column: ("approx", "dato")})
+    monkeypatch.setitem(metrics.DISTINCT, metrics.GCP_PROJECTS[0], DistinctCounts())
+    bq = MagicMock()
+    monkeypatch.setitem(metrics.BACKENDS, metrics.GCP_PROJECTS[0], bq)
+    day1 = datetime.date(2022, 11, 1)
+    bq.count_total_and_uniques_approx.return_value = {
+        "total": 100.0,
+        "unique": 90.0,
+        "sketch": b"day1",
+        "watermark": day1,
+    }
+    metrics.run_job("distinct_counts")
+
+    bq.count_total_and_uniques_approx.side_effect = metrics.budget.BudgetExceeded(
+        "Over"
+    )
+    bq.count_rows_from_metadata.return_value = 120.0
+    metrics.run_job("distinct_counts")
+
+    # The metadata total has the rows after day1, so they are not added again
+    bq.count_total_and_uniques_approx.side_effect = None
+    bq.count_total_and_uniques_approx.return_value = {
+        "total": 130.0,
+        "unique": 95.0,
+        "sketch": b"day2",
+        "watermark": day1 + datetime.timedelta(days=1),
+    }
+    metrics.run_job("distinct_counts")
+    bq.count_total_and_uniques_approx.assert_called_with(*column, "dato", None, None)
+    total, unique, *_ = metrics.DISTINCT[metrics.GCP_PROJECTS[0]].get(*column)
+    assert (total, unique) == (130.0, 95.0)
@@ -0,0 +1,108 @@
+import time
+
+import prometheus_client
+from werkzeug.test import Client
+
+
+def test_only_one_leader(tmp_path):
+    from freg_quality_metrics.coordination import Leadership
+
+    path = tmp_path / "leader.lock"
+    leader, follower = Leadership(path), Leadership(path)
+    assert leader.try_acquire()
+    assert not follower.try_acquire()
+
+    # The follower takes over once the leader is gone
+    leader.release()
+    assert follower.try_acquire()
+    assert follower.is_leader and not leader.is_leader
+    follower.release()
+
+
+def test_follower_serves_leader_snapshot(tmp_path):
+    from freg_quality_metrics.coordination import elect
+    from freg_quality_metrics.exposition import SnapshotCollector, make_wsgi_app
+
+    collector_registry = prometheus_client.CollectorRegistry()
+    gauge = prometheus_client.Gauge("test_shared", "Test", registry=collector_registry)
+    leader_collector = SnapshotCollector(collector_registry)
+    follower_collector = SnapshotCollector(prometheus_client.CollectorRegistry())
+    elected = []
+
+    leader = elect(tmp_path, lambda: elected.append("leader"), 0.01, leader_collector)
+    follower = elect(
+        tmp_path, lambda: elected.append("follower"), 0.01, follower_collector
+    )
+    assert elected == ["leader"]
+    assert follower_collector.following
+
+    gauge.set(3)
+    leader_collector.ready.set()
+    leader_collector.publish()
+    leader_response = Client(make_wsgi_app(leader_collector)).get("/")
+    follower_response = Client(make_wsgi_app(follower_collector)).get("/")
+    assert b"test_shared 3.0" in follower_response.data
+    assert follower_response.data == leader_response.data
+    assert follower_response.headers["ETag"] == leader_response.headers["ETag"]
+
+    openmetrics = Client(make_wsgi_app(follower_collector)).get(
+        "/", headers={"Accept": "application/openmetrics-text"}
+    )
+    assert openmetrics.data.endswith(b"# EOF\n")
+
+    # The follower takes over, and starts the jobs, once the leader is gone
+    leader.release()
+    for _ in range(500):
+        if len(elected) == 2:
+            break
+        time.sleep(0.01)
+    assert elected == ["leader", "follower"]
+    follower.release()
+
+
+def test_follower_ready_once_leader_is(tmp_path):
+    from freg_quality_metrics.exposition import SnapshotCollector
+
+    leader = SnapshotCollector(prometheus_client.CollectorRegistry())
+    follower = SnapshotCollector(prometheus_client.CollectorRegistry())
+    leader.share(tmp_path / "metrics.shared")
+    follower.follow(tmp_path / "metrics.shared")
+
+    # Published before the leader has loaded any metrics, so not shared
+    leader.publish()
+    assert follower.snapshot.generation == 0
+    assert not follower.snapshot.ready
+
+    leader.ready.set()
+    leader.publish()
+    assert follower.snapshot.ready
+
+
+def test_new_leader_keeps_shared_snapshot_until_ready(tmp_path):
+    from freg_quality_metrics.exposition import SnapshotCollector
+
+    path = tmp_path / "metrics.shared"
+    old_leader = SnapshotCollector(prometheus_client.CollectorRegistry())
+    old_leader.share(path)
+    old_leader.ready.set()
+    old_leader.publish()
+
+    new_registry = prometheus_client.CollectorRegistry()
+    gauge = prometheus_client.Gauge("test_taken_over", "Test", registry=new_registry)
+    new_leader = SnapshotCollector(new_registry)
+    new_leader.follow(path)
+    assert new_leader.snapshot.ready
+
+    # Taking over, with nothing loaded yet
+    new_leader.share(path)
+    new_leader.publish()
+    follower = SnapshotCollector(prometheus_client.CollectorRegistry())
+    follower.follow(path)
+    assert follower.snapshot.ready
+    assert new_leader.following and new_leader.snapshot.ready
+
+    gauge.set(5)
+    new_leader.ready.set()
+    new_leader.publish()
+    assert not new_leader.following
+    assert b"test_taken_over 5.0" in follower.snapshot.text
@@ -0,0 +1,89 @@
+import threading
+from unittest.mock import MagicMock
+
+import pandas
+import prometheus_client
+
+
+FRAMES = {
+    "number_of_citizenships": pandas.DataFrame(
+        {"datasett": ["inndata"], "gruppe": ["2"], "antall": [7]}
+    ),
+    "latest_timestamp": pandas.DataFrame(
+        {
+            "datasett": ["inndata"],
+            "tabell": ["v_status"],
+            "variabel": ["status"],
+            "latest_timestamp": ["2022-11-01 12:00:00"],
+        }
+    ),
+}
+
+
+def test_refresh_all_polls_query_jobs(bigquery_client, monkeypatch):
+    from freg_quality_metrics import metrics
+    from freg_quality_metrics.engine import RefreshEngine
+
+    bq = MagicMock()
+    bq.query_jobs = True
+    monkeypatch.setitem(metrics.BACKENDS, metrics.GCP_PROJECTS[0], bq)
+    monkeypatch.setattr(metrics, "CHANGE_DETECTION", False)
+    events = []
+    # No job is done before both are submitted, however the threads are
+    # scheduled
+    both_submitted = threading.Event()
+
+    def submit(source):
+        # A query job that is done on its third poll after both are submitted
+        job = MagicMock(source=source, state="RUNNING", polls=0)
+
+        def reload():
+            if not both_submitted.is_set():
+                return
+            job.polls += 1
+            if job.polls == 3:
+                job.state = "DONE"
+
+        job.reload.side_effect = reload
+        events.append(("submit", source))
+        if len(events) == 2:
+            both_submitted.set()
+        return job
+
+    def download(job):
+        events.append(("download", job.source))
+        return FRAMES[job.source]
+
+    bq.submit_pre_aggregated.side_effect = submit
+    bq.download.side_effect = download
+
+    # One thread, which is not held while the queries run
+    engine = RefreshEngine(
+        ["preagg_num_citizenships", "preagg_latest_timestamp"],
+        60,
+        poll_seconds=0,
+        max_workers=1,
+    )
+    engine.loop.run_until_complete(engine.refresh_all())
+    engine.shutdown()
+
+    # Both queries run at the same time
+    assert [event for event, _ in events] == ["submit", "submit"] + ["download"] * 2
+    sample = prometheus_client.REGISTRY.get_sample_value
+    labels = {"group": "2", "database": "inndata", "project": metrics.GCP_PROJECTS[0]}
+    assert sample("freg_ant_statsborgerskap", labels) == 7
+
+
+def test_submit_runs_in_the_engine_pool():
+    from freg_quality_metrics.engine import RefreshEngine
+
+    engine = RefreshEngine([], 60, max_workers=1, projects=[])
+    loop = threading.Thread(target=engine.loop.run_forever, daemon=True)
+    loop.start()
+    try:
+        future = engine.submit(lambda project: threading.current_thread().name, "p")
+        assert future.result(5).startswith("refresh")
+    finally:
+        engine.loop.call_soon_threadsafe(engine.loop.stop)
+        loop.join()
+        engine.shutdown()
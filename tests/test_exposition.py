@@ -0,0 +1,67 @@
+import gzip
+
+import prometheus_client
+import pytest
+from werkzeug.test import Client
+
+
+@pytest.fixture
+def collector_registry():
+    return prometheus_client.CollectorRegistry()
+
+
+@pytest.fixture
+def gauge(collector_registry):
+    gauge = prometheus_client.Gauge(
+        "test_snapshot", "Test", registry=collector_registry
+    )
+    gauge.set(1)
+    return gauge
+
+
+@pytest.fixture
+def collector(collector_registry, gauge):
+    from freg_quality_metrics.exposition import SnapshotCollector
+
+    collector = SnapshotCollector(collector_registry)
+    collector.publish()
+    return collector
+
+
+@pytest.fixture
+def client(collector):
+    from freg_quality_metrics.exposition import make_wsgi_app
+
+    return Client(make_wsgi_app(collector))
+
+
+def test_snapshot_is_published_not_live(gauge, collector):
+    first = collector.snapshot
+    gauge.set(2)
+
+    assert b"test_snapshot 1.0" in collector.snapshot.text
+
+    second = collector.publish()
+    assert second.generation == first.generation + 1
+    assert b"test_snapshot 2.0" in second.text
+
+
+def test_not_modified(client, collector):
+    etag = client.get("/").headers["ETag"]
+    assert client.get("/", headers={"If-None-Match": etag}).status_code == 304
+
+    collector.publish()
+    assert client.get("/", headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_gzip_openmetrics(client):
+    response = client.get(
+        "/",
+        headers={
+            "Accept": "application/openmetrics-text; version=0.0.1",
+            "Accept-Encoding": "gzip",
+        },
+    )
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Content-Type"].startswith("application/openmetrics-text")
+    assert gzip.decompress(response.data).endswith(b"# EOF\n")
@@ -15,13 +15,27 @@ def client(bigquery_client):
     return client
 
 
-def test_ready(client):
-    """Tests the ready endpoint. Is always 200 for now"""
-    response = client.get("/health/ready")
-    assert response.status_code == 200
+def test_ready(client, monkeypatch):
+    """Tests the ready endpoint. Is 200 once metrics are loaded"""
+    import threading
+
+    from freg_quality_metrics import metrics
+
+    monkeypatch.setattr(metrics, "READY", threading.Event())
+    assert client.get("/health/ready").status_code == 503
+
+    metrics.READY.set()
+    assert client.get("/health/ready").status_code == 200
 
 
 def test_alive(client):
     """Tests the alive endpoint. Is always 200 for now"""
     response = client.get("/health/alive")
     assert response.status_code == 200
+
+
+def test_metrics(client):
+    """Tests that the metrics endpoint serves the published snapshot"""
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert b"freg_metrics_interval_seconds" in response.data
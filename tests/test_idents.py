@@ -0,0 +1,36 @@
+import pytest
+
+from freg_quality_metrics import idents
+
+
+@pytest.mark.parametrize(
+    "test_input,expected",
+    [
+        ("2222", (False, "invalid_format")),
+        ("01234567891", (False, "invalid_date")),
+        ("01012000a1", (False, "invalid_format")),
+        ("010120002398573984753241", (False, "invalid_format")),
+        (None, (False, "invalid_format")),
+        ("01010012356", (False, None)),
+        ("41010012345", (True, "invalid_control")),
+        # The day of a dnr starting with 9 is 50 or more
+        ("91010012345", (True, "invalid_date")),
+        # 2000 is a leap year, 1990 is not
+        ("29020050088", (False, None)),
+        ("29021990025", (False, "invalid_date")),
+    ],
+)
+def test_classify(test_input, expected):
+    is_dnr, failed = idents.classify([test_input])
+    check = idents.CHECKS[failed[0]] if failed[0] >= 0 else None
+    assert (bool(is_dnr[0]), check) == expected
+
+
+def test_count_chunks():
+    counts = idents.count_chunks([["01010012356", "2222"], ["91010012345"]])
+    assert counts["fnr_total_count"] == 2
+    assert counts["fnr_invalid_format"] == 1
+    assert counts["dnr_total_count"] == 1
+    assert counts["dnr_invalid_date"] == 1
+    assert counts["dnr_invalid_first_digit"] == 0
+    assert list(counts) == idents.COLUMNS
@@ -0,0 +1,243 @@
+import datetime
+from unittest.mock import MagicMock
+
+import pandas
+
+
+def _rows(*rows):
+    return pandas.DataFrame(
+        rows, columns=["tidspunkt", "kolonne", "ant_nullvals", "pct_nullvals"]
+    )
+
+
+def test_nullvalue_history():
+    from freg_quality_metrics.incremental import NullvalueHistory
+
+    day1 = datetime.datetime(2022, 11, 1, 6, tzinfo=datetime.timezone.utc)
+    day2 = day1 + datetime.timedelta(days=1)
+    history = NullvalueHistory()
+    history.update(
+        _rows(
+            (day1, "fodselsdato", 10, 1.0),
+            (day1, "kjoenn", 5, 0.5),
+            (day2, "fodselsdato", 30, 3.0),
+        )
+    )
+    assert history.watermark == day2
+
+    # Only fodselsdato is part of the latest run
+    latest = history.latest()
+    assert list(latest.kolonne) == ["fodselsdato"]
+    assert list(latest.ant_nullvals) == [30]
+    diff = history.diff()
+    assert list(diff.pct_diff_last) == [2.0]
+    assert history.latest_timestamp().latest_timestamp[0] == "02-11-2022 06:00:00"
+
+    # A row already seen is ignored, a new one moves the column on
+    history.update(_rows((day1, "kjoenn", 7, 0.7), (day2, "kjoenn", 5, 0.55)))
+    assert history.columns["kjoenn"] == ((day2, 5, 0.55), (day1, 5, 0.5))
+    assert list(history.diff().kolonne) == ["fodselsdato"]
+
+    # The saved rows rebuild the same history
+    restored = NullvalueHistory()
+    restored.update(history.rows())
+    assert restored.columns == history.columns
+
+
+def test_distinct_counts_merge_new_rows(bigquery_client, monkeypatch):
+    import prometheus_client
+
+    from freg_quality_metrics import metrics
+    from freg_quality_metrics.bigquery import HLL_RELATIVE_ERROR
+    from freg_quality_metrics.incremental import DistinctCounts
+
+    column = ("inndata", "v_hendelse", "hendelsesid")
+    monkeypatch.setattr(metrics, "DISTINCT_COUNTS", {column: ("approx", "dato")})
+    monkeypatch.setitem(metrics.DISTINCT, metrics.GCP_PROJECTS[0], DistinctCounts())
+    bq = MagicMock()
+    monkeypatch.setitem(metrics.BACKENDS, metrics.GCP_PROJECTS[0], bq)
+
+    day1 = datetime.date(2022, 11, 1)
+    bq.count_total_and_uniques_approx.return_value = {
+        "total": 100.0,
+        "unique": 90.0,
+        "sketch": b"day1",
+        "watermark": day1,
+    }
+    metrics.set_distinct_counts(metrics.fetch_distinct_counts())
+    bq.count_total_and_uniques_approx.assert_called_with(*column, "dato", None, None)
+
+    # The next count continues from the sketch and watermark of the first,
+    # and adds the new rows to the total
+    bq.count_total_and_uniques_approx.return_value = {
+        "total": 10.0,
+        "unique": 95.0,
+        "sketch": b"day2",
+        "watermark": day1 + datetime.timedelta(days=1),
+    }
+    rows = metrics.fetch_distinct_counts()
+    bq.count_total_and_uniques_approx.assert_called_with(*column, "dato", day1, b"day1")
+    assert list(rows.totalt) == [110.0]
+    assert list(rows.distinkte) == [95.0]
+    assert list(rows.relativ_feil) == [HLL_RELATIVE_ERROR]
+
+    # Apart from the counts of preagg_total_and_distinct of the same column
+    preagg = pandas.DataFrame(
+        [column + (120.0, 100.0)],
+        columns=["datasett", "tabell", "variabel", "totalt", "distinkte"],
+    )
+    metrics.set_total_and_distinct(preagg)
+    metrics.set_distinct_counts(rows)
+    labels = dict(zip(["database", "table", "column"], column))
+    labels["project"] = metrics.GCP_PROJECTS[0]
+    sample = prometheus_client.REGISTRY.get_sample_value
+    assert sample("freg_unique_rows", labels) == 100.0
+    assert sample("freg_counted_unique_rows", labels) == 95.0
+
+
+def test_group_by_counts_move_changed_persons(bigquery_client, monkeypatch):
+    import prometheus_client
+
+    from freg_quality_metrics import metrics
+    from freg_quality_metrics.incremental import LatestRecords
+
+    column = ("inndata", "v_status", "status")
+    monkeypatch.setattr(metrics, "GROUP_BY_COUNTS", {column: "ingestion_time"})
+    monkeypatch.setitem(
+        metrics.LATEST, metrics.GCP_PROJECTS[0], {column: LatestRecords()}
+    )
+    bq = MagicMock()
+    monkeypatch.setitem(metrics.BACKENDS, metrics.GCP_PROJECTS[0], bq)
+
+    def records(*rows, watermark):
+        return pandas.DataFrame(
+            rows, columns=["ident", "gyldighetstidspunkt", "value"]
+        ).assign(watermark=watermark)
+
+    bq.latest_records_since.return_value = records(
+        ("1", "2021-01-01", "bosatt"), ("2", "2021-01-01", "bosatt"), watermark=1
+    )
+    metrics.set_group_by_counts(metrics.fetch_group_by_counts())
+    bq.latest_records_since.assert_called_with(*column, "ingestion_time", None)
+
+    # Person 1 moves out, and a late record of person 2 older than the one
+    # kept is ignored
+    bq.latest_records_since.return_value = records(
+        ("1", "2022-01-01", "utflyttet"), ("2", "2020-01-01", "doed"), watermark=2
+    )
+    metrics.set_group_by_counts(metrics.fetch_group_by_counts())
+    bq.latest_records_since.assert_called_with(*column, "ingestion_time", 1)
+
+    latest = metrics.LATEST[metrics.GCP_PROJECTS[0]][column]
+    assert latest.group_counts() == {"bosatt": 1, "utflyttet": 1}
+    assert latest.watermark == 2
+    labels = {
+        "database": "inndata",
+        "table": "v_status",
+        "column": "status",
+        "project": metrics.GCP_PROJECTS[0],
+    }
+    sample = prometheus_client.REGISTRY.get_sample_value
+    assert sample("freg_latest_group_by", {"group": "utflyttet", **labels}) == 1
+
+    # The saved rows rebuild the same counts and watermark
+    rows = metrics.group_by_counts_rows()
+    restored = LatestRecords()
+    monkeypatch.setitem(metrics.LATEST, metrics.GCP_PROJECTS[0], {column: restored})
+    metrics.set_group_by_counts(rows)
+    assert restored.group_counts() == latest.group_counts()
+    assert restored.watermark == 2
+
+
+def test_group_by_counts_streamed_page_by_page(bigquery_client, monkeypatch):
+    from freg_quality_metrics import metrics
+    from freg_quality_metrics.incremental import LatestRecords
+
+    column = ("inndata", "v_status", "status")
+    monkeypatch.setattr(metrics, "GROUP_BY_COUNTS", {column: "ingestion_time"})
+    monkeypatch.setattr(metrics, "STREAM_PAGE_SIZE", 1)
+    latest = LatestRecords()
+    monkeypatch.setitem(metrics.LATEST, metrics.GCP_PROJECTS[0], {column: latest})
+    bq = MagicMock()
+    monkeypatch.setitem(metrics.BACKENDS, metrics.GCP_PROJECTS[0], bq)
+
+    def pages():
+        for ident, status in [("1", "bosatt"), ("2", "utflyttet")]:
+            yield pandas.DataFrame(
+                {
+                    "ident": [ident],
+                    "gyldighetstidspunkt": ["2021-01-01"],
+                    "value": [status],
+                    "watermark": [3],
+                }
+            )
+            # The watermark moves on once all pages are merged
+            assert latest.watermark is None
+
+    bq.latest_records_since_pages.return_value = pages()
+    rows = metrics.fetch_group_by_counts()
+    bq.latest_records_since_pages.assert_called_with(*column, "ingestion_time", None, 1)
+    assert rows.empty
+    metrics.set_group_by_counts(rows)
+    assert latest.group_counts() == {"bosatt": 1, "utflyttet": 1}
+    assert latest.watermark == 3
+
+
+def test_group_by_counts_save_changed_records(tmp_path, bigquery_client, monkeypatch):
+    from freg_quality_metrics import metrics
+    from freg_quality_metrics.incremental import LatestRecords
+    from freg_quality_metrics.store import ResultStore
+
+    column = ("inndata", "v_status", "status")
+    monkeypatch.setattr(metrics, "GROUP_BY_COUNTS", {column: "ingestion_time"})
+    monkeypatch.setattr(metrics, "STORE", ResultStore(tmp_path / "results.db"))
+    monkeypatch.setattr(metrics, "CHANGE_DETECTION", False)
+    latest = LatestRecords()
+    monkeypatch.setitem(metrics.LATEST, metrics.GCP_PROJECTS[0], {column: latest})
+    bq = MagicMock()
+    monkeypatch.setitem(metrics.BACKENDS, metrics.GCP_PROJECTS[0], bq)
+
+    day = datetime.datetime(2021, 1, 1)
+    idents = [f"{i}" for i in range(100)]
+    bq.latest_records_since.return_value = pandas.DataFrame(
+        {
+            "ident": idents,
+            "gyldighetstidspunkt": [day] * 100,
+            "value": ["bosatt"] * 100,
+            "watermark": [day] * 100,
+        }
+    )
+    metrics.run_job("group_by_counts")
+    assert not latest.unsaved
+
+    # One person moves out and one is added, and only they are saved
+    later = day + datetime.timedelta(days=1)
+    bq.latest_records_since.return_value = pandas.DataFrame(
+        {
+            "ident": ["1", "100"],
+            "gyldighetstidspunkt": [later] * 2,
+            "value": ["utflyttet", "bosatt"],
+            "watermark": [later] * 2,
+        }
+    )
+    metrics.run_job("group_by_counts")
+    assert latest.group_counts() == {"bosatt": 100, "utflyttet": 1}
+    assert len(latest.rows(unsaved=True)) == 0
+
+    # A restart rebuilds the same counts and watermark from the saved rows,
+    # and compares them with naive timestamps of new fetches
+    restored = LatestRecords()
+    monkeypatch.setitem(metrics.LATEST, metrics.GCP_PROJECTS[0], {column: restored})
+    metrics.load_saved_results()
+    assert restored.group_counts() == latest.group_counts()
+    assert restored.watermark == later
+    bq.latest_records_since.return_value = pandas.DataFrame(
+        {
+            "ident": ["2"],
+            "gyldighetstidspunkt": [later],
+            "value": ["doed"],
+            "watermark": [later],
+        }
+    )
+    metrics.run_job("group_by_counts")
+    assert restored.group_counts() == {"bosatt": 99, "utflyttet": 1, "doed": 1}
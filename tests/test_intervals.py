@@ -0,0 +1,122 @@
+import datetime
+import threading
+import time
+from unittest.mock import MagicMock
+
+import prometheus_client
+
+
+def test_interval_follows_changes():
+    from freg_quality_metrics.intervals import JobInterval
+
+    interval = JobInterval("test_job", "test", 5, max_minutes=20, growth=2)
+    interval.record(False)
+    interval.record(False)
+    assert interval.effective_seconds == 20 * 60
+    interval.record(False)
+    assert interval.effective_seconds == 20 * 60
+
+    interval.record(True)
+    assert interval.effective_seconds == 10 * 60
+    interval.record(True)
+    interval.record(True)
+    assert interval.effective_seconds == 5 * 60
+
+
+def test_interval_kept_when_postponed():
+    from freg_quality_metrics.budget import POSTPONED
+    from freg_quality_metrics.intervals import JobInterval
+
+    interval = JobInterval("test_job", "test", 5, max_minutes=20, growth=2)
+    interval.record(None)
+    interval.record(POSTPONED)
+    interval.record(POSTPONED)
+    assert (interval.seconds, interval.failures) == (5 * 60, 1)
+
+
+def test_interval_backs_off_after_failures():
+    from freg_quality_metrics.intervals import JobInterval
+
+    interval = JobInterval("test_job", "test", 5, max_minutes=60, jitter=0.1)
+    for _ in range(3):
+        interval.record(None)
+    assert interval.effective_seconds == 40 * 60
+    assert 36 * 60 <= interval.delay() <= 44 * 60
+    sample = prometheus_client.REGISTRY.get_sample_value
+    labels = {"name": "test_job", "project": "test"}
+    assert sample("freg_metrics_interval_seconds", labels) == 40 * 60
+
+    # A success ends the backoff
+    interval.record(True)
+    assert interval.effective_seconds == 5 * 60
+
+
+def test_interval_published_after_changed_refresh():
+    from freg_quality_metrics import exposition
+    from freg_quality_metrics.intervals import JobInterval
+
+    interval = JobInterval("test_published", "test", 5, max_minutes=20, growth=2)
+    interval.record(False)
+    interval.record(True)
+
+    (family,) = [
+        family
+        for family in exposition.COLLECTOR.collect()
+        if family.name == "freg_metrics_interval_seconds"
+    ]
+    (value,) = [
+        sample.value
+        for sample in family.samples
+        if sample.labels == {"name": "test_published", "project": "test"}
+    ]
+    assert value == 5 * 60
+
+
+def test_run_schedules_next_refresh():
+    from freg_quality_metrics import scheduler
+    from freg_quality_metrics.intervals import JobInterval
+
+    interval = JobInterval("test_job", "test", 5, growth=2, jitter=0)
+    apscheduler = MagicMock()
+    refresh = MagicMock(side_effect=RuntimeError("BigQuery is down"))
+
+    scheduler._run(apscheduler, interval, refresh)
+
+    refresh.assert_called_once_with("test")
+    assert interval.failures == 1
+    args, kwargs = apscheduler.modify_job.call_args
+    assert args == ("test/test_job",)
+    assert kwargs["next_run_time"] > datetime.datetime.now()
+
+
+def test_scheduled_job_survives_its_runs():
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    from freg_quality_metrics import scheduler
+    from freg_quality_metrics.intervals import JobInterval
+
+    interval = JobInterval("test_survives", "test", 5, max_minutes=60, jitter=0)
+    ran = threading.Event()
+
+    def refresh(project):
+        ran.set()
+        return True
+
+    apscheduler = BackgroundScheduler()
+    apscheduler.start()
+    try:
+        scheduler._schedule(apscheduler, interval, refresh, datetime.datetime.now())
+        assert ran.wait(5)
+        # The job is kept, with its next run moved from after the longest
+        # interval to after the interval of the job
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            job = apscheduler.get_job("test/test_survives")
+            now = datetime.datetime.now(job.next_run_time.tzinfo)
+            if job.next_run_time - now < datetime.timedelta(minutes=10):
+                break
+            time.sleep(0.01)
+        delay = job.next_run_time - now
+        assert datetime.timedelta(minutes=4) < delay <= datetime.timedelta(minutes=5)
+    finally:
+        apscheduler.shutdown(wait=False)
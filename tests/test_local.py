@@ -0,0 +1,135 @@
+import datetime
+
+import pandas
+import pytest
+
+
+duckdb = pytest.importorskip("duckdb")
+
+
+@pytest.fixture
+def local(tmp_path):
+    from freg_quality_metrics.local import LocalBackend
+
+    tidspunkt = datetime.datetime(2022, 11, 1, 6, tzinfo=datetime.timezone.utc)
+    tables = {
+        "kvalitet/metrics_count_total_and_distinct": pandas.DataFrame(
+            {
+                "tidspunkt": [tidspunkt.replace(tzinfo=None)],
+                "datasett": ["inndata"],
+                "tabell": ["v_status"],
+                "variabel": ["status"],
+                "totalt": [4],
+                "distinkte": [2],
+            }
+        ),
+        "kvalitet/qa_nullvalue_columns": pandas.DataFrame(
+            {
+                "tidspunkt": [tidspunkt - datetime.timedelta(days=1), tidspunkt],
+                "datasett": ["klargjort", "klargjort"],
+                "tabell": ["dsf_situasjonsuttak", "dsf_situasjonsuttak"],
+                "kolonne": ["fodselsdato", "fodselsdato"],
+                "ant_nullvals": [10, 30],
+                "pct_nullvals": [1.0, 3.0],
+            }
+        ),
+        "inndata/v_status": pandas.DataFrame(
+            {
+                "folkeregisteridentifikator": ["1", "1", "2", "3"],
+                "gyldighetstidspunkt": ["2020-01-01", "2021-01-01", "2021-01-01"]
+                + ["2021-01-01"],
+                "status": ["bosatt", "utflyttet", "bosatt", "bosatt"],
+            }
+        ),
+    }
+    for name, df in tables.items():
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        df.to_parquet(tmp_path / f"{name}.parquet")
+    return LocalBackend(tmp_path)
+
+
+def test_pre_aggregated(local):
+    df = local.pre_aggregated("total_and_distinct")
+    assert list(df.distinkte) == [2]
+    assert local.pre_aggregated("metrics_timestamp").latest_timestamp[0] == (
+        "2022-11-01 06:00:00"
+    )
+    assert local.dsfsit_latest_timestamp() == {"timestamp": "01-11-2022 06:00:00"}
+    diff = local.dsfsit_qa_nullvals_diff()
+    assert list(diff.pct_diff_last) == [2.0]
+
+
+def test_queries_on_source_tables(local):
+    # Only the latest record per person is counted
+    assert local.group_by_and_count("inndata", "v_status", "status") == {
+        "bosatt": 2,
+        "utflyttet": 1,
+    }
+    assert local.count_total_and_uniques("inndata", "v_status", "status") == {
+        "total": 4.0,
+        "unique": 2.0,
+    }
+    assert local.latest_timestamp_from_string(
+        "inndata", "v_status", "gyldighetstidspunkt", "%Y-%m-%d"
+    ) == {"timestamp": "2021-01-01 00:00:00"}
+
+
+def test_pre_aggregated_batch(local):
+    result = local.pre_aggregated_batch(["total_and_distinct", "metrics_timestamp"])
+    assert list(result["total_and_distinct"].totalt) == [4.0]
+    assert list(result["metrics_timestamp"].columns) == ["latest_timestamp"]
+
+
+def test_valid_and_invalid_idents(local):
+    df = local.valid_and_invalid_idents(
+        "inndata", "v_status", "folkeregisteridentifikator", chunk_size=2
+    )
+    assert df.fnr_total_count[0] == 4
+    assert df.fnr_invalid_format[0] == 4
+
+
+def test_latest_records_since(local):
+    df = local.latest_records_since(
+        "inndata", "v_status", "status", "gyldighetstidspunkt"
+    )
+    assert dict(zip(df.ident, df.value)) == {
+        "1": "utflyttet",
+        "2": "bosatt",
+        "3": "bosatt",
+    }
+    assert set(df.watermark) == {"2021-01-01"}
+
+    # Only the rows after the watermark are read
+    df = local.latest_records_since(
+        "inndata", "v_status", "status", "gyldighetstidspunkt", "2020-06-01"
+    )
+    assert len(df) == 3
+    df = local.latest_records_since(
+        "inndata", "v_status", "status", "gyldighetstidspunkt", "2021-01-01"
+    )
+    assert df.empty
+
+
+def test_dsfsit_qa_nullvals_since(local):
+    df = local.dsfsit_qa_nullvals_since()
+    assert list(df.ant_nullvals.sort_values()) == [10, 30]
+
+    # Only the rows after the watermark are read, a naive one is in UTC
+    watermark = datetime.datetime(2022, 10, 31, 6)
+    df = local.dsfsit_qa_nullvals_since(watermark)
+    assert list(df.ant_nullvals) == [30]
+    df = local.dsfsit_qa_nullvals_since(watermark + datetime.timedelta(days=1))
+    assert df.empty
+
+
+def test_results_read_page_by_page(local):
+    assert local.group_by_and_count("inndata", "v_status", "status", page_size=1) == {
+        "bosatt": 2,
+        "utflyttet": 1,
+    }
+    pages = list(
+        local.latest_records_since_pages(
+            "inndata", "v_status", "status", "gyldighetstidspunkt", page_size=1
+        )
+    )
+    assert [len(page) for page in pages] == [1, 1, 1]
@@ -0,0 +1,72 @@
+from unittest.mock import MagicMock
+
+import pandas
+import prometheus_client
+import pytest
+
+
+@pytest.fixture
+def metrics(bigquery_client, monkeypatch):
+    from freg_quality_metrics import metrics
+
+    bq = MagicMock()
+    bq.table_fingerprint.return_value = ("2022-11-01", 10)
+    bq.pre_aggregated.return_value = pandas.DataFrame(
+        {"kolonne": ["fodselsdato"], "ant_nullvals": [1], "pct_nullvals": [0.5]}
+    )
+    monkeypatch.setitem(metrics.BACKENDS, metrics.GCP_PROJECTS[0], bq)
+    monkeypatch.setattr(metrics, "CHANGE_DETECTION", True)
+    monkeypatch.setattr(metrics, "_fingerprints", {})
+    return metrics
+
+
+def test_run_job_skips_unchanged_table(metrics):
+    metrics.run_job("dsfsit_qa_nullvals_latest")
+    metrics.run_job("dsfsit_qa_nullvals_latest")
+    assert metrics.backend().pre_aggregated.call_count == 1
+
+    metrics.backend().table_fingerprint.return_value = ("2022-11-02", 12)
+    metrics.run_job("dsfsit_qa_nullvals_latest")
+    assert metrics.backend().pre_aggregated.call_count == 2
+
+
+def test_run_job_records_query_phases(metrics):
+    from freg_quality_metrics.bigquery import QueryStats
+
+    def pre_aggregated(source):
+        metrics._record_query(QueryStats(1, 2, 0.5, 100, 200, 30, 1, True))
+        return metrics.backend().pre_aggregated.return_value
+
+    metrics.backend().pre_aggregated.side_effect = pre_aggregated
+    sample = prometheus_client.REGISTRY.get_sample_value
+    name = {"name": "dsfsit_qa_nullvals_latest", "project": metrics.GCP_PROJECTS[0]}
+    before = sample("freg_query_bytes_billed_total", name) or 0
+
+    metrics.run_job("dsfsit_qa_nullvals_latest")
+
+    assert sample("freg_query_bytes_billed_total", name) == before + 200
+    for phase in ["queue", "execution", "download", "apply"]:
+        assert sample("freg_query_seconds_count", {**name, "phase": phase}) >= 1
+
+
+def test_run_job_labels_metrics_by_project(metrics, monkeypatch):
+    prod = MagicMock()
+    prod.table_fingerprint.return_value = ("2022-11-01", 10)
+    prod.pre_aggregated.return_value = pandas.DataFrame(
+        {"kolonne": ["fodselsdato"], "ant_nullvals": [3], "pct_nullvals": [0.1]}
+    )
+    monkeypatch.setitem(metrics.BACKENDS, "prod-freg", prod)
+
+    metrics.run_job("dsfsit_qa_nullvals_latest")
+    metrics.run_job("dsfsit_qa_nullvals_latest", "prod-freg")
+
+    sample = prometheus_client.REGISTRY.get_sample_value
+    column = {"column": "fodselsdato"}
+    project = metrics.GCP_PROJECTS[0]
+    assert sample("freg_dsfsit_nullvals_latest", {**column, "project": project}) == 1
+    assert (
+        sample("freg_dsfsit_nullvals_latest", {**column, "project": "prod-freg"}) == 3
+    )
+    # Change detection is kept per project
+    metrics.run_job("dsfsit_qa_nullvals_latest", "prod-freg")
+    assert prod.pre_aggregated.call_count == 1
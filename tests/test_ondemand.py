@@ -0,0 +1,78 @@
+import concurrent.futures
+import threading
+from unittest.mock import MagicMock
+
+
+def test_scheduled_run_joins_triggered_refresh(monkeypatch):
+    from freg_quality_metrics import ondemand, scheduler
+    from freg_quality_metrics.intervals import JobInterval
+
+    monkeypatch.setattr(ondemand, "_refreshed_at", {})
+    monkeypatch.setattr(ondemand, "_triggered_at", {})
+    monkeypatch.setattr(ondemand, "_refreshes", [])
+    release = threading.Event()
+    calls = []
+
+    def refresh(project):
+        calls.append(project)
+        release.wait(5)
+        return True
+
+    # One thread for all refreshes, busy with the one a scrape triggered
+    pool = concurrent.futures.ThreadPoolExecutor(1)
+    ondemand.configure([(refresh, "job", "test")], pool)
+    ondemand._refreshed_at["test/job"] -= 120
+    ondemand.refresh_stale(max_staleness=60, wait_seconds=0)
+
+    # The scheduled run joins it instead of waiting for it in a thread
+    interval = JobInterval("job", "test", 5, jitter=0)
+    apscheduler = MagicMock()
+    scheduler._run(apscheduler, interval, refresh)
+    apscheduler.modify_job.assert_not_called()
+
+    release.set()
+    pool.shutdown(wait=True)
+    assert calls == ["test"]
+    apscheduler.modify_job.assert_called_once()
+    assert interval.failures == 0
+
+
+def test_refresh_stale_only_refreshes_stale_jobs(monkeypatch):
+    from freg_quality_metrics import ondemand
+
+    monkeypatch.setattr(ondemand, "_refreshed_at", {})
+    monkeypatch.setattr(ondemand, "_triggered_at", {})
+    monkeypatch.setattr(ondemand, "_refreshes", [])
+    calls = []
+
+    def refresh(project):
+        calls.append(project)
+        return True
+
+    pool = concurrent.futures.ThreadPoolExecutor(1)
+    ondemand.configure(
+        [(refresh, "fresh_job", "test"), (refresh, "stale_job", "test")], pool
+    )
+    # Just configured, so not stale before their first scheduled runs
+    ondemand.refresh_stale(max_staleness=60, wait_seconds=5)
+    assert calls == []
+
+    ondemand._refreshed_at["test/stale_job"] -= 120
+    ondemand.refresh_stale(max_staleness=60, wait_seconds=5)
+    assert calls == ["test"]
+    assert ondemand._refreshed_at.keys() == {"test/fresh_job", "test/stale_job"}
+
+    # Both are fresh now, so the next scrape is served right away
+    ondemand.refresh_stale(max_staleness=60, wait_seconds=5)
+    assert calls == ["test"]
+
+
+def test_scrape_wait_seconds_within_scrape_timeout():
+    from freg_quality_metrics import ondemand
+
+    assert ondemand.scrape_wait_seconds({}, wait_seconds=5) == 5
+    header = "HTTP_X_PROMETHEUS_SCRAPE_TIMEOUT_SECONDS"
+    assert ondemand.scrape_wait_seconds({header: "10"}, wait_seconds=5) == 5
+    assert ondemand.scrape_wait_seconds({header: "3"}, wait_seconds=5) == 2.5
+    assert ondemand.scrape_wait_seconds({header: "0.1"}, wait_seconds=5) == 0
+    assert ondemand.scrape_wait_seconds({header: "soon"}, wait_seconds=5) == 5
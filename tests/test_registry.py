@@ -0,0 +1,226 @@
+import math
+
+import pandas
+import prometheus_client
+import pytest
+
+
+@pytest.fixture
+def collector_registry():
+    return prometheus_client.CollectorRegistry()
+
+
+def test_set_from_frame(collector_registry):
+    from freg_quality_metrics import registry
+
+    metric = prometheus_client.Gauge(
+        "test_group_by", "Test", ["group", "table"], registry=collector_registry
+    )
+    df = pandas.DataFrame({"gruppe": ["a", "b", 3], "antall": [1, 2, 3]})
+
+    registry.set_from_frame(metric, df, {"group": "gruppe"}, "antall", table="t")
+
+    sample = collector_registry.get_sample_value
+    assert sample("test_group_by", {"group": "a", "table": "t"}) == 1
+    assert sample("test_group_by", {"group": "b", "table": "t"}) == 2
+    assert sample("test_group_by", {"group": "3", "table": "t"}) == 3
+
+
+def test_set_from_frame_reuses_children(collector_registry):
+    from freg_quality_metrics import registry
+
+    metric = prometheus_client.Gauge(
+        "test_cached", "Test", ["group"], registry=collector_registry
+    )
+    df = pandas.DataFrame({"gruppe": ["a"], "antall": [1]})
+    registry.set_from_frame(metric, df, {"group": "gruppe"}, "antall")
+    child = registry._children[metric][("a",)]
+
+    registry.set_from_frame(
+        metric, df.assign(antall=[5]), {"group": "gruppe"}, "antall"
+    )
+
+    assert registry._children[metric][("a",)] is child
+    assert collector_registry.get_sample_value("test_cached", {"group": "a"}) == 5
+
+
+def test_get_or_create_creates_once():
+    from concurrent.futures import ThreadPoolExecutor
+
+    from freg_quality_metrics import registry
+
+    graphs = registry.MetricRegistry()
+    calls = []
+
+    def factory():
+        calls.append(1)
+        return object()
+
+    with ThreadPoolExecutor(8) as pool:
+        metrics = list(
+            pool.map(lambda _: graphs.get_or_create("m", factory), range(100))
+        )
+
+    assert len(calls) == 1
+    assert all(metric is metrics[0] for metric in metrics)
+
+
+def test_set_from_arrow_table(collector_registry):
+    import pyarrow
+
+    from freg_quality_metrics import registry
+
+    metric = prometheus_client.Gauge(
+        "test_arrow", "Test", ["group"], registry=collector_registry
+    )
+    table = pyarrow.table({"gruppe": ["a", "b", "a", None], "antall": [1, 2, 3, 4]})
+
+    registry.set_from_frame(metric, table, {"group": "gruppe"}, "antall")
+
+    sample = collector_registry.get_sample_value
+    assert sample("test_arrow", {"group": "a"}) == 3
+    assert sample("test_arrow", {"group": "b"}) == 2
+    assert sample("test_arrow", {"group": "None"}) == 4
+
+
+def test_cycle_evicts_stale_series(collector_registry, monkeypatch):
+    from freg_quality_metrics import registry
+
+    monkeypatch.setattr(registry, "EVICT_AFTER_CYCLES", 2)
+    metric = prometheus_client.Gauge(
+        "test_evicted", "Test", ["group"], registry=collector_registry
+    )
+    both = pandas.DataFrame({"gruppe": ["a", "b"], "antall": [1, 2]})
+    only_a = pandas.DataFrame({"gruppe": ["a"], "antall": [1]})
+
+    with registry.cycle("test_evicted"):
+        registry.set_from_frame(metric, both, {"group": "gruppe"}, "antall")
+    with registry.cycle("test_evicted"):
+        registry.set_from_frame(metric, only_a, {"group": "gruppe"}, "antall")
+    assert collector_registry.get_sample_value("test_evicted", {"group": "b"}) == 2
+
+    with registry.cycle("test_evicted"):
+        registry.set_from_frame(metric, only_a, {"group": "gruppe"}, "antall")
+    assert collector_registry.get_sample_value("test_evicted", {"group": "b"}) is None
+    assert collector_registry.get_sample_value("test_evicted", {"group": "a"}) == 1
+    series = prometheus_client.REGISTRY.get_sample_value(
+        "freg_metrics_series", {"family": "test_evicted"}
+    )
+    assert series == 1
+
+
+def test_cycle_only_tags_children_of_its_own_context(collector_registry, monkeypatch):
+    import threading
+
+    from freg_quality_metrics import registry
+
+    monkeypatch.setattr(registry, "EVICT_AFTER_CYCLES", 1)
+    metric = prometheus_client.Counter(
+        "test_untagged", "Test", ["name"], registry=collector_registry
+    )
+
+    # Written by another thread while a cycle of job_a is running
+    with registry.cycle("job_a"):
+        thread = threading.Thread(
+            target=lambda: registry.child(metric, name="job_b").inc(5)
+        )
+        thread.start()
+        thread.join()
+    with registry.cycle("job_a"):
+        pass
+    sample = collector_registry.get_sample_value(
+        "test_untagged_total", {"name": "job_b"}
+    )
+    assert sample == 5
+
+
+def test_set_from_frame_folds_past_cardinality_limit(collector_registry, monkeypatch):
+    from freg_quality_metrics import registry
+
+    monkeypatch.setitem(registry.CARDINALITY_LIMITS, "test_folded", 3)
+    metric = prometheus_client.Gauge(
+        "test_folded", "Test", ["group", "table"], registry=collector_registry
+    )
+    df = pandas.DataFrame(
+        {"gruppe": ["a", "b", "c", "d", "e"], "antall": [50, 40, 3, 2, 1]}
+    )
+
+    registry.set_from_frame(
+        metric, df, {"group": "gruppe"}, "antall", fold="group", table="t"
+    )
+
+    sample = collector_registry.get_sample_value
+    assert sample("test_folded", {"group": "a", "table": "t"}) == 50
+    assert sample("test_folded", {"group": "b", "table": "t"}) == 40
+    assert sample("test_folded", {"group": "other", "table": "t"}) == 6
+    assert sample("test_folded", {"group": "c", "table": "t"}) is None
+    overflow = prometheus_client.REGISTRY.get_sample_value(
+        "freg_metrics_cardinality_overflow", {"family": "test_folded"}
+    )
+    assert overflow == 3
+
+
+def test_set_from_pages_folds_across_pages(collector_registry, monkeypatch):
+    from freg_quality_metrics import registry
+
+    monkeypatch.setitem(registry.CARDINALITY_LIMITS, "test_paged", 3)
+    metric = prometheus_client.Gauge(
+        "test_paged", "Test", ["group", "table"], registry=collector_registry
+    )
+    pages = iter(
+        [
+            pandas.DataFrame({"gruppe": ["a", "b"], "antall": [50, 40]}),
+            pandas.DataFrame({"gruppe": ["c", "d"], "antall": [3, 2]}),
+            pandas.DataFrame({"gruppe": ["e"], "antall": [1]}),
+        ]
+    )
+
+    registry.set_from_pages(
+        metric, pages, {"group": "gruppe"}, "antall", fold="group", table="t"
+    )
+
+    sample = collector_registry.get_sample_value
+    assert sample("test_paged", {"group": "a", "table": "t"}) == 50
+    assert sample("test_paged", {"group": "b", "table": "t"}) == 40
+    assert sample("test_paged", {"group": "other", "table": "t"}) == 6
+    assert sample("test_paged", {"group": "c", "table": "t"}) is None
+    overflow = prometheus_client.REGISTRY.get_sample_value(
+        "freg_metrics_cardinality_overflow", {"family": "test_paged"}
+    )
+    assert overflow == 3
+
+
+def test_set_from_pages_keeps_row_at_limit(collector_registry, monkeypatch):
+    from freg_quality_metrics import registry
+
+    monkeypatch.setitem(registry.CARDINALITY_LIMITS, "test_paged_limit", 3)
+    metric = prometheus_client.Gauge(
+        "test_paged_limit", "Test", ["group"], registry=collector_registry
+    )
+    pages = [
+        pandas.DataFrame({"gruppe": ["a", "b"], "antall": [50, 40]}),
+        pandas.DataFrame({"gruppe": ["c"], "antall": [3]}),
+    ]
+
+    registry.set_from_pages(metric, pages, {"group": "gruppe"}, "antall", fold="group")
+
+    sample = collector_registry.get_sample_value
+    assert sample("test_paged_limit", {"group": "c"}) == 3
+    assert sample("test_paged_limit", {"group": "other"}) is None
+
+
+def test_set_from_arrow_table_with_nulls(collector_registry):
+    pyarrow = pytest.importorskip("pyarrow")
+
+    from freg_quality_metrics import registry
+
+    metric = prometheus_client.Gauge(
+        "test_arrow_nulls", "Test", ["group"], registry=collector_registry
+    )
+    table = pyarrow.table({"gruppe": ["a", "b"], "antall": pyarrow.array([1, None])})
+
+    registry.set_from_frame(metric, table, {"group": "gruppe"}, "antall")
+
+    sample = collector_registry.get_sample_value
+    assert sample("test_arrow_nulls", {"group": "a"}) == 1
+    assert math.isnan(sample("test_arrow_nulls", {"group": "b"}))
@@ -0,0 +1,46 @@
+"""
+Startup-time budget: importing the package and creating the app must not load
+the heavy modules behind the scheduled jobs, and must stay within
+STARTUP_BUDGET_SECONDS.
+"""
+import os
+import subprocess
+import sys
+
+
+STARTUP_BUDGET_SECONDS = float(os.environ.get("STARTUP_BUDGET_SECONDS", "3"))
+
+HEAVY_MODULES = ["google.cloud.bigquery", "pandas", "pyarrow"]
+
+SCRIPT = f"""
+import sys
+import time
+
+start = time.perf_counter()
+import freg_quality_metrics.app
+
+loaded = [name for name in {HEAVY_MODULES!r} if name in sys.modules]
+print(time.perf_counter() - start)
+print(",".join(loaded))
+"""
+
+
+def _slowest_imports(importtime: str, n=10) -> str:
+    rows = [line.split("|") for line in importtime.splitlines() if "|" in line]
+    rows = [row for row in rows if row[1].strip().isdigit()]
+    rows.sort(key=lambda row: int(row[1]), reverse=True)
+    return "\n".join("|".join(row) for row in rows[:n])
+
+
+def test_import_time():
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", SCRIPT],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    seconds, loaded = process.stdout.splitlines()[-2:]
+    report = _slowest_imports(process.stderr)
+
+    assert loaded == "", f"Heavy modules imported at startup: {loaded}\n{report}"
+    assert float(seconds) < STARTUP_BUDGET_SECONDS, report
@@ -0,0 +1,73 @@
+import datetime
+
+import pandas
+
+
+def test_save_and_load(tmp_path):
+    from freg_quality_metrics.store import ResultStore
+
+    df = pandas.DataFrame(
+        {
+            "tidspunkt": [datetime.datetime(2022, 11, 1, tzinfo=datetime.timezone.utc)],
+            "gyldighetstidspunkt": [datetime.datetime(2022, 10, 1, 12)],
+            "kolonne": ["fodselsdato"],
+            "pct_nullvals": [0.5],
+        }
+    )
+    ResultStore(tmp_path / "results.db").save("dsfsit_qa_nullvals_incremental", df)
+
+    loaded = ResultStore(tmp_path / "results.db").load()
+
+    saved_at, restored = loaded["dsfsit_qa_nullvals_incremental"]
+    assert isinstance(saved_at, datetime.datetime)
+    pandas.testing.assert_frame_equal(restored, df, check_dtype=False)
+    assert restored.tidspunkt[0] == df.tidspunkt[0]
+    # Columns without a time zone are loaded without one
+    assert restored.gyldighetstidspunkt.dt.tz is None
+    assert restored.gyldighetstidspunkt[0] == df.gyldighetstidspunkt[0]
+
+
+def test_saved_results_publish_when_fetched(tmp_path, bigquery_client, monkeypatch):
+    import threading
+
+    from freg_quality_metrics import exposition, metrics
+    from freg_quality_metrics.store import ResultStore
+
+    store = ResultStore(tmp_path / "results.db")
+    monkeypatch.setattr(metrics, "STORE", store)
+    monkeypatch.setattr(metrics, "READY", threading.Event())
+    df = pandas.DataFrame({"datasett": ["inndata"], "gruppe": ["2"], "antall": [7]})
+    store.save(f"{metrics.GCP_PROJECTS[0]}/preagg_num_citizenships", df)
+
+    metrics.load_saved_results()
+
+    # Published with the metrics of the saved result, without a refresh
+    assert metrics.READY.is_set()
+    text = exposition.COLLECTOR.snapshot.text.decode()
+    assert 'freg_metrics_fetched_timestamp_seconds{name="preagg_num_citizenships"' in (
+        text
+    )
+
+
+def test_save_by_key_upserts_rows(tmp_path):
+    from freg_quality_metrics.store import ResultStore
+
+    store = ResultStore(tmp_path / "results.db")
+    first = pandas.DataFrame(
+        {
+            "ident": ["1", "2"],
+            "gyldighetstidspunkt": [datetime.datetime(2021, 1, 1)] * 2,
+            "value": ["bosatt", "bosatt"],
+        }
+    )
+    store.save("group_by_counts", first, key=["ident"])
+    # Only the changed row, and one without any timestamp to tell the type
+    store.save("group_by_counts", first.iloc[1:].assign(value="utflyttet"), ["ident"])
+    store.save("group_by_counts", first.iloc[0:0], key=["ident"])
+
+    _, restored = store.load()["group_by_counts"]
+    assert dict(zip(restored.ident, restored.value)) == {
+        "1": "bosatt",
+        "2": "utflyttet",
+    }
+    assert restored.gyldighetstidspunkt.dt.tz is None